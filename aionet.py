@@ -0,0 +1,206 @@
+'''
+drizzle -- Drizzle
+aionet -- asyncio front end
+
+Runs a DrizzlePeer on an asyncio event loop instead of its own Reactor, so
+the mesh can share the loop with the rest of an application's I/O. Datagrams
+arrive through a DatagramProtocol, timers are scheduled with loop.call_at,
+and the waiting parts of the API (SyncTo, handler delivery, DesyncAll)
+return Futures or Queues that coroutines can wait on.
+
+Works with asyncio, or with the trollius backport on Python 2.
+'''
+
+import time
+import socket
+
+try:
+	import asyncio
+except ImportError:
+	import trollius as asyncio
+
+import log
+import reactor
+from netlayer import DrizzlePeer, Packet, CMD, STATE
+
+logger=log.getLogger(__name__)
+
+def _Future(loop):
+	if hasattr(loop, 'create_future'):
+		return loop.create_future()
+	return asyncio.Future(loop=loop)
+
+class LoopScheduler(object):
+	#Stands in for a reactor.Reactor as far as DrizzlePeer.timers (and
+	#anything else using DrizzlePeer.reactor for timers) is concerned.
+	def __init__(self, loop):
+		self.loop=loop
+		self.handles={} #Timer -> asyncio.Handle
+		self.hooks=[]
+		self.pending=False #An end-of-dispatch flush is scheduled
+	def AddTimer(self, timer):
+		self.RemoveTimer(timer)
+		at=self.loop.time()+max(0.0, timer.nextcall-time.time())
+		self.handles[timer]=self.loop.call_at(at, self._Fire, timer)
+	def RemoveTimer(self, timer):
+		handle=self.handles.pop(timer, None)
+		if handle is not None:
+			handle.cancel()
+	def CallLater(self, delay, callback, *args):
+		alarm=reactor.Alarm(delay, callback, *args)
+		self.AddTimer(alarm)
+		return alarm
+	def AddHooks(self, begin, end):
+		self.hooks.append((begin, end))
+	def Dispatch(self, f, *args):
+		#Like one Reactor dispatch: the begin hooks run now, and the end hooks
+		#once, after everything else this loop iteration has done.
+		for begin, end in self.hooks:
+			begin()
+		if not self.pending:
+			self.pending=True
+			self.loop.call_soon(self._End)
+		return f(*args)
+	def _End(self):
+		self.pending=False
+		for begin, end in self.hooks:
+			end()
+	def _Fire(self, timer):
+		del self.handles[timer]
+		try:
+			self.Dispatch(timer.Fire)
+		except Exception:
+			logger.exception('Timer %r failed', timer.callback) #As Reactor.RunTimers does
+		if timer.nextcall is not None and timer not in self.handles:
+			self.AddTimer(timer)
+	def CancelAll(self):
+		for handle in self.handles.values():
+			handle.cancel()
+		self.handles.clear()
+
+class TransportSocket(object):
+	#What DrizzlePeer needs of its socket, with sends through the transport.
+	def __init__(self, transport, sock):
+		self.transport=transport
+		self.sock=sock
+	def sendto(self, data, addr):
+		self.transport.sendto(data, addr)
+	def getsockname(self):
+		return self.sock.getsockname()
+	def fileno(self):
+		return self.sock.fileno()
+
+class DrizzleProtocol(asyncio.DatagramProtocol):
+	def __init__(self, node):
+		self.node=node
+	def connection_made(self, transport):
+		self.node.ConnectionMade(transport)
+	def datagram_received(self, data, addr):
+		self.node.scheduler.Dispatch(self.node.dpeer.Recv, data, addr)
+	def error_received(self, exc):
+		logger.warning('Socket error on %r: %s', self.node.dpeer.addrs, exc)
+	def connection_lost(self, exc):
+		self.node.ConnectionLost(exc)
+
+class QueueHandler(object):
+	#A netlayer handler that queues (peer, pkt) for coroutines; Get returns
+	#an awaitable for the next one.
+	def __init__(self, maxsize=0):
+		self.queue=asyncio.Queue(maxsize)
+	def Recv(self, peer, pkt):
+		try:
+			self.queue.put_nowait((peer, pkt))
+		except asyncio.QueueFull:
+			logger.warning('Handler queue full; dropping DATA from %r', peer)
+	def StateChange(self, peer, state):
+		pass
+	def Get(self):
+		return self.queue.get()
+
+class AsyncDrizzlePeer(object):
+	DIRECT_STATES=(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	def __init__(self, loop=None, dpeer=None):
+		#dpeer, if given, must not be Run or Attached elsewhere.
+		if loop is None:
+			loop=asyncio.get_event_loop()
+		if dpeer is None:
+			dpeer=DrizzlePeer()
+		self.loop=loop
+		self.dpeer=dpeer
+		self.scheduler=LoopScheduler(loop)
+		self.transport=None
+		self.ready=_Future(loop)
+		self.starting=None #Task opening the transport, while Start is in progress
+		self.syncwaiters={} #Addr -> [Future]
+		dpeer.observers.append(self.StateChange)
+	def Start(self, addr=('', 0)):
+		#Opens a transport bound to addr, which replaces the DrizzlePeer's own
+		#socket; returns a Future that completes with self once it is up.
+		#Failing to open it (say, the address is in use) fails the Future.
+		coro=self.loop.create_datagram_endpoint(lambda: DrizzleProtocol(self), local_addr=addr)
+		self.starting=asyncio.ensure_future(coro, loop=self.loop)
+		self.starting.add_done_callback(self.Started)
+		return self.ready
+	def Started(self, task):
+		self.starting=None
+		if task.cancelled():
+			if not self.ready.done():
+				self.ready.cancel()
+		elif task.exception() is not None:
+			if not self.ready.done():
+				self.ready.set_exception(task.exception())
+	def ConnectionMade(self, transport):
+		self.transport=transport
+		sock=transport.get_extra_info('socket')
+		self.dpeer.sock.close()
+		self.dpeer.sock=TransportSocket(transport, sock)
+		self.dpeer.addrs=set([sock.getsockname()])
+		self.dpeer.reactor=self.scheduler
+		self.scheduler.AddHooks(self.dpeer.BeginTick, self.dpeer.Flush)
+		self.dpeer.timers.Attach(self.scheduler)
+		if not self.ready.done():
+			self.ready.set_result(self)
+	def ConnectionLost(self, exc):
+		self.scheduler.CancelAll()
+		self.dpeer.timers.reactor=None
+		for waiters in self.syncwaiters.values():
+			for fut in waiters:
+				if not fut.done():
+					fut.set_exception(exc or socket.error('Transport closed'))
+		self.syncwaiters.clear()
+	def StateChange(self, peer, state):
+		if state in self.DIRECT_STATES:
+			for fut in self.syncwaiters.pop(peer.addr, ()):
+				if not fut.done():
+					fut.set_result(peer)
+	def SyncTo(self, addr, timeout=None):
+		#Returns a Future for the Peer at addr once it is directly connected.
+		addr=tuple(addr)
+		fut=_Future(self.loop)
+		peer=self.dpeer.GetPeer(addr)
+		if peer is not None and peer.state in self.DIRECT_STATES:
+			fut.set_result(peer)
+			return fut
+		self.syncwaiters.setdefault(addr, []).append(fut)
+		self.scheduler.Dispatch(self.dpeer.SyncTo, addr)
+		if timeout is not None:
+			return asyncio.wait_for(fut, timeout)
+		return fut
+	def AddHandler(self, name, maxsize=0):
+		#Registers and returns a QueueHandler for DATA sent to name.
+		handler=QueueHandler(maxsize)
+		self.dpeer.handlers[name]=handler
+		return handler
+	def Send(self, peer, handler, **attrs):
+		self.scheduler.Dispatch(peer.Send, Packet(CMD.DATA, handler=handler, **attrs))
+	def DesyncAll(self, close=True):
+		#Desyncs every peer; the returned Future completes once the DESYNCs
+		#are handed to the transport (and it is closed, if close).
+		fut=_Future(self.loop)
+		self.scheduler.Dispatch(self.dpeer.DesyncAll)
+		def done():
+			if close and self.transport is not None:
+				self.transport.close()
+			fut.set_result(None)
+		self.loop.call_soon(done) #After the scheduler's flush
+		return fut
@@ -0,0 +1,328 @@
+'''
+drizzle -- Drizzle
+bench -- Benchmarks
+
+Numbers to track from release to release, as JSON:
+
+convergence -- how long (in simulated time) and how many datagrams and
+bytes it takes N nodes that each SyncTo one seed to all become directly
+connected (it's an error if they never do), on public addresses and behind
+NATs (so through arbitration); and how many links a mesh with symmetric
+NATs in it (some pairs of which can never connect) holds, which must never
+fall.
+gossip -- what a converged mesh spends per node per minute, by CMD, keeping
+itself up to date (KEEPALIVE, PEERS, HANDLERS), and on the wire in all.
+recv -- packets per second from DrizzlePeer.Recv, through Peer.Recv, to a
+handler, with plain and columnar (see peertable) peers.
+peers -- memory per peer, and timer sweeps per second, for PEERS_SIZE peers
+in a plain and a columnar peer table.
+serialize -- Packets per second encoded and decoded, at the oldest and
+newest wire versions, and their encoded sizes.
+
+The first two run on the simulator (see sim), so they come out the same
+every time until the protocol changes; the rest are rates on this machine,
+best of a few runs. Every result says which way is better and how far
+(as a fraction) it may move that way before it counts as a regression.
+Given a baseline (an earlier run's output), any regressions are listed and
+the exit status is 1.
+
+    python bench.py [-o <output file>] [-b <baseline file>] [<benchmark> ...]
+'''
+
+import gc
+import sys
+import time
+import json
+import socket
+import resource
+import platform
+import collections
+import multiprocessing
+
+import log
+import sim
+import serialize
+from netlayer import DrizzlePeer, Packet, CMD, STATE, CLOCK_MASK, HandlersVersion
+from peertable import ColumnarDrizzlePeer
+
+SEED=0 #For the simulator
+CONVERGENCE_SIZES=(10, 50) #Nodes on public addresses
+CONVERGENCE_NAT_SIZES=(20,) #Nodes each behind a NAT (full-cone or port-restricted, alternately) but the seed
+CONVERGENCE_MIXED_SIZES=(20,) #As above, but symmetric NATs too
+CONVERGENCE_TIMEOUT=300 #Simulated s to give up on full connectivity after
+CONVERGENCE_STEP=0.25 #Resolution (in simulated s) of convergence times
+GOSSIP_SIZE=20 #Nodes in the mesh
+GOSSIP_WARMUP=60 #Simulated s after convergence before measuring...
+GOSSIP_PERIOD=300 #...for this long
+GOSSIP_CMDS=(CMD.KEEPALIVE, CMD.PEERS, CMD.HANDLERS)
+PEERS_SIZE=20000 #Peers in the peer table benchmarks
+PEER_TABLES=(('plain', DrizzlePeer), ('columnar', ColumnarDrizzlePeer))
+RUN_TIME=0.1 #Least time (in s) a run of a rate benchmark should take
+REPEAT=5 #Runs of a rate benchmark to take the best of
+SIM_TOLERANCE=0.05 #Simulated results only move when the code does...
+RATE_TOLERANCE=0.25 #...but rates vary from run to run
+LOWER='lower'
+HIGHER='higher'
+
+def Result(value, unit, better, tolerance):
+	return {'value': value, 'unit': unit, 'better': better, 'tolerance': tolerance}
+
+def Time(f, count):
+	#As timeit does, without the garbage collector's pauses.
+	gcwas=gc.isenabled()
+	gc.disable()
+	try:
+		start=time.time()
+		for i in xrange(count):
+			f()
+		return time.time()-start
+	finally:
+		if gcwas:
+			gc.enable()
+
+def Rate(f, repeat=REPEAT, runtime=RUN_TIME):
+	#Calls to f per s. Runs of calls are doubled in length until one takes
+	#runtime s, then the best of repeat such runs is taken.
+	count=1
+	elapsed=Time(f, count)
+	while elapsed<runtime:
+		count*=2
+		elapsed=Time(f, count)
+	for i in xrange(repeat-1):
+		elapsed=min(elapsed, Time(f, count))
+	return count/elapsed
+
+def Mesh(s, count, nats=()):
+	#Adds count nodes to the Simulator s, all synced to the first (the seed);
+	#those after it go behind NATs of the kinds in nats, in turn, if any.
+	seed=s.AddNode()
+	for i in xrange(count-1):
+		nat=s.AddNAT(nats[i%len(nats)]) if nats else None
+		s.AddNode(nat).SyncTo(seed.sock.getsockname())
+	return seed
+
+def Converge(s, count, timeout=CONVERGENCE_TIMEOUT):
+	#Runs s until all count nodes are directly connected, returning the
+	#simulated time taken, or None if they weren't after timeout s.
+	full=count*(count-1)
+	took=s.RunWhile(lambda: s.Links()<full, timeout, CONVERGENCE_STEP)
+	return took if s.Links()>=full else None
+
+def BenchConvergence():
+	results={}
+	cases=[('convergence.%d'%(count,), count, ()) for count in CONVERGENCE_SIZES]
+	cases.extend(('convergence.nat.%d'%(count,), count, (sim.NAT.FULL_CONE, sim.NAT.RESTRICTED)) for count in CONVERGENCE_NAT_SIZES)
+	for name, count, nats in cases:
+		with sim.Simulator(SEED) as s:
+			Mesh(s, count, nats)
+			took=Converge(s, count)
+			if took is None:
+				raise RuntimeError('Mesh of %d nodes failed to converge'%(count,))
+			stats=s.net.stats
+			results[name+'.time']=Result(took, 's', LOWER, SIM_TOLERANCE)
+			results[name+'.datagrams']=Result(stats['sent'], 'datagrams', LOWER, SIM_TOLERANCE)
+			results[name+'.bytes']=Result(stats['bytes'], 'bytes', LOWER, SIM_TOLERANCE)
+	for count in CONVERGENCE_MIXED_SIZES:
+		with sim.Simulator(SEED) as s:
+			Mesh(s, count, (sim.NAT.FULL_CONE, sim.NAT.RESTRICTED, sim.NAT.SYMMETRIC))
+			most=0
+			for i in xrange(int(CONVERGENCE_TIMEOUT/CONVERGENCE_STEP)):
+				s.Run(CONVERGENCE_STEP)
+				links=s.Links()
+				if links<most:
+					raise RuntimeError('Mesh of %d nodes with symmetric NATs lost links (%d, had %d) at %gs'%(count, links, most, (i+1)*CONVERGENCE_STEP))
+				most=links
+			results['convergence.mixed.%d.links'%(count,)]=Result(links, 'links', HIGHER, SIM_TOLERANCE)
+	return results
+
+def BenchGossip():
+	results={}
+	with sim.Simulator(SEED) as s:
+		Mesh(s, GOSSIP_SIZE)
+		if Converge(s, GOSSIP_SIZE) is None:
+			raise RuntimeError('Mesh of %d nodes failed to converge'%(GOSSIP_SIZE,))
+		s.Run(GOSSIP_WARMUP)
+		wire=s.net.stats['bytes']
+		before=[list(node.metrics.txbytes) for node in s.nodes]
+		s.Run(GOSSIP_PERIOD)
+		scale=60.0/GOSSIP_PERIOD/GOSSIP_SIZE
+		for cmd in GOSSIP_CMDS:
+			sent=sum(node.metrics.txbytes[cmd]-txbytes[cmd] for node, txbytes in zip(s.nodes, before))
+			results['gossip.%s'%(CMD.LOOKUP[cmd],)]=Result(round(sent*scale, 1), 'bytes/node/min', LOWER, SIM_TOLERANCE)
+		results['gossip.wire']=Result(round((s.net.stats['bytes']-wire)*scale, 1), 'bytes/node/min', LOWER, SIM_TOLERANCE)
+		if s.Links()<GOSSIP_SIZE*(GOSSIP_SIZE-1):
+			raise RuntimeError('Mesh of %d nodes lost links while idle'%(GOSSIP_SIZE,))
+	return results
+
+class Sink(object):
+	#A handler that counts what it gets.
+	def __init__(self, dpeer, name='bench'):
+		self.name=name
+		self.count=0
+		dpeer.handlers[name]=self
+	def Recv(self, peer, pkt):
+		self.count+=1
+	def StateChange(self, peer, state):
+		pass
+
+def RecvRate(cls):
+	sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.bind(('127.0.0.1', 0))
+	dpeer=cls(sock)
+	try:
+		sink=Sink(dpeer)
+		src=('127.0.0.1', 9) #Discard; anything the peer sends back goes nowhere
+		peer=dpeer.GetPeer(src, True)
+		peer.state=STATE.DIRECT
+		peer.wire=serialize.WIRE_VERSION
+		data=Packet(CMD.DATA, handler=sink.name, data='\0'*256).Encode(serialize.WIRE_VERSION)
+		dpeer.Recv(data, src)
+		if sink.count!=1:
+			raise RuntimeError('Packet failed to reach the handler')
+		return Rate(lambda: dpeer.Recv(data, src))
+	finally:
+		sock.close()
+
+def BenchRecv():
+	return {'recv.data': Result(round(RecvRate(DrizzlePeer)), 'packets/s', HIGHER, RATE_TOLERANCE),
+			'recv.data.columnar': Result(round(RecvRate(ColumnarDrizzlePeer)), 'packets/s', HIGHER, RATE_TOLERANCE)}
+
+def Resident():
+	#This process's resident memory (in bytes), or None where /proc can't say.
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1])*resource.getpagesize()
+	except (IOError, OSError):
+		return None
+
+def Populate(cls, count):
+	#A cls (some DrizzlePeer) knowing count peers, all NOT_CONNECTED.
+	sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.bind(('127.0.0.1', 0))
+	dpeer=cls(sock)
+	dpeer.MAX_PEERS=max(dpeer.MAX_PEERS, count)
+	for i in xrange(count):
+		dpeer.GetPeer(('10.%d.%d.%d'%(i>>16, (i>>8)&0xff, i&0xff), 9652), True)
+	return dpeer
+
+def PeerBytes(cls, count):
+	#Memory per peer that count peers of a cls take, measured in a child
+	#process, so no memory this one freed earlier gets reused.
+	def child(conn):
+		gc.collect()
+		before=Resident()
+		dpeer=Populate(cls, count)
+		gc.collect()
+		after=Resident()
+		conn.send(None if before is None else (after-before)/float(count))
+		dpeer.sock.close()
+	mine, theirs=multiprocessing.Pipe()
+	proc=multiprocessing.Process(target=child, args=(theirs,))
+	proc.start()
+	value=mine.recv()
+	proc.join()
+	return value
+
+def BenchPeers():
+	results={}
+	for name, cls in PEER_TABLES:
+		size=PeerBytes(cls, PEERS_SIZE)
+		results['peers.bytes.'+name]=Result(size and round(size), 'bytes/peer', LOWER, RATE_TOLERANCE)
+		dpeer=Populate(cls, PEERS_SIZE)
+		try:
+			results['peers.sweep.'+name]=Result(round(Rate(dpeer.DoPeerTimers)), 'sweeps/s', HIGHER, RATE_TOLERANCE)
+		finally:
+			dpeer.sock.close()
+	return results
+
+def SamplePackets():
+	#Name -> a Packet like the ones that make up most traffic. Clocks are
+	#the latest Millis gives, so the round trip at WIRE_V1 checks they fit.
+	addrs=[('10.%d.%d.%d'%(i>>16, (i>>8)&0xff, i&0xff), 9652) for i in xrange(64)]
+	handlers=['stream', 'swarm:0123456789abcdef0123456789abcdef']
+	return {'keepalive': Packet(CMD.KEEPALIVE, t=CLOCK_MASK),
+			'peers': Packet(CMD.PEERS, gen=1000, epoch=0x12345678, peers=addrs, states=[STATE.DIRECT]*len(addrs)),
+			'handlers': Packet(CMD.HANDLERS, handlers=handlers, version=HandlersVersion(handlers)),
+			'data': Packet(CMD.DATA, handler='stream', data='\0'*1024, sid=1234, seq=56789, ts=CLOCK_MASK, ack=56000, wnd=1024, echo=CLOCK_MASK, delay=1234)}
+
+def BenchSerialize():
+	results={}
+	for name, pkt in SamplePackets().iteritems():
+		for version in (serialize.WIRE_V1, serialize.WIRE_VERSION):
+			key='%s.v%d'%(name, version)
+			data=pkt.Encode(version)
+			if Packet.FromStr(data).Fields()!=pkt.Fields():
+				raise RuntimeError('%s packet changed in encoding'%(key,))
+			results['serialize.encode.'+key]=Result(round(Rate(lambda: pkt.Encode(version))), 'packets/s', HIGHER, RATE_TOLERANCE)
+			results['serialize.decode.'+key]=Result(round(Rate(lambda: Packet.FromStr(data).Fields())), 'packets/s', HIGHER, RATE_TOLERANCE)
+			results['serialize.size.'+key]=Result(len(data), 'bytes', LOWER, 0.0)
+	return results
+
+BENCHMARKS=collections.OrderedDict([('convergence', BenchConvergence),
+		('gossip', BenchGossip),
+		('recv', BenchRecv),
+		('peers', BenchPeers),
+		('serialize', BenchSerialize)])
+
+def Run(names=None):
+	#Runs the named benchmarks (all by default), returning name -> Result.
+	results={}
+	for name, bench in BENCHMARKS.iteritems():
+		if names and name not in names:
+			continue
+		start=time.time()
+		results.update(bench())
+		sys.stderr.write('%s: %.1fs\n'%(name, time.time()-start))
+	return results
+
+def Compare(results, baseline):
+	#Returns (name, baseline value, value) for every result worse than in
+	#baseline (name -> Result) by more than its tolerance allows.
+	regressions=[]
+	for name, result in sorted(results.iteritems()):
+		base=baseline.get(name)
+		if base is None or base['value'] is None:
+			continue
+		value=result['value']
+		if value is None:
+			regressions.append((name, base['value'], value))
+			continue
+		worse=value-base['value'] if result['better']==LOWER else base['value']-value
+		if worse>result['tolerance']*abs(base['value']):
+			regressions.append((name, base['value'], value))
+	return regressions
+
+if __name__=='__main__':
+	args=sys.argv[1:]
+	out=None
+	baseline=None
+	names=[]
+	while args:
+		arg=args.pop(0)
+		if arg=='-o':
+			out=args.pop(0)
+		elif arg=='-b':
+			baseline=args.pop(0)
+		elif arg in BENCHMARKS:
+			names.append(arg)
+		else:
+			sys.exit('Unknown benchmark %r (have %s)'%(arg, ', '.join(BENCHMARKS)))
+	log.getLogger().setLevel(log.CRITICAL)
+	report={'python': platform.python_version(),
+			'platform': platform.platform(),
+			'time': time.time(),
+			'results': Run(names)}
+	if baseline is not None:
+		with open(baseline) as f:
+			regressions=Compare(report['results'], json.load(f)['results'])
+		report['regressions']=[name for name, old, new in regressions]
+		for name, old, new in regressions:
+			sys.stderr.write('REGRESSION %s: %r -> %r %s\n'%(name, old, new, report['results'][name]['unit']))
+	text=json.dumps(report, indent=1, sort_keys=True)
+	if out is None:
+		print(text)
+	else:
+		with open(out, 'w') as f:
+			f.write(text+'\n')
+	if report.get('regressions'):
+		sys.exit(1)
@@ -3,11 +3,22 @@ drizzle -- Drizzle
 log -- Local logging
 
 Just a wrapper around logging that provides the basic setup needed.
+
+Console output goes through a QueueHandler, so the formatting and the
+writes to the terminal happen on a background thread rather than on
+whatever thread (usually the network loop) logged.
 '''
 
+import os
 import sys
+import threading
 from logging import *
 
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
 #basicConfig(format='%(asctime)-15s %(levelname)-10s %(name)-16s %(message)s', level=NOTSET)
 
 NETWORK=3
@@ -34,11 +45,69 @@ class ANSIFormatter(Formatter):
 			res=(SGI%(30+COLORS[record.levelno],))+res+(SGI%(0,))
 		return res
 
+class QueueHandler(Handler):
+	#Hands records over to a background thread, which passes them on to
+	#target. Only the message is rendered up front, as its arguments may have
+	#changed by the time the thread gets to it. Records past maxsize queued
+	#are dropped (and counted) rather than waited on.
+	def __init__(self, target, maxsize=10000):
+		Handler.__init__(self)
+		self.target=target
+		self.maxsize=maxsize
+		self.queue=None
+		self.thread=None
+		self.pid=None #Process the thread runs in; see emit
+		self.dropped=0
+		self.excfmt=Formatter()
+	def Start(self):
+		self.pid=os.getpid()
+		self.queue=queue.Queue(self.maxsize)
+		self.thread=threading.Thread(target=self.Run, name='log')
+		self.thread.daemon=True
+		self.thread.start()
+	def Run(self):
+		q=self.queue
+		while True:
+			record=q.get()
+			try:
+				if record is None:
+					return
+				self.target.handle(record)
+			finally:
+				q.task_done()
+	def emit(self, record):
+		#(Re)starts the thread on first use in each process, as forked
+		#children don't inherit it.
+		if self.pid!=os.getpid():
+			self.Start()
+		try:
+			record.msg=record.getMessage()
+			record.args=None
+			if record.exc_info:
+				record.exc_text=self.excfmt.formatException(record.exc_info)
+				record.exc_info=None
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped+=1
+		except Exception:
+			self.handleError(record)
+	def flush(self):
+		#Waits for what's queued to be written.
+		if self.pid==os.getpid():
+			self.queue.join()
+		self.target.flush()
+	def close(self):
+		if self.pid==os.getpid() and self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		self.pid=None
+		Handler.close(self)
+
 fmt=ANSIFormatter('%(asctime)-15s %(levelname)-10s %(name)-16s %(message)s')
 hdl=StreamHandler(sys.stdout)
 hdl.setFormatter(fmt)
 rl=getLogger()
-rl.addHandler(hdl)
+rl.addHandler(QueueHandler(hdl))
 rl.setLevel(NETWORK)
 
 del fmt, hdl, rl
@@ -0,0 +1,228 @@
+'''
+drizzle -- Drizzle
+metrics -- Counters and histograms
+
+What a DrizzlePeer counts as it goes: packets and bytes in and out by CMD
+and by peer, packets dropped by reason, arbitration outcomes, and
+histograms of KEEPALIVE round trips and handler latency. (BUNDLEs and
+FRAGMENTs are counted as well as the packets in them.) DrizzlePeer.Stats
+puts these together with gauges (peers by state, arbitrations in flight)
+into one snapshot of plain data.
+
+A StatsEndpoint answers any datagram sent to a local UDP or Unix socket
+with that snapshot as JSON ("peers" gets the per-peer counters too), so a
+running node can be watched from outside. Replies are kept to one datagram;
+when the per-peer counters don't fit, they come a page at a time, and Query
+asks for the rest:
+
+    python metrics.py <port or socket path> [peers]
+'''
+
+import os
+import sys
+import time
+import json
+import socket
+import bisect
+import tempfile
+
+import log
+
+logger=log.getLogger(__name__)
+
+LATENCY_BOUNDS=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) #In s
+
+class Histogram(object):
+	#Counts of values in buckets, each up to (and including) a bound; the
+	#last bucket takes everything past the last bound.
+	def __init__(self, bounds=LATENCY_BOUNDS):
+		self.bounds=bounds
+		self.counts=[0]*(len(bounds)+1)
+		self.count=0
+		self.total=0.0
+		self.min=None
+		self.max=None
+	def Observe(self, val):
+		self.counts[bisect.bisect_left(self.bounds, val)]+=1
+		self.count+=1
+		self.total+=val
+		if self.min is None or val<self.min:
+			self.min=val
+		if self.max is None or val>self.max:
+			self.max=val
+	def Quantile(self, q):
+		#The bound of the bucket holding the qth quantile (or the largest
+		#value, if it's in the last bucket).
+		if not self.count:
+			return None
+		rank=q*self.count
+		seen=0
+		for i, count in enumerate(self.counts):
+			seen+=count
+			if seen>=rank and count:
+				return self.bounds[i] if i<len(self.bounds) else self.max
+		return self.max
+	def Snapshot(self):
+		return {'count': self.count,
+				'sum': self.total,
+				'min': self.min,
+				'max': self.max,
+				'mean': self.total/self.count if self.count else None,
+				'p50': self.Quantile(0.5),
+				'p90': self.Quantile(0.9),
+				'p99': self.Quantile(0.99),
+				'buckets': [[bound, count] for bound, count in zip(list(self.bounds)+[None], self.counts) if count]}
+
+class Metrics(object):
+	ARBITRATION_OUTCOMES=('started', 'succeeded', 'ended', 'refused', 'timedout')
+	def __init__(self):
+		self.rxpackets=[0]*256 #By CMD
+		self.rxbytes=[0]*256
+		self.txpackets=[0]*256
+		self.txbytes=[0]*256
+		self.peers={} #Addr -> [rx packets, rx bytes, tx packets, tx bytes]
+		self.drops={} #Reason -> packets dropped
+		self.arbitrations=dict((outcome, 0) for outcome in self.ARBITRATION_OUTCOMES)
+		self.rtt=Histogram() #KEEPALIVE round trips
+		self.handlers={} #Handler name -> Histogram of its Recv's run time
+		self.start=time.time()
+	def Rx(self, addr, cmd, size):
+		self.rxpackets[cmd]+=1
+		self.rxbytes[cmd]+=size
+		counts=self.peers.get(addr)
+		if counts is None:
+			counts=self.peers[addr]=[0, 0, 0, 0]
+		counts[0]+=1
+		counts[1]+=size
+	def Tx(self, addr, cmd, size):
+		self.txpackets[cmd]+=1
+		self.txbytes[cmd]+=size
+		counts=self.peers.get(addr)
+		if counts is None:
+			counts=self.peers[addr]=[0, 0, 0, 0]
+		counts[2]+=1
+		counts[3]+=size
+	def Drop(self, reason):
+		self.drops[reason]=self.drops.get(reason, 0)+1
+	def Arbitration(self, outcome):
+		self.arbitrations[outcome]+=1
+	def HandlerTime(self, name, elapsed):
+		hist=self.handlers.get(name)
+		if hist is None:
+			hist=self.handlers[name]=Histogram()
+		hist.Observe(elapsed)
+	def Forget(self, addr):
+		self.peers.pop(addr, None)
+	def Snapshot(self, cmdnames):
+		#cmdnames is CMD.LOOKUP. Per-peer counters are left to PeerSnapshot.
+		cmds={}
+		for cmd in xrange(256):
+			if self.rxpackets[cmd] or self.txpackets[cmd]:
+				cmds[cmdnames.get(cmd, str(cmd))]={'rx_packets': self.rxpackets[cmd], 'rx_bytes': self.rxbytes[cmd], 'tx_packets': self.txpackets[cmd], 'tx_bytes': self.txbytes[cmd]}
+		return {'uptime': time.time()-self.start,
+				'cmds': cmds,
+				'drops': dict(self.drops),
+				'arbitration_outcomes': dict(self.arbitrations),
+				'keepalive_rtt': self.rtt.Snapshot(),
+				'handler_latency': dict((name, hist.Snapshot()) for name, hist in self.handlers.iteritems())}
+	def PeerSnapshot(self, addr):
+		counts=self.peers.get(addr, (0, 0, 0, 0))
+		return {'rx_packets': counts[0], 'rx_bytes': counts[1], 'tx_packets': counts[2], 'tx_bytes': counts[3]}
+
+class StatsEndpoint(object):
+	#Answers datagrams on addr (a (host, port) for UDP, or a str path for a
+	#Unix socket) with dpeer.Stats() as JSON. dpeer must be Attached.
+	MAX_REPLY=65507 #Bytes in a reply (the most a UDP datagram can hold)
+	def __init__(self, dpeer, addr):
+		self.dpeer=dpeer
+		if isinstance(addr, str):
+			self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		else:
+			self.sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(addr)
+		self.sock.setblocking(False)
+		dpeer.reactor.AddReader(self.sock, self.OnReadable)
+	def OnReadable(self, sock):
+		while True:
+			try:
+				req, src=sock.recvfrom(1024)
+			except socket.error:
+				return #Nothing left (EAGAIN)
+			if not src:
+				continue #An unbound Unix socket; no way to answer
+			words=req.decode('utf8', 'replace').split()
+			peers=words[:1]==['peers']
+			stats=self.dpeer.Stats(peers)
+			if peers:
+				reply=self.Page(stats, words[1] if len(words)>1 else None)
+			else:
+				reply=json.dumps(stats, sort_keys=True)
+			try:
+				sock.sendto(reply.encode('utf8'), src)
+			except socket.error as e:
+				logger.warning('Failed to send stats to %r: %s', src, e)
+				try:
+					sock.sendto(json.dumps({'error': str(e)}).encode('utf8'), src)
+				except socket.error:
+					pass
+	def Page(self, stats, after=None):
+		#stats (with by_peer) as JSON in at most MAX_REPLY bytes. by_peer
+		#holds the peers (in order of their keys) after after that fit, and
+		#if any are left out, by_peer_next is the key to ask after next
+		#("peers <key>").
+		bypeer=stats.pop('by_peer')
+		keys=sorted(key for key in bypeer if after is None or key>after)
+		stats['by_peer']={}
+		stats['by_peer_next']=''
+		room=self.MAX_REPLY-len(json.dumps(stats))-max([len(json.dumps(key)) for key in keys] or [0])
+		page=stats['by_peer']
+		for key in keys:
+			size=len(json.dumps({key: bypeer[key]}, sort_keys=True)) #No more than it adds to by_peer
+			if size>room and page:
+				break
+			room-=size
+			page[key]=bypeer[key]
+		if len(page)<len(keys):
+			stats['by_peer_next']=max(page)
+		else:
+			del stats['by_peer_next']
+		return json.dumps(stats, sort_keys=True)
+	def Close(self):
+		self.dpeer.reactor.RemoveReader(self.sock)
+		self.sock.close()
+
+def Query(addr, what='', timeout=1.0):
+	#Asks a StatsEndpoint at addr for its stats, putting together every
+	#page of by_peer if it comes in several.
+	if isinstance(addr, str):
+		sock=socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		path=tempfile.mktemp(prefix='drizzle-stats-')
+		sock.bind(path)
+	else:
+		sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		path=None
+	try:
+		sock.settimeout(timeout)
+		sock.sendto(what.encode('utf8'), addr)
+		stats=json.loads(sock.recv(65536).decode('utf8'))
+		after=stats.pop('by_peer_next', None)
+		while after is not None:
+			sock.sendto(('peers '+after).encode('utf8'), addr)
+			page=json.loads(sock.recv(65536).decode('utf8'))
+			if 'error' in page:
+				raise RuntimeError(page['error'])
+			stats['by_peer'].update(page['by_peer'])
+			after=page.get('by_peer_next')
+		return stats
+	finally:
+		sock.close()
+		if path is not None:
+			os.unlink(path)
+
+if __name__=='__main__':
+	if len(sys.argv)<2:
+		sys.argv.append('9653')
+	target=sys.argv[1]
+	if target.isdigit():
+		target=('127.0.0.1', int(target))
+	print(json.dumps(Query(target, ' '.join(sys.argv[2:])), indent=1, sort_keys=True))
@@ -13,6 +13,8 @@ import sys
 import socket
 import time
 import random
+import zlib
+import collections
 
 from Crypto.Cipher import AES
 from Crypto.Cipher import CAST
@@ -30,13 +32,19 @@ from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Signature import PKCS1_PSS
 
 import serialize
+import reconcile
+import metrics
 import log
+import reactor
+import wheel
+from reactor import Timer
 from cryptutil import PKCS5Padding
 
 PYTHON_3=(sys.version_info.major>=3)
 
 if PYTHON_3:
 	xrange=range
+	long=int
 
 logger=log.getLogger(__name__)
 
@@ -87,44 +95,113 @@ class CMD:
 	HANDLERS=5 #List handlers
 	DATA=6 #Other data
 	ROUTE=7 #Best effort delivery function (for embedded packets)
+	BUNDLE=8 #Several packets in one datagram (see FEATURE.BUNDLE)
+	FRAGMENT=9 #Piece of a packet too big for one datagram (see FEATURE.FRAGMENT)
+	@classmethod
+	def Register(cls, name, value=None):
+		#Adds a command (e.g. for a protocol built on Drizzle), by default with
+		#the next free value; handle it with Peer.RegisterCommand.
+		if value is None:
+			value=max(v for v in cls.LOOKUP if isinstance(v, int))+1
+		if value in cls.LOOKUP or not 0<=value<256:
+			raise ValueError('Command value %r is taken or out of range'%(value,))
+		setattr(cls, name, value)
+		cls.LOOKUP[value]=name
+		return value
 CMD.LOOKUP=dict(zip(CMD.__dict__.values(), CMD.__dict__.keys()))
+SYNC_BYTE=chr(CMD.SYNC) #What encoded SYNCs start with
 
 class Packet(object):
+	#Received packets keep their datagram (raw) and only decode the attrs when
+	#something first looks at them; until something changes them, Encode
+	#hands the same bytes back out (to any peer that can read them--see
+	#RAW_VERSIONS), so forwarded and echoed packets aren't re-serialized.
+	#Reading attrs gives out the dict itself, so it counts as a change; use
+	#the attributes, Has or Fields to only read.
+	__slots__=('cmd', '_attrs', 'raw', 'rawver')
+	SCHEMAS={} #CMD -> serialize.Schema for its attrs (see SCHEMA)
+	RAW_VERSIONS={serialize.MapSerializer.__tag__: serialize.WIRE_V1,
+			serialize.VMapSerializer.__tag__: serialize.WIRE_ARRAYS,
+			serialize.VSchemaSerializer.__tag__: serialize.WIRE_SCHEMA} #Body tag -> wire version needed to read it
 	def __init__(self, cmd, **kwargs):
 		self.cmd=cmd
-		self.attrs=kwargs
+		self._attrs=kwargs
+		self.raw=None
+		self.rawver=None #Lowest wire version raw can be sent at; None if it can't be reused
 	@classmethod
 	def FromStr(cls, s):
-		return cls(ord(s[0]), **serialize.Deserialize(s[1:]))
+		#Decodes straight out of the datagram buffer--no slicing or streams.
+		cmd, off=serialize.ByteSerializer.Unpack(s, 0)
+		if not isinstance(s, str):
+			#Someone else's buffer; don't hang on to it.
+			return cls(cmd, **serialize.DeserializeFrom(s, off)[0])
+		pkt=cls.__new__(cls)
+		object.__setattr__(pkt, 'cmd', cmd)
+		object.__setattr__(pkt, '_attrs', None)
+		object.__setattr__(pkt, 'raw', s)
+		object.__setattr__(pkt, 'rawver', cls.RAW_VERSIONS.get(s[off:off+1] and ord(s[off])))
+		return pkt
 	@classmethod
 	def Make(cls, obj):
 		if isinstance(obj, cls):
 			return obj
 		return cls.FromStr(obj) #XXX Eww.
+	def Fields(self):
+		#The attrs, decoded if need be. Don't change them through this.
+		attrs=self._attrs
+		if attrs is None:
+			attrs=serialize.DeserializeFrom(self.raw, 1)[0]
+			if not isinstance(attrs, dict):
+				raise TypeError('Packet body is a %s, not a map'%(type(attrs).__name__,))
+			object.__setattr__(self, '_attrs', attrs)
+		return attrs
+	def _get_attrs(self):
+		attrs=self.Fields()
+		object.__setattr__(self, 'rawver', None)
+		return attrs
+	def _set_attrs(self, val):
+		object.__setattr__(self, '_attrs', val)
+		object.__setattr__(self, 'rawver', None)
+	attrs=property(_get_attrs, _set_attrs)
 	def __getattr__(self, attr):
 		if attr=='cmd':
 			logger.warning('Failed to find "cmd" on a Packet; assuming default')
 			self.cmd=CMD.KEEPALIVE
 			return self.cmd
-		if attr=='attrs':
-			logger.warning('Failed to find "attrs" on a Packet; assuming default')
-			self.attrs={}
-			return self.attrs
-		return self.attrs[attr]
+		if attr in self.__slots__:
+			raise AttributeError(attr)
+		return self.Fields()[attr]
 	def __setattr__(self, attr, val):
-		if attr in ('cmd', 'attrs'):
+		if attr=='attrs':
+			self._set_attrs(val)
+			return
+		if attr in self.__slots__:
 			object.__setattr__(self, attr, val)
+			if attr!='cmd':
+				return
 		else:
-			self.attrs[attr]=val
+			self.Fields()[attr]=val
+		object.__setattr__(self, 'rawver', None)
 	def __delattr__(self, attr):
-		del self.attrs[attr]
+		del self.Fields()[attr]
+		object.__setattr__(self, 'rawver', None)
 	def __str__(self):
-		return chr(self.cmd)+serialize.Serialize(self.attrs)
+		return self.Encode(serialize.WIRE_V1)
+	def Encode(self, version):
+		if self.rawver is not None and version>=self.rawver:
+			return self.raw
+		attrs=self.Fields()
+		if version>=serialize.WIRE_SCHEMA and attrs:
+			schema=self.SCHEMAS.get(self.cmd)
+			if schema is not None:
+				return chr(self.cmd)+schema.Serialize(attrs, None, version)
+		return chr(self.cmd)+serialize.Serialize(attrs, None, version)
 	def __repr__(self):
-		return '<Packet cmd=%s %r>'%(CMD.LOOKUP[self.cmd], self.attrs)
+		return '<Packet cmd=%s %r>'%(CMD.LOOKUP[self.cmd], self.Fields())
 	def Has(self, *attrs):
+		fields=self.Fields()
 		for attr in attrs:
-			if attr not in self.attrs:
+			if attr not in fields:
 				return False
 		return True
 	@staticmethod
@@ -133,6 +210,17 @@ class Packet(object):
 			f.attrs=set(attrs)
 			return f
 		return decorator
+	@staticmethod
+	def SCHEMA(*fields):
+		#Declares the usual attrs of the packets handled by a cmd_* method, as
+		#(name, kind) pairs for serialize.Schema. Other attrs still work, they
+		#just cost more. Changing these changes the wire format, so peers only
+		#use WIRE_SCHEMA if their serialize.SchemaDigest matches (see cmd_SYNC).
+		def decorator(f, fields=fields):
+			cmd=getattr(CMD, f.__name__[len('cmd_'):])
+			Packet.SCHEMAS[cmd]=serialize.Schema(fields)
+			return f
+		return decorator
 
 class STATE:
 	NOT_CONNECTED=0 #Not connected to this peer at all
@@ -160,29 +248,74 @@ class STATE:
 STATE.LOOKUP=dict(zip(STATE.__dict__.values(), STATE.__dict__.keys()))
 STATE.ALL=set(xrange(STATE.MAX))
 
+class FEATURE:
+	#Optional parts of the protocol, as bits negotiated in SYNC (like the
+	#wire version); a peer only uses those both sides offered.
+	BUNDLE=1 #Accepts BUNDLE
+	FRAGMENT=2 #Accepts FRAGMENT
+
+CLOCK_MASK=0x7fffffff #Millis wraps at 2**31, so it fits even WIRE_V1's signed ints
+
+def Millis():
+	#The clock in ms, mod 2**31, as carried in 'L' fields.
+	return int(time.time()*1000)&CLOCK_MASK
+
+def HandlersVersion(names):
+	#What HANDLERS carries as "version" for handlers named names; 31 bits,
+	#so it fits even WIRE_V1's signed ints.
+	return zlib.crc32(repr(sorted(names)))&0x7fffffff
+
 class Peer(object):
+	#Everything a Peer keeps is set up by __init__, and has a slot here;
+	#subclasses that add their own (like peertable.ColumnarPeer) add slots.
+	__slots__=('this', 'addr', '_state', 'wire', 'features', 'handlers', 'handlersver', 'peers', 'psmap', 'peersgen', 'guess', 'reconcdiff', 'srtt', 'rttvar', 'lastact', 'lastsent', 'lastup')
 	KA_INTERVAL=5
 	KA_DROP=30
 	STATE_UPDATE=30
+	DISPATCH={} #Peer class -> its dispatch table (see CompileDispatch)
 	def __init__(self, this, addr, state=STATE.NOT_CONNECTED):
 		self.this=this
 		self.addr=tuple(addr)
 		self._state=state
+		self.wire=serialize.WIRE_V1 #Negotiated in SYNC
+		self.features=0 #FEATURE bits, also negotiated in SYNC
 		self.handlers=set()
+		self.handlersver=None #Version of handlers, from the last HANDLERS reply
 		self.peers=set()
 		self.psmap={}
+		self.peersgen=None #(epoch, gen) of peers/psmap, from the last PEERS reply
+		self.guess=None #The psmap summarized in our outstanding PEERS request, if any
+		self.reconcdiff=None #Expected size of the difference from guess (see DrizzlePeer.ReconcileCells)
+		self.srtt=None #Smoothed round trip time (in s), and its variation; see RTTSample
+		self.rttvar=None
 		self.lastact=time.time()
 		self.lastsent=self.lastact
 		self.lastup=self.lastact
+		self.Reschedule()
 	def __repr__(self):
 		return '<Peer @%r state %s>'%(self.addr, STATE.LOOKUP[self.state])
+	def __hash__(self):
+		#By addr (which never changes) rather than id, so that the order Peers
+		#come out of the timing wheel doesn't depend on where they were allocated.
+		return hash(self.addr)
 	def _get_state(self):
 		return self._state
 	def _set_state(self, val):
 		logger.info('%r state transition to %s', self, STATE.LOOKUP[val])
 		for handler in self.this.handlers.itervalues():
 			handler.StateChange(self, val)
+		for observer in self.this.observers:
+			observer(self, val)
+		if val==STATE.NOT_CONNECTED:
+			self.wire=serialize.WIRE_V1
+			self.features=0
+		wasdirect=self._state in (STATE.DIRECT, STATE.DIRECT_LOCAL)
 		self._state=val
+		self.Reschedule()
+		if self.this.peers.get(self.addr) is self:
+			self.this.PeerChanged(self.addr, val)
+		if wasdirect!=(val in (STATE.DIRECT, STATE.DIRECT_LOCAL)):
+			self.this.DirectChanged(self, not wasdirect)
 	state=property(_get_state, _set_state)
 	def Disconnect(self):
 		logger.info('Disconnecting %r...', self)
@@ -198,41 +331,180 @@ class Peer(object):
 			self.Disconnect()
 		elif self.lastsent+self.KA_INTERVAL<t:
 			logger.debug('Keep-alive sent to %r', self)
-			self.Send(Packet(CMD.KEEPALIVE))
+			self.Send(Packet(CMD.KEEPALIVE, t=Millis()))
 	def DoStateTimer(self):
 		if self.state not in (STATE.DIRECT, STATE.DIRECT_LOCAL):
 			return
 		if self.lastup+self.STATE_UPDATE<time.time():
 			self.UpdateState()
+	def NextDeadline(self):
+		#Earliest of the KA send, KA drop and state update deadlines. These
+		#only ever move later, so rather than rescheduling whenever lastact,
+		#lastsent or lastup change, DoTimers just refiles the peer if it comes
+		#due early.
+		return min(self.lastact+self.KA_DROP, self.lastsent+self.KA_INTERVAL, self.lastup+self.STATE_UPDATE)
+	def DoTimers(self):
+		#Called from the timing wheel (see DrizzlePeer.DoPeerTimers).
+		if self.state not in (STATE.DIRECT, STATE.DIRECT_LOCAL) or self.this.peers.get(self.addr) is not self:
+			return
+		self.DoKATimer()
+		self.DoStateTimer()
+		self.Reschedule()
+	def Reschedule(self):
+		#Puts a directly connected peer on the wheel (see DoTimers), or takes
+		#any other off it.
+		if self.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			self.this.wheel.Schedule(self, self.NextDeadline())
+		else:
+			self.this.wheel.Cancel(self)
+	def DirectLinks(self, anystate=False):
+		#The addrs this peer reported being directly connected to--usable for
+		#routing only while we're directly connected to it (unless anystate).
+		if not anystate and self.state not in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			return set()
+		return set(addr for addr, state in self.psmap.iteritems() if state==STATE.DIRECT)
 	def UpdateState(self):
 		logger.debug('Updating state on %r', self)
-		self.Send(Packet(CMD.HANDLERS))
-		self.Send(Packet(CMD.PEERS))
+		if self.handlersver is not None:
+			self.Send(Packet(CMD.HANDLERS, version=self.handlersver))
+		else:
+			self.Send(Packet(CMD.HANDLERS))
+		if self.peersgen is not None:
+			self.Send(Packet(CMD.PEERS, epoch=self.peersgen[0], since=self.peersgen[1]))
+		else:
+			self.SendPeersRequest()
 		self.lastup=time.time()
+	def SendPeersRequest(self):
+		#Asks for the whole peer list, but when that's likely to be long,
+		#summarizes a guess at it (see reconcile) so the reply only needs to
+		#say what's different.
+		guess=None
+		if self.wire>=serialize.WIRE_ARRAYS:
+			guess=self.this.GuessPeers(self)
+		summary=None
+		if guess is not None:
+			cells=self.this.ReconcileCells(self, guess)
+			if cells is not None:
+				summary=reconcile.Summarize(guess, cells)
+		if summary is None:
+			self.guess=None
+			self.Send(Packet(CMD.PEERS))
+		else:
+			self.guess=guess
+			self.Send(Packet(CMD.PEERS, summary=summary))
+	def ApplyPeers(self, addrs, states, gone):
+		#Updates peers/psmap with the listed changes, without rebuilding them.
+		psmap=self.psmap
+		links=set(addr for addr in addrs+gone if psmap.get(addr)==STATE.DIRECT)
+		known=set(addr for addr in addrs+gone if addr in psmap)
+		for addr, state in zip(addrs, states):
+			self.peers.add(addr)
+			psmap[addr]=state
+		for addr in gone:
+			self.peers.discard(addr)
+			psmap.pop(addr, None)
+		self.this.LinksChanged(self, links, set(addr for addr in addrs if psmap[addr]==STATE.DIRECT))
+		self.this.KnownChanged(self, known, set(addrs))
+		for addr, state in zip(addrs, states):
+			self.LearnPeer(addr, state)
+	def Sync(self):
+		#The SYNC request advertises our wire version and features; see cmd_SYNC.
+		self.Send(Packet(CMD.SYNC, you=self.addr, wire=self.this.WIRE_VERSION, features=self.this.FEATURES, schemas=serialize.SchemaDigest()))
 	def Send(self, pkt):
-		logger.log(log.NETWORK, '%r <- %r', self, pkt)
-		self.this.sock.sendto(str(pkt), self.addr)
+		data=pkt.Encode(self.wire)
+		tracer=self.this.tracer
+		if tracer is not None:
+			tracer.Record(0, self.addr, pkt.cmd, len(data)) #pkttrace.TX
+		stats=self.this.metrics
+		if stats is not None:
+			stats.Tx(self.addr, pkt.cmd, len(data))
+		if len(data)>self.this.PATH_MTU and self.features&FEATURE.FRAGMENT:
+			self.this.SendFragments(self, data)
+		else:
+			self.this.SendTo(data, self.addr)
 		self.lastsent=time.time()
+	@classmethod
+	def CompileDispatch(cls):
+		#Builds the table Recv dispatches on, indexed by command byte: entries
+		#are None or (function, allowed-state bitmask, required attrs), from the
+		#cmd_* methods and their STATE.ONLY/EXCLUDE and Packet.REQUIRE marks.
+		table=[None]*256
+		for cmd, name in CMD.LOOKUP.items():
+			if not isinstance(cmd, int):
+				continue
+			f=getattr(cls, 'cmd_'+name, None)
+			if f is None:
+				continue
+			f=getattr(f, '__func__', f)
+			mask=-1 #Every state
+			if hasattr(f, 'states'):
+				mask=0
+				for state in f.states:
+					mask|=1<<state
+			table[cmd]=(f, mask, tuple(getattr(f, 'attrs', ())))
+		cls.DISPATCH[cls]=table
+		return table
+	@classmethod
+	def RegisterCommand(cls, cmd, f):
+		#Installs f as the handler for cmd (see CMD.Register) on this class and
+		#its subclasses. Assigning cmd_* methods directly after packets have
+		#been received won't be noticed; use this.
+		setattr(cls, 'cmd_'+CMD.LOOKUP[cmd], f)
+		cls.DISPATCH.clear()
 	def Recv(self, pkt):
 		self.lastact=time.time()
 		pkt=Packet.Make(pkt)
-		logger.log(log.NETWORK, '%r -> %r', self, pkt)
-		handler=getattr(self, 'cmd_'+CMD.LOOKUP[pkt.cmd])
-		if hasattr(handler, 'states') and self.state not in handler.states:
-			logger.warning('%s packet not expected in %s state (accepts states %r); ignoring.', CMD.LOOKUP[pkt.cmd], STATE.LOOKUP[self.state], map(lambda x: STATE.LOOKUP[x], handler.states))
+		tracer=self.this.tracer
+		if tracer is not None:
+			tracer.Record(1, self.addr, pkt.cmd, None if pkt.raw is None else len(pkt.raw)) #pkttrace.RX
+		stats=self.this.metrics
+		if stats is not None:
+			stats.Rx(self.addr, pkt.cmd, 0 if pkt.raw is None else len(pkt.raw))
+		table=self.DISPATCH.get(type(self))
+		if table is None:
+			table=self.CompileDispatch()
+		entry=table[pkt.cmd]
+		if entry is None:
+			logger.warning('Unknown command %r from %r; ignoring.', pkt.cmd, self)
+			self.this.Dropped('unknown_cmd')
+			return
+		f, mask, attrs=entry
+		state=self.state
+		if not (mask>>state)&1:
+			self.this.Dropped('wrong_state')
+			logger.warning('%s packet not expected in %s state (accepts states %r); ignoring.', CMD.LOOKUP[pkt.cmd], STATE.LOOKUP[state], map(lambda x: STATE.LOOKUP[x], f.states))
 			return
-		if hasattr(handler, 'attrs'):
-			missing=handler.attrs-set(pkt.attrs.keys())
+		if attrs:
+			have=pkt.Fields()
+			missing=[attr for attr in attrs if attr not in have]
 			if missing:
-				logger.warning('%s packet missing attributes %r; ignoring.', CMD.LOOKUP[pkt.cmd], missing)
+				logger.warning('%s packet missing attributes %r; ignoring.', CMD.LOOKUP[pkt.cmd], set(missing))
+				self.this.Dropped('missing_attrs')
 				return
-		handler(pkt)
+		f(self, pkt)
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.SCHEMA(('response', 'B'), ('t', 'L'))
 	def cmd_KEEPALIVE(self, pkt):
+		#Requests may carry our clock (t), which comes back in the response.
 		if not pkt.Has('response'):
 			pkt.response=1
 			self.Send(pkt)
+		elif pkt.Has('t'):
+			rtt=((Millis()-pkt.t)&CLOCK_MASK)/1000.0
+			self.RTTSample(rtt)
+			if self.this.metrics is not None:
+				self.this.metrics.rtt.Observe(rtt)
+	def RTTSample(self, rtt):
+		#Folds a round trip time (in s) into srtt and rttvar, as TCP does
+		#(RFC 6298). Anything timing round trips to this peer may add to it.
+		if self.srtt is None:
+			self.srtt=rtt
+			self.rttvar=rtt/2
+		else:
+			self.rttvar=0.75*self.rttvar+0.25*abs(self.srtt-rtt)
+			self.srtt=0.875*self.srtt+0.125*rtt
 	@STATE.EXCLUDE(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.SCHEMA(('response', 'B'), ('local', 'B'), ('wire', 'B'), ('wireack', 'B'), ('you', serialize.ADDR), ('features', 'L'), ('featuresack', 'L'), ('schemas', 'L'), ('schemasack', 'L'))
 	def cmd_SYNC(self, pkt):
 		if pkt.Has('local'):
 			logger.info('%r synchronizing locally', self)
@@ -245,16 +517,50 @@ class Peer(object):
 				logger.error('(MAX_SELVES) Too many recognized self-addresses to add %r; possible attack?', pkt.you)
 			else:
 				self.this.addrs.add(tuple(pkt.you))
+		#Wire version negotiation: the request carries the sender's highest
+		#version in "wire", and the response the agreed one in "wireack". Old
+		#peers echo the request back verbatim, so "wire" alone in a response
+		#doesn't count. Features go the same way, in "features" and
+		#"featuresack". Each side's serialize.SchemaDigest goes along in
+		#"schemas" and "schemasack"; without a match, the version stops short
+		#of WIRE_SCHEMA.
 		if pkt.Has('response'):
+			if pkt.Has('wireack'):
+				self.wire=self.AgreeWire(pkt.wireack, pkt.Fields().get('schemasack'))
+			else:
+				self.wire=serialize.WIRE_V1
+			if pkt.Has('featuresack'):
+				self.features=pkt.featuresack&self.this.FEATURES
+			else:
+				self.features=0
 			#A good time to do a state update
 			self.UpdateState()
 		else:
+			if pkt.Has('wire'):
+				self.wire=self.AgreeWire(pkt.wire, pkt.Fields().get('schemas'))
+				pkt.wireack=self.wire
+				pkt.schemasack=serialize.SchemaDigest()
+			else:
+				self.wire=serialize.WIRE_V1
+			if pkt.Has('features'):
+				self.features=pkt.features&self.this.FEATURES
+				pkt.featuresack=self.features
+			else:
+				self.features=0
 			pkt.response=1
 			pkt.you=self.addr
 			self.Send(pkt)
+	def AgreeWire(self, wire, schemas):
+		#The wire version to use with a peer offering wire, whose SchemaDigest
+		#is schemas (None if it didn't say).
+		wire=min(wire, self.this.WIRE_VERSION)
+		if wire>=serialize.WIRE_SCHEMA and schemas!=serialize.SchemaDigest():
+			wire=serialize.WIRE_SCHEMA-1
+		return wire
 	def cmd_DESYNC(self, pkt):
 		self.state=STATE.NOT_CONNECTED
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.SCHEMA(('success', 'B'), ('remote', serialize.ADDR), ('behalf', serialize.ADDR), ('respond', serialize.ADDR), ('arbitrated', serialize.ADDR))
 	def cmd_ARBITRATE(self, pkt):
 		if pkt.Has('remote'):
 			peer=self.this.GetPeer(pkt.remote)
@@ -269,9 +575,15 @@ class Peer(object):
 			if peer and peer.state==STATE.BLOCKED:
 				logger.info('Dropping arbitration request on behalf of %r (peer is blocked)', peer)
 				return
-			peer=Peer(self.this, pkt.behalf, STATE.ARBITRATING)
-			logger.debug('Arbitration request received from %r via %r', peer, self)
-			self.this.peers[tuple(pkt.behalf)]=peer
+			if peer and peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+				#Already linked; the requester just knows us by another address
+				#(symmetric NATs do this). Replacing the peer would drop the link.
+				logger.debug('Arbitration request received from %r via %r; already connected', peer, self)
+			else:
+				peer=self.this.NewPeer(pkt.behalf, STATE.ARBITRATING)
+				logger.debug('Arbitration request received from %r via %r', peer, self)
+				self.this.peers[tuple(pkt.behalf)]=peer
+				self.this.PeerChanged(peer.addr, peer.state)
 			peer.Send(Packet(CMD.KEEPALIVE))
 			self.Send(Packet(CMD.ARBITRATE, respond=pkt.behalf))
 		elif pkt.Has('respond'):
@@ -286,79 +598,191 @@ class Peer(object):
 			if pkt.success:
 				if peer:
 					logger.debug('Arbitration to %r succeeded; syncing.', peer)
-					peer.Send(Packet(CMD.SYNC, you=peer.addr))
+					peer.Sync()
 				else:
 					logger.warning('Could not find arbitration remote peer.')
 			else:
 				logger.debug('Arbitration to %r failed.', pkt.arbitrated)
-				peer.state=STATE.INDIRECT
+				self.this.ArbitrationFailed(tuple(pkt.arbitrated), 'refused')
 		else:
 			logger.warning('Invalid arbitration state.')
+	def LearnPeer(self, addr, state):
+		#This peer reports addr in state; see if that tells us a way to reach it.
+		if addr not in self.this.addrs: #Get rid of silly warnings
+			peer=self.this.GetPeer(addr, True)
+			if peer and peer.state in (STATE.NOT_CONNECTED, STATE.INDIRECT_REMOTE):
+				#Once anyone reports a direct link, it's worth arbitrating; a
+				#later report that someone else can't reach it doesn't change that.
+				if state==STATE.DIRECT:
+					peer.state=STATE.INDIRECT
+				elif state in (STATE.INDIRECT, STATE.DIRECT_LOCAL) and peer.state==STATE.NOT_CONNECTED:
+					peer.state=STATE.INDIRECT_REMOTE
+	#PEERS and HANDLERS are versioned so that state updates only cost as much
+	#as what changed. A PEERS request with "since" and "epoch" (from the last
+	#reply's "gen" and "epoch") gets only the peers changed or "gone" since
+	#then, if the changelog reaches back that far, and a full list otherwise;
+	#replies carry "since" only if they are such a delta. Without since, a
+	#request may carry a "summary" of what the requester guesses our list is
+	#(see SendPeersRequest); if the difference can be made out, the reply is
+	#marked "reconciled" and lists it, like a delta from the guess. A
+	#HANDLERS request with "version" gets just "same" if the handler names
+	#still hash to it. Old peers ignore all this and reply in full.
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.SCHEMA(('peers', serialize.VAR), ('states', serialize.VAR), ('gone', serialize.VAR), ('since', 'L'), ('gen', 'L'), ('epoch', 'L'), ('summary', serialize.VAR), ('reconciled', 'B'))
 	def cmd_PEERS(self, pkt):
 		if pkt.Has('peers', 'states'):
-			self.peers=set((tuple(i) for i in pkt.peers))
-			self.psmap=dict(zip(self.peers, pkt.states))
-			for addr in self.peers:
-				if addr not in self.this.addrs: #Get rid of silly warnings
-					peer=self.this.GetPeer(addr, True)
-					if peer and peer.state in (STATE.NOT_CONNECTED, STATE.INDIRECT):
-						if self.psmap[addr]==STATE.DIRECT:
-							peer.state=STATE.INDIRECT
-						elif self.psmap[addr]in (STATE.INDIRECT, STATE.DIRECT_LOCAL):
-							peer.state=STATE.INDIRECT_REMOTE
+			addrs=[tuple(i) for i in pkt.peers]
+			gone=[tuple(i) for i in pkt.gone] if pkt.Has('gone') else []
+			guess=self.guess
+			self.guess=None
+			if pkt.Has('reconciled'):
+				if guess is None:
+					logger.debug('Unexpected reconciled PEERS from %r; asking for a full list.', self)
+					self.peersgen=None
+					self.Send(Packet(CMD.PEERS))
+					return
+				links=self.DirectLinks()
+				known=self.psmap
+				self.peers=set(guess)
+				self.psmap=guess
+				self.this.LinksChanged(self, links, self.DirectLinks())
+				self.this.KnownChanged(self, known, guess)
+				self.ApplyPeers(addrs, pkt.states, gone)
+				self.this.ReconcileSucceeded(self, len(addrs)+len(gone))
+			elif pkt.Has('since', 'gen', 'epoch'):
+				if self.peersgen!=(pkt.epoch, pkt.since):
+					logger.debug('Out-of-order PEERS delta from %r; asking for a full list.', self)
+					self.peersgen=None
+					self.Send(Packet(CMD.PEERS))
+					return
+				self.ApplyPeers(addrs, pkt.states, gone)
+			else:
+				if guess is not None:
+					self.this.ReconcileFailed(self)
+				links=self.DirectLinks()
+				known=self.psmap
+				self.peers=set(addrs)
+				self.psmap=dict(zip(addrs, pkt.states))
+				self.this.LinksChanged(self, links, self.DirectLinks())
+				self.this.KnownChanged(self, known, self.psmap)
+				for addr, state in self.psmap.iteritems():
+					self.LearnPeer(addr, state)
+			if pkt.Has('gen', 'epoch'):
+				self.peersgen=(pkt.epoch, pkt.gen)
 		else:
-			pkt.peers=self.this.peers.keys()
-			pkt.states=[i.state for i in self.this.peers.values()]
-			self.Send(pkt)
+			reply=Packet(CMD.PEERS, gen=self.this.generation, epoch=self.this.epoch)
+			changes=None
+			if pkt.Has('since', 'epoch'):
+				changes=self.this.PeersSince(pkt.epoch, pkt.since)
+				if changes is not None:
+					reply.since=pkt.since
+			elif pkt.Has('summary'):
+				result=reconcile.Reconcile(pkt.summary, dict((addr, peer.state) for addr, peer in self.this.peers.iteritems()))
+				if result is not None:
+					reply.reconciled=1
+					changes, gone=result
+					for addr in gone:
+						changes[addr]=None
+			if changes is None:
+				reply.peers=self.this.peers.keys()
+				reply.states=[i.state for i in self.this.peers.values()]
+			else:
+				reply.peers=[addr for addr, state in changes.iteritems() if state is not None]
+				reply.states=[changes[addr] for addr in reply.peers]
+				gone=[addr for addr, state in changes.iteritems() if state is None]
+				if gone:
+					reply.gone=gone
+			self.Send(reply)
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.SCHEMA(('handlers', serialize.VAR), ('version', 'L'), ('same', 'B'))
 	def cmd_HANDLERS(self, pkt):
-		if pkt.Has('handlers'):
+		if pkt.Has('same'):
+			pass #Still the handlers we have
+		elif pkt.Has('handlers'):
 			self.handlers=set(pkt.handlers)
+			self.handlersver=pkt.version if pkt.Has('version') else None
 		else:
-			pkt.handlers=self.this.handlers.keys()
-			self.Send(pkt)
+			version=self.this.HandlersVersion()
+			if pkt.Has('version') and pkt.version==version:
+				self.Send(Packet(CMD.HANDLERS, version=version, same=1))
+			else:
+				self.Send(Packet(CMD.HANDLERS, handlers=self.this.handlers.keys(), version=version))
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
 	@Packet.REQUIRE('handler')
+	@Packet.SCHEMA(('handler', serialize.VAR), ('data', serialize.VAR),
+			('sid', 'L'), ('seq', 'L'), ('ts', 'L'), ('fin', 'B'), ('ack', 'L'), ('wnd', 'L'), ('echo', 'L'), ('delay', 'L'), ('sack', serialize.VAR)) #The rest are stream's
 	def cmd_DATA(self, pkt):
 		handler=self.this.GetHandler(pkt.handler)
-		if handler:
+		stats=self.this.metrics
+		if not handler:
+			self.this.Dropped('no_handler')
+		elif stats is None:
+			handler.Recv(self, pkt)
+		else:
+			start=time.time()
 			handler.Recv(self, pkt)
+			stats.HandlerTime(pkt.handler, time.time()-start)
 	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
 	@Packet.REQUIRE('dest', 'data', 'ttl', 'src')
+	@Packet.SCHEMA(('ttl', 'h'), ('dest', serialize.ADDR), ('src', serialize.ADDR), ('data', serialize.VAR))
 	def cmd_ROUTE(self, pkt):
 		if pkt.ttl<0:
+			self.this.Dropped('ttl')
 			return
-		if tuple(pkt.dest) in self.this.addrs:
+		dest=tuple(pkt.dest)
+		if dest in self.this.addrs:
 			self.this.Recv(pkt.data, tuple(pkt.src))
 			return
-		peer=self.this.GetPeer(pkt.dest)
+		peer=self.this.GetPeer(dest)
 		if peer:
 			if peer.state==STATE.DIRECT:
 				peer.Send(pkt)
 				return
-		rpeer=None
-		for rp in self.this.peers.itervalues():
-			if peer.addr in rp.peers and rp.psmap[peer.addr]==STATE.DIRECT:
-				rpeer=rp
-				break
-		else:
-			rpeer=random.choice(self.this.peers.values())
+		rpeer=self.this.NextHop(dest, self)
+		if rpeer is None:
+			logger.debug('Dropping ROUTE to %r from %r; no route.', dest, self)
+			self.this.Dropped('no_route')
+			return
 		pkt.ttl-=1
 		if pkt.ttl<0:
+			self.this.Dropped('ttl')
 			return
 		rpeer.Send(pkt)
-
-class Timer(object):
-	def __init__(self, interval, callback, *args):
-		self.interval=interval
-		self.callback=callback
-		self.args=args
-		self.nextcall=time.time()+interval
-	def Run(self):
-		if time.time()>=self.nextcall:
-			self.callback(*self.args)
-			self.nextcall=time.time()+self.interval
+	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.REQUIRE('packets')
+	@Packet.SCHEMA(('packets', serialize.VAR))
+	def cmd_BUNDLE(self, pkt):
+		#Each inner packet is handled as if it came in on its own (including
+		#the state checks). Only synced peers send BUNDLEs (see Bundle).
+		packets=pkt.packets
+		if not isinstance(packets, (list, tuple)):
+			logger.warning('Dropping BUNDLE of a %s from %r.', type(packets).__name__, self)
+			self.this.Dropped('bad_bundle')
+			return
+		for data in packets:
+			if not isinstance(data, str) or not data:
+				logger.warning('Dropping a %s in a BUNDLE from %r.', type(data).__name__, self)
+				self.this.Dropped('bad_bundle')
+				continue
+			inner=Packet.FromStr(data)
+			if inner.cmd==CMD.BUNDLE:
+				logger.warning('Dropping BUNDLE nested in a BUNDLE from %r.', self)
+				self.this.Dropped('nested')
+				continue
+			self.Recv(inner)
+	@STATE.ONLY(STATE.DIRECT, STATE.DIRECT_LOCAL)
+	@Packet.REQUIRE('msgid', 'index', 'count', 'data')
+	@Packet.SCHEMA(('msgid', 'L'), ('index', 'H'), ('count', 'H'), ('data', serialize.VAR))
+	def cmd_FRAGMENT(self, pkt):
+		data=self.this.Reassemble(self, pkt.msgid, pkt.index, pkt.count, pkt.data)
+		if data is None:
+			return
+		inner=Packet.FromStr(data)
+		if inner.cmd==CMD.FRAGMENT:
+			logger.warning('Dropping FRAGMENT reassembled from FRAGMENTs from %r.', self)
+			self.this.Dropped('nested')
+			return
+		self.Recv(inner)
 
 class SECMODE:
 	REJECT=0 #Reject connections with low security.
@@ -367,14 +791,34 @@ class SECMODE:
 
 class DrizzlePeer(object):
 	BUF_SIZE=65536 #Maximum MTU to read from UDP socket recvfrom call
-	TIMEOUT=1 #Timeout (in s) on read socket; affects timer resolution
+	BATCH_SIZE=64 #Maximum datagrams to drain from the socket before running timers
+	TIMEOUT=1 #Timeout (in s) on read socket when not driven by a Reactor
 	PT_RESOLUTION=1 #Scheduling resolution (in s) on which to call peer timers
 	CONNECT_INTERVAL=10 #Interval during which arbitration is automatically attempted
-	MAX_ARBITRATIONS=25 #Maximum number of arbitrations to do at once
+	MAX_ARBITRATIONS=25 #Maximum number of arbitrations in flight at once
+	MAX_ARBITER_LOAD=8 #Maximum number of arbitrations in flight through any one peer
+	ARBITRATION_TIMEOUT=10 #Time (in s) an arbitration has to end in a direct connection
+	ARBITRATION_BACKOFF=5 #Delay (in s) before retrying a failed arbitration, doubled with each failure...
+	ARBITRATION_BACKOFF_MAX=300 #...up to this
 	MAX_CONNECTIONS=256 #Maximum number of direct connections to hold
 	MAX_PEERS=4096 #Maximum number of peers to know about
 	MAX_SELVES=8 #Maximum number of addresses to attribute to the local adapter
+	ROUTE_CACHE=True #Remember next hops chosen for ROUTE destinations no neighbour links to
+	CHANGELOG_SIZE=1024 #Peer table changes to remember for PEERS deltas; older requests get the full table
+	RECONCILE_DIFF=32 #Entries a peer's PEERS list is first expected to differ from our guess by (see ReconcileCells)
+	RECONCILE_CELLS_PER_DIFF=2 #Summary cells per expected difference...
+	RECONCILE_MIN_CELLS=12 #...but no fewer than this...
+	RECONCILE_MAX_CELLS=4096 #...nor more than this
+	PEERS_ENTRY_BYTES=7 #About what each peer adds to a full PEERS reply
 	SEC_LEVEL=32 #Reject security schemes with strengths less than this
+	WIRE_VERSION=serialize.WIRE_VERSION #Highest wire version to offer in SYNC
+	FEATURES=FEATURE.BUNDLE|FEATURE.FRAGMENT #FEATURE bits to offer in SYNC
+	PATH_MTU=1400 #Largest datagram (in bytes) to make when bundling packets (see Flush), or to send unfragmented
+	BUNDLE_OVERHEAD=32 #Upper bounds (in bytes) on what a BUNDLE adds to its packets,
+	BUNDLE_ITEM_OVERHEAD=6 #in total and per packet
+	MAX_FRAGMENTS=1024 #Most fragments a packet may be split into
+	REASSEMBLY_TIMEOUT=10 #Time (in s) the fragments of a packet have to all arrive
+	MAX_REASSEMBLY_BYTES=4194304 #Most fragment data (in bytes) to hold at once; the oldest packets are dropped past this
 	def __init__(self, sock=None):
 		if not sock:
 			sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -383,11 +827,34 @@ class DrizzlePeer(object):
 		self.sock.settimeout(self.TIMEOUT)
 		self.peers={} #Addr -> Peer (object) with .addr==addr
 		self.handlers={} #Name -> Handler (object)
-		self.timers=set()
+		self.wheel=wheel.TimingWheel(self.PT_RESOLUTION, time.time()) #Direct Peers by next timer deadline
+		self.observers=[] #Callables (peer, state) told of state changes, like Handler.StateChange but not advertised
+		self.reactor=None #Set by Attach
+		self.timers=reactor.TimerSet()
 		self.timers.add(Timer(self.PT_RESOLUTION, self.DoPeerTimers))
 		self.timers.add(Timer(self.CONNECT_INTERVAL, self.DoConnection))
 		self.secmode=SECMODE.ACCEPT_LIMITED
 		self.dorun=False
+		self.sendq=None #List of (data, addr) while in a tick; see SendTo
+		self.tracer=None #pkttrace.Tracer to record packets in, if any
+		self.metrics=metrics.Metrics() #None to stop counting
+		self.iostats={'rx_batches': 0, 'rx_packets': 0, 'tx_flushes': 0, 'tx_packets': 0, 'tx_bundles': 0}
+		self.batchsizes={} #Datagrams received in a batch -> number of such batches
+		self.direct=set() #Directly connected Peers (see DirectChanged)
+		self.reach={} #Addr -> set of direct Peers directly connected to it (see LinksChanged)
+		self.aware={} #Addr -> set of direct Peers that list it in PEERS (see KnownChanged)
+		self.routes={} #Addr -> Peer, next hops cached by NextHop...
+		self.routesvia={} #...and Peer -> set of the addrs it is cached for
+		self.epoch=random.getrandbits(32) #Tells this peer table from the ones before a restart
+		self.generation=0 #Bumped with every change to peers
+		self.changelog=collections.deque(maxlen=self.CHANGELOG_SIZE) #(generation, addr, state or None if forgotten)
+		self.arbitrations={} #Target addr -> (deadline, arbiter Peer), for arbitrations in flight
+		self.arbiterload={} #Arbiter Peer -> number of arbitrations in flight through it
+		self.backoff={} #Target addr -> (failures, time before which not to retry)
+		self.rearbitrate=False #An arbitration ended, so there's room to start another
+		self.fragid=int(random.getrandbits(31)) #Message ID of the last packet fragmented
+		self.reassembly=collections.OrderedDict() #(Addr, msgid) -> [deadline, fragments (None if missing), number missing, bytes], oldest first
+		self.reassemblybytes=0
 	def GetPeer(self, addr, create=False):
 		addr=tuple(addr)
 		if addr in self.addrs:
@@ -399,15 +866,135 @@ class DrizzlePeer(object):
 				if len(self.peers)>self.MAX_PEERS:
 					logger.error('(MAX_PEERS) Too many peers; not creating peer at %r', addr)
 					return None
-			return self.peers.setdefault(addr, Peer(self, addr))
+			peer=self.peers.get(addr)
+			if peer is None:
+				peer=self.peers[addr]=self.NewPeer(addr)
+				self.PeerChanged(addr, peer.state)
+			return peer
 		return self.peers.get(addr, None)
+	def NewPeer(self, addr, state=STATE.NOT_CONNECTED):
+		#Makes (but doesn't register) the Peer object for addr.
+		return Peer(self, addr, state)
+	def LocalPeers(self):
+		#The peers whose connections this DrizzlePeer manages itself (see
+		#shard for when that isn't all of them).
+		return self.peers.itervalues()
+	def ForgetPeer(self, addr):
+		#Removes the peer at addr altogether (it will be back if it sends us
+		#anything).
+		peer=self.peers[addr]
+		if peer in self.direct:
+			self.DirectChanged(peer, False)
+		del self.peers[addr]
+		if self.metrics is not None:
+			self.metrics.Forget(addr)
+		self.PeerChanged(addr, None)
+	def PeerChanged(self, addr, state):
+		#Logs a change to peers for PEERS deltas (see Peer.cmd_PEERS).
+		self.generation+=1
+		self.changelog.append((self.generation, addr, state))
+		if addr in self.arbitrations and state!=STATE.ARBITRATING:
+			if self.metrics is not None:
+				self.metrics.Arbitration('succeeded' if state in (STATE.DIRECT, STATE.DIRECT_LOCAL) else 'ended')
+			self.EndArbitration(addr)
+		if state is None or state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			self.backoff.pop(addr, None)
+	def PeersSince(self, epoch, since):
+		#Returns {addr: state, or None if forgotten} for the peers changed
+		#after generation since, or None if the changelog doesn't go back that
+		#far (or since is from another epoch).
+		if epoch!=self.epoch or since>self.generation:
+			return None
+		log=self.changelog
+		if since<self.generation and (not log or log[0][0]>since+1):
+			return None
+		changes={}
+		for gen, addr, state in reversed(log):
+			if gen<=since:
+				break
+			if addr not in changes:
+				changes[addr]=state
+		return changes
+	def GuessPeers(self, peer):
+		#What peer's PEERS list probably is, for a summary: what it told us
+		#last, or failing that our own list--but with the peers we know of
+		#through others as DIRECT, as most peers in a dense mesh are.
+		if peer.psmap:
+			return dict(peer.psmap)
+		guess={}
+		for addr, other in self.peers.iteritems():
+			if other is not peer:
+				state=other.state
+				guess[addr]=STATE.DIRECT if state in (STATE.INDIRECT, STATE.ARBITRATING) else state
+		return guess
+	def ReconcileCells(self, peer, guess):
+		#How many cells to summarize guess (at peer's PEERS list) in, sized by
+		#the difference expected with that peer; None if the summary would
+		#cost as much as the full list it saves.
+		diff=peer.reconcdiff
+		if diff is None:
+			diff=self.RECONCILE_DIFF
+		cells=min(max(diff*self.RECONCILE_CELLS_PER_DIFF, self.RECONCILE_MIN_CELLS), self.RECONCILE_MAX_CELLS)
+		if cells*reconcile.CELL_BYTES>=len(guess)*self.PEERS_ENTRY_BYTES:
+			return None
+		return cells
+	def ReconcileSucceeded(self, peer, found):
+		#Decays the expected difference towards the found one.
+		diff=peer.reconcdiff
+		if diff is None:
+			diff=self.RECONCILE_DIFF
+		peer.reconcdiff=max(found, diff//2, 1)
+	def ReconcileFailed(self, peer):
+		#The difference was too big for the summary; expect twice as much.
+		diff=peer.reconcdiff
+		if diff is None:
+			diff=self.RECONCILE_DIFF
+		peer.reconcdiff=min(diff*2, self.RECONCILE_MAX_CELLS//self.RECONCILE_CELLS_PER_DIFF)
+	def HandlersVersion(self):
+		return HandlersVersion(self.handlers.keys())
+	def Dropped(self, reason):
+		if self.metrics is not None:
+			self.metrics.Drop(reason)
+	def Stats(self, peers=False):
+		#A snapshot of what this node is doing (see metrics), as plain data;
+		#with the counters for each peer if peers.
+		states={}
+		direct=0
+		for peer in self.peers.itervalues():
+			name=STATE.LOOKUP[peer.state]
+			states[name]=states.get(name, 0)+1
+			if peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+				direct+=1
+		stats={'time': time.time(),
+				'addrs': ['%s:%d'%addr for addr in self.addrs],
+				'io': dict(self.iostats),
+				'peers': len(self.peers),
+				'max_peers': self.MAX_PEERS,
+				'states': states,
+				'direct': direct,
+				'max_connections': self.MAX_CONNECTIONS,
+				'arbitrations': len(self.arbitrations),
+				'max_arbitrations': self.MAX_ARBITRATIONS,
+				'backoffs': len(self.backoff),
+				'reassembly': {'messages': len(self.reassembly), 'bytes': self.reassemblybytes}}
+		if self.metrics is not None:
+			stats.update(self.metrics.Snapshot(CMD.LOOKUP))
+		if peers:
+			bypeer={}
+			for addr, peer in self.peers.iteritems():
+				entry={'state': STATE.LOOKUP[peer.state], 'wire': peer.wire, 'features': peer.features, 'srtt': peer.srtt}
+				if self.metrics is not None:
+					entry.update(self.metrics.PeerSnapshot(addr))
+				bypeer['%s:%d'%addr]=entry
+			stats['by_peer']=bypeer
+		return stats
 	def GetHandler(self, handler):
 		return self.handlers.get(handler, None)
 	def SyncTo(self, addr):
 		logger.info('SyncTo %r', addr)
 		peer=self.GetPeer(addr, True)
 		if peer:
-			peer.Send(Packet(CMD.SYNC, you=addr))
+			peer.Sync()
 		else:
 			logger.error('Failed to sync to %r; could not create peer!', addr)
 	def DesyncAll(self):
@@ -415,16 +1002,190 @@ class DrizzlePeer(object):
 		for peer in self.peers.itervalues():
 			if peer.state==STATE.DIRECT:
 				peer.Send(Packet(CMD.DESYNC))
+	def Attach(self, rct):
+		#Hands the socket and timers to the Reactor rct; several DrizzlePeers
+		#may share one. Run attaches to a private Reactor if this wasn't done.
+		self.reactor=rct
+		rct.AddReader(self.sock, self.OnReadable)
+		rct.AddHooks(self.BeginTick, self.Flush)
+		self.timers.Attach(rct)
 	def Run(self):
+		if self.reactor is None:
+			self.Attach(reactor.Reactor())
 		self.dorun=True
-		while self.dorun:
+		self.reactor.Run(lambda: self.dorun)
+	def OnReadable(self, sock):
+		batch=self.Drain(self.BATCH_SIZE)
+		for data, src in batch:
+			self.Recv(data, src)
+		if batch:
+			self.iostats['rx_batches']+=1
+			self.iostats['rx_packets']+=len(batch)
+			self.batchsizes[len(batch)]=self.batchsizes.get(len(batch), 0)+1
+	def Drain(self, count):
+		#Returns up to count datagrams already waiting on the socket, without
+		#blocking. Each is the str recvfrom made, which Packet.FromStr decodes
+		#in place; BYTES fields in it are still copied out. Views of a buffer
+		#reused with recvfrom_into would be overwritten under the handlers
+		#that keep payloads (streams, reassembly) by the next datagram.
+		batch=[]
+		if count<=0:
+			return batch
+		timeout=self.sock.gettimeout()
+		self.sock.settimeout(0.0)
+		try:
+			while len(batch)<count:
+				batch.append(self.sock.recvfrom(self.BUF_SIZE))
+		except socket.error:
+			pass #Nothing left (EAGAIN)
+		finally:
+			self.sock.settimeout(timeout)
+		return batch
+	def BeginTick(self):
+		if self.sendq is None:
+			self.sendq=[]
+	def SendTo(self, data, addr):
+		#Inside a tick (a Reactor dispatch), datagrams are queued and sent
+		#together by Flush.
+		if self.sendq is not None:
+			self.sendq.append((data, addr))
+		else:
+			self.sock.sendto(data, addr)
+	def Flush(self):
+		sendq=self.sendq
+		self.sendq=None
+		if not sendq:
+			return
+		self.iostats['tx_flushes']+=1
+		if len(sendq)>1:
+			sendq=self.Bundle(sendq)
+		self.iostats['tx_packets']+=len(sendq)
+		sendto=self.sock.sendto
+		for data, addr in sendq:
 			try:
-				self.Recv(*self.sock.recvfrom(self.BUF_SIZE))
-			except socket.timeout:
-				pass
-			logger.log(log.VERBOSE, 'Timer tick')
-			for t in self.timers:
-				t.Run()
+				sendto(data, addr)
+			except socket.error as e:
+				logger.warning('Failed to send %d bytes to %r: %s', len(data), addr, e)
+				self.Dropped('send_error')
+	def SendFragments(self, peer, data):
+		#Splits data (an encoded packet) over as many FRAGMENTs to peer as it
+		#takes for each to fit in PATH_MTU.
+		header=len(Packet(CMD.FRAGMENT, msgid=0x7fffffff, index=0xffff, count=0xffff, data='').Encode(peer.wire))
+		size=self.PATH_MTU-header-8 #Room for the data's length to grow
+		count=-(-len(data)//size)
+		if count>self.MAX_FRAGMENTS:
+			logger.warning('Packet of %d bytes to %r is too big to fragment; sending it whole.', len(data), peer)
+			self.SendTo(data, peer.addr)
+			return
+		self.fragid=msgid=(self.fragid+1)&0x7fffffff
+		for index in xrange(count):
+			frag=Packet(CMD.FRAGMENT, msgid=msgid, index=index, count=count, data=data[index*size:(index+1)*size]).Encode(peer.wire)
+			if self.metrics is not None:
+				self.metrics.Tx(peer.addr, CMD.FRAGMENT, len(frag))
+			self.SendTo(frag, peer.addr)
+	def Reassemble(self, peer, msgid, index, count, data):
+		#Files a fragment from peer, returning the whole packet once the last
+		#one is in (else None). The fragments are only copied once, by the
+		#join; the packet decodes lazily straight out of the result. All of
+		#these come from the peer, which on wires without schemas can send
+		#any type at all.
+		if not (isinstance(msgid, (int, long)) and isinstance(index, (int, long)) and isinstance(count, (int, long)) and isinstance(data, str)):
+			logger.warning('Dropping FRAGMENT with mistyped fields from %r.', peer)
+			self.Dropped('bad_fragment')
+			return None
+		if not 0<=index<count<=self.MAX_FRAGMENTS:
+			logger.warning('Dropping FRAGMENT %d of %d from %r.', index, count, peer)
+			self.Dropped('bad_fragment')
+			return None
+		if count==1:
+			return data
+		key=(peer.addr, msgid)
+		buf=self.reassembly.get(key)
+		if buf is None:
+			buf=self.reassembly[key]=[time.time()+self.REASSEMBLY_TIMEOUT, [None]*count, count, 0]
+		elif len(buf[1])!=count:
+			logger.warning('FRAGMENT counts for message %d from %r disagree; dropping it.', msgid, peer)
+			self.Dropped('bad_fragment')
+			self.DropReassembly(key)
+			return None
+		frags=buf[1]
+		if frags[index] is not None:
+			return None #Duplicate
+		frags[index]=data
+		buf[2]-=1
+		buf[3]+=len(data)
+		self.reassemblybytes+=len(data)
+		if not buf[2]:
+			self.DropReassembly(key)
+			return ''.join(frags)
+		while self.reassemblybytes>self.MAX_REASSEMBLY_BYTES:
+			oldest=next(iter(self.reassembly))
+			logger.warning('(MAX_REASSEMBLY_BYTES) Dropping partial message %d from %r.', oldest[1], oldest[0])
+			self.Dropped('reassembly_full')
+			self.DropReassembly(oldest)
+		return None
+	def DropReassembly(self, key):
+		self.reassemblybytes-=self.reassembly.pop(key)[3]
+	def ExpireReassembly(self, now):
+		#Deadlines are all REASSEMBLY_TIMEOUT from creation, so the expired
+		#ones are at the front.
+		reassembly=self.reassembly
+		while reassembly:
+			key=next(iter(reassembly))
+			if reassembly[key][0]>=now:
+				break
+			logger.info('Partial message %d from %r timed out.', key[1], key[0])
+			self.Dropped('reassembly_timeout')
+			self.DropReassembly(key)
+	def Bundle(self, sendq):
+		#Coalesces the datagrams queued for each peer that accepts BUNDLE into
+		#as few datagrams of up to PATH_MTU bytes as will hold them. Each
+		#peer's datagrams stay in order. SYNCs go alone: the peer may not
+		#count as synced (and so take BUNDLEs) until it has read one.
+		byaddr={}
+		for data, addr in sendq:
+			queued=byaddr.get(addr)
+			if queued is None:
+				byaddr[addr]=[data]
+			else:
+				queued.append(data)
+		if len(byaddr)==len(sendq):
+			return sendq #Nothing to coalesce
+		out=[]
+		for addr, queued in byaddr.iteritems():
+			peer=self.peers.get(addr)
+			if len(queued)<2 or peer is None or not peer.features&FEATURE.BUNDLE:
+				out.extend((data, addr) for data in queued)
+				continue
+			budget=self.PATH_MTU-self.BUNDLE_OVERHEAD
+			chunk=[]
+			size=0
+			for data in queued:
+				if data[:1]==SYNC_BYTE:
+					if chunk:
+						out.append(self.BundleOf(peer, chunk))
+						chunk=[]
+						size=0
+					out.append((data, addr))
+					continue
+				cost=len(data)+self.BUNDLE_ITEM_OVERHEAD
+				if chunk and size+cost>budget:
+					out.append(self.BundleOf(peer, chunk))
+					chunk=[]
+					size=0
+				chunk.append(data)
+				size+=cost
+			if chunk:
+				out.append(self.BundleOf(peer, chunk))
+		return out
+	def BundleOf(self, peer, chunk):
+		if len(chunk)==1:
+			return chunk[0], peer.addr
+		self.iostats['tx_bundles']+=1
+		data=Packet(CMD.BUNDLE, packets=chunk).Encode(peer.wire)
+		if self.metrics is not None:
+			self.metrics.Tx(peer.addr, CMD.BUNDLE, len(data))
+		return data, peer.addr
 	def Recv(self, data, src):
 		pkt=Packet.Make(data)
 		peer=self.GetPeer(src, True)
@@ -433,35 +1194,166 @@ class DrizzlePeer(object):
 				peer.Recv(pkt)
 			else:
 				logger.info('Dropping packet from %r (peer is blocked)', peer)
+				self.Dropped('blocked')
 		else:
 			logger.warning('Dropped packet from %r; could not create peer.', src)
+			self.Dropped('no_peer')
+	def LinksChanged(self, peer, old, new):
+		#Keeps reach up to date as peer's direct links (see Peer.DirectLinks)
+		#go from old to new.
+		reach=self.reach
+		for addr in old:
+			if addr not in new:
+				relays=reach.get(addr)
+				if relays is not None:
+					relays.discard(peer)
+					if not relays:
+						del reach[addr]
+		for addr in new:
+			if addr not in old:
+				relays=reach.get(addr)
+				if relays is None:
+					relays=reach[addr]=set()
+				relays.add(peer)
+	def KnownChanged(self, peer, old, new):
+		#Keeps aware up to date as the addrs peer lists in PEERS (its psmap)
+		#go from old to new. Cached routes through peer to addrs it no longer
+		#lists are dropped, as are routes that went through an unaware peer
+		#to an addr peer now lists.
+		aware=self.aware
+		routes=self.routes
+		for addr in old:
+			if addr not in new:
+				knowers=aware.get(addr)
+				if knowers is not None:
+					knowers.discard(peer)
+					if not knowers:
+						del aware[addr]
+				if routes.get(addr) is peer:
+					self.ForgetRoute(addr)
+		for addr in new:
+			if addr not in old:
+				knowers=aware.get(addr)
+				if knowers is None:
+					knowers=aware[addr]=set()
+				elif addr in routes and routes[addr] not in knowers:
+					self.ForgetRoute(addr)
+				knowers.add(peer)
+	def DirectChanged(self, peer, direct):
+		#Files peer's links and the addrs it knows of in the indexes (reach,
+		#aware) as it becomes directly connected, or takes them out (with any
+		#routes through it) as it stops being.
+		links=peer.DirectLinks(True)
+		if direct:
+			self.direct.add(peer)
+			self.LinksChanged(peer, (), links)
+			self.KnownChanged(peer, (), peer.psmap)
+		else:
+			self.direct.discard(peer)
+			self.LinksChanged(peer, links, ())
+			self.KnownChanged(peer, peer.psmap, ())
+			for addr in list(self.routesvia.get(peer, ())):
+				self.ForgetRoute(addr)
+	def ForgetRoute(self, dest):
+		peer=self.routes.pop(dest)
+		dests=self.routesvia[peer]
+		dests.discard(dest)
+		if not dests:
+			del self.routesvia[peer]
+	def NextHop(self, dest, exclude=None):
+		#A direct peer to forward traffic for dest through, other than
+		#exclude: one directly connected to dest if we know of one, else one
+		#that has at least heard of it, else any. None if there's nobody.
+		#Among several, the choice is by rendezvous hash of dest and their
+		#addrs, so it spreads destinations out but doesn't change at random.
+		for peer in self.reach.get(dest, ()):
+			if peer is not exclude:
+				return peer
+		peer=self.routes.get(dest)
+		if peer is not None and peer is not exclude:
+			return peer
+		candidates=[peer for peer in self.aware.get(dest, ()) if peer is not exclude] or [peer for peer in self.direct if peer is not exclude]
+		if not candidates:
+			return None
+		peer=max(candidates, key=lambda peer: hash((dest, peer.addr)))
+		if self.ROUTE_CACHE:
+			if dest in self.routes:
+				self.ForgetRoute(dest)
+			self.routes[dest]=peer
+			self.routesvia.setdefault(peer, set()).add(dest)
+		return peer
 	def DoPeerTimers(self):
-		for peer in self.peers.itervalues():
-			peer.DoKATimer()
-			peer.DoStateTimer()
+		now=time.time()
+		for peer in self.wheel.Advance(now):
+			peer.DoTimers()
+		self.DoNodeTimers(now)
+	def DoNodeTimers(self, now):
+		#The timers that aren't any one peer's.
+		if self.reassembly:
+			self.ExpireReassembly(now)
+		if self.arbitrations:
+			for addr in [addr for addr, (deadline, arbiter) in self.arbitrations.iteritems() if deadline<now]:
+				logger.debug('Arbitration to %r timed out.', addr)
+				self.ArbitrationFailed(addr, 'timedout')
+		if self.rearbitrate:
+			self.Arbitrate()
 	def DoConnection(self):
 		logger.debug('Running DoConnection...')
 		for addr in self.addrs:
 			if addr in self.peers:
-				del self.peers[addr]
-		cpeer=None
-		for peer in self.peers.itervalues():
-			if peer.state==STATE.DIRECT:
-				cpeer=peer
-				break
-		else:
+				self.ForgetPeer(addr)
+		self.Arbitrate()
+	def Arbitrate(self):
+		#Starts arbitrations to INDIRECT peers, as many as the window allows.
+		#Each goes through the least busy arbiter among those that report a
+		#direct link to the target, or failing that, any direct peer.
+		self.rearbitrate=False
+		if len(self.arbitrations)>=self.MAX_ARBITRATIONS:
+			return
+		direct=[peer for peer in self.peers.itervalues() if peer.state==STATE.DIRECT]
+		if not direct:
 			logger.warning('In DoConnection: no directly connected peers; this situation will never rectify itself without intervention.')
 			return #Nothing to do--no direct connections.
-		i=0
-		for peer in self.peers.itervalues():
-			if peer.state==STATE.INDIRECT:
-				logger.debug('DoConnection: Arbitrating %r through %r', peer, cpeer)
-				cpeer.Send(Packet(CMD.ARBITRATE, remote=peer.addr))
-				peer.state=STATE.ARBITRATING
-				i+=1
-				if i>self.MAX_ARBITRATIONS:
-					logger.warning('DoConnection: (MAX_ARBITRATIONS) Hit arbitrations limit, done for now.')
-					return #Finish for now.
+		load=self.arbiterload
+		now=time.time()
+		for peer in self.LocalPeers():
+			if peer.state!=STATE.INDIRECT or peer.addr in self.arbitrations:
+				continue
+			backoff=self.backoff.get(peer.addr)
+			if backoff is not None and backoff[1]>now:
+				continue
+			arbiters=[arbiter for arbiter in self.reach.get(peer.addr, ()) if arbiter.state==STATE.DIRECT] or direct
+			arbiter=min(arbiters, key=lambda arbiter: load.get(arbiter, 0))
+			if load.get(arbiter, 0)>=self.MAX_ARBITER_LOAD:
+				continue
+			logger.debug('DoConnection: Arbitrating %r through %r', peer, arbiter)
+			self.arbitrations[peer.addr]=(now+self.ARBITRATION_TIMEOUT, arbiter)
+			if self.metrics is not None:
+				self.metrics.Arbitration('started')
+			load[arbiter]=load.get(arbiter, 0)+1
+			arbiter.Send(Packet(CMD.ARBITRATE, remote=peer.addr))
+			peer.state=STATE.ARBITRATING
+			if len(self.arbitrations)>=self.MAX_ARBITRATIONS:
+				logger.debug('DoConnection: (MAX_ARBITRATIONS) Arbitration window full, done for now.')
+				return #Finish for now.
+	def EndArbitration(self, addr):
+		deadline, arbiter=self.arbitrations.pop(addr)
+		count=self.arbiterload.pop(arbiter)-1
+		if count:
+			self.arbiterload[arbiter]=count
+		self.rearbitrate=True
+	def ArbitrationFailed(self, addr, outcome='refused'):
+		#Backs off from addr and puts it back up for arbitration.
+		if addr in self.arbitrations:
+			if self.metrics is not None:
+				self.metrics.Arbitration(outcome)
+			self.EndArbitration(addr)
+		failures=self.backoff.get(addr, (0, 0))[0]+1
+		delay=min(self.ARBITRATION_BACKOFF*2**(failures-1), self.ARBITRATION_BACKOFF_MAX)
+		self.backoff[addr]=(failures, time.time()+delay*random.uniform(0.5, 1.0))
+		peer=self.peers.get(addr)
+		if peer is not None and peer.state==STATE.ARBITRATING:
+			peer.state=STATE.INDIRECT
 
 if __name__=='__main__':
 	import sys
@@ -0,0 +1,210 @@
+'''
+drizzle -- Drizzle
+peertable -- Columnar peer storage
+
+For nodes that know about many thousands of peers: the per-peer numbers the
+timers look at (state, lastact, lastsent, lastup) live in a few flat columns
+(NumPy arrays if NumPy is installed, array.arrays otherwise) instead of in
+each Peer, peers not yet heard from share their empty handler and peer
+sets, and the keep-alive and state-update sweep is a handful of comparisons
+over whole columns.
+
+ColumnarDrizzlePeer is a drop-in DrizzlePeer using it. Its peers are still
+a dict (addr -> Peer) of ColumnarPeers, thin views onto a row of the table,
+so everything written against Peer (handlers, qtnt's DPeerModel) works
+unchanged.
+
+What it buys is memory: bench's peers benchmark puts a columnar peer at
+under half of a plain one, and Recv runs about as fast. The sweep, though,
+looks at every row each time, where a plain DrizzlePeer's timing wheel only
+looks at the peers that are due; without NumPy, that's far slower.
+'''
+
+import time
+import array
+
+try:
+	import numpy
+except ImportError:
+	numpy=None
+
+from netlayer import DrizzlePeer, Peer, STATE
+
+FREE=-1 #State of an unused row
+
+class _FrozenMap(dict):
+	#The psmap of a peer that hasn't sent PEERS; shared, so assign a new map
+	#rather than changing this one.
+	def _Immutable(self, *args, **kwargs):
+		raise TypeError('Shared empty psmap; assign a new map instead')
+	__setitem__=__delitem__=update=setdefault=pop=popitem=clear=_Immutable
+
+def _Column(name, conv):
+	#conv makes NumPy's scalars into plain ones; array.array's already are.
+	def get(self):
+		row=self.row
+		if row is None:
+			return self.detached[name]
+		return conv(self.table.cols[name][row])
+	def getplain(self):
+		row=self.row
+		if row is None:
+			return self.detached[name]
+		return self.table.cols[name][row]
+	if numpy is None:
+		get=getplain
+	def set(self, val):
+		row=self.row
+		if row is None:
+			self.detached[name]=val
+		else:
+			self.table.cols[name][row]=val
+	return property(get, set)
+
+class ColumnarPeer(Peer):
+	#A view onto one row of a PeerTable. A peer taken out of the table (by
+	#del, pop or replacement) keeps working off a copy of its row.
+	__slots__=('table', 'row', 'detached')
+	EMPTY_SET=frozenset()
+	EMPTY_MAP=_FrozenMap()
+	def __init__(self, this, addr, state=STATE.NOT_CONNECTED):
+		self.table=this.peers
+		self.row=self.table.Alloc(self)
+		self.detached=None
+		Peer.__init__(self, this, addr, state)
+		#Until they're heard from, peers share empty ones (which get replaced,
+		#not changed).
+		self.handlers=self.peers=self.EMPTY_SET
+		self.psmap=self.EMPTY_MAP
+	_state=_Column('state', int)
+	lastact=_Column('lastact', float)
+	lastsent=_Column('lastsent', float)
+	lastup=_Column('lastup', float)
+	def Reschedule(self):
+		pass #Found by PeerTable.Due instead of the wheel
+	def Detach(self):
+		if self.row is None:
+			return
+		self.detached=dict((name, getattr(self, attr)) for name, attr in (('state', '_state'), ('lastact', 'lastact'), ('lastsent', 'lastsent'), ('lastup', 'lastup')))
+		self.table.Release(self.row)
+		self.row=None
+
+class PeerTable(dict):
+	#Addr -> ColumnarPeer, owning the columns the peers are views onto.
+	COLUMNS=(('state', 'b', 'int8'),
+			('lastact', 'd', 'float64'),
+			('lastsent', 'd', 'float64'),
+			('lastup', 'd', 'float64'))
+	def __init__(self, capacity=64):
+		dict.__init__(self)
+		self.capacity=0
+		self.cols={}
+		for name, code, dtype in self.COLUMNS:
+			if numpy is not None:
+				self.cols[name]=numpy.zeros(0, dtype)
+			else:
+				self.cols[name]=array.array(code)
+		self.views=[] #Row -> ColumnarPeer, or None if free
+		self.free=[] #Free rows
+		self.Grow(capacity)
+	def Grow(self, count):
+		for name, code, dtype in self.COLUMNS:
+			fill=FREE if name=='state' else 0
+			if numpy is not None:
+				self.cols[name]=numpy.concatenate((self.cols[name], numpy.empty(count, dtype)))
+				self.cols[name][self.capacity:]=fill
+			else:
+				self.cols[name].extend([fill]*count)
+		self.views.extend([None]*count)
+		self.free.extend(range(self.capacity+count-1, self.capacity-1, -1))
+		self.capacity+=count
+	def Alloc(self, view):
+		if not self.free:
+			self.Grow(max(self.capacity, 1))
+		row=self.free.pop()
+		self.views[row]=view
+		return row
+	def Release(self, row):
+		self.views[row]=None
+		self.cols['state'][row]=FREE
+		self.free.append(row)
+	def __setitem__(self, addr, peer):
+		old=dict.get(self, addr)
+		if old is not None and old is not peer:
+			old.Detach()
+		dict.__setitem__(self, addr, peer)
+	def __delitem__(self, addr):
+		dict.pop(self, addr).Detach()
+	def pop(self, addr, *default):
+		if addr in self:
+			peer=dict.pop(self, addr)
+			peer.Detach()
+			return peer
+		return dict.pop(self, addr, *default)
+	def popitem(self):
+		addr, peer=dict.popitem(self)
+		peer.Detach()
+		return addr, peer
+	def clear(self):
+		for peer in self.itervalues():
+			peer.Detach()
+		dict.clear(self)
+	def setdefault(self, addr, peer=None):
+		if addr not in self:
+			self[addr]=peer
+		return dict.__getitem__(self, addr)
+	def update(self, *args, **kwargs):
+		for addr, peer in dict(*args, **kwargs).iteritems():
+			self[addr]=peer
+	def Due(self, now, dropafter, kainterval, updateafter):
+		#Returns lists of the directly connected peers that have timed out,
+		#that are due a keep-alive, and that are due a state update (the
+		#last two leave out the first).
+		cols=self.cols
+		views=self.views
+		if numpy is not None:
+			state=cols['state']
+			direct=(state==STATE.DIRECT)|(state==STATE.DIRECT_LOCAL)
+			drop=direct&(cols['lastact']<now-dropafter)
+			live=direct&~drop
+			ka=live&(cols['lastsent']<now-kainterval)
+			update=live&(cols['lastup']<now-updateafter)
+			return ([views[row] for row in numpy.flatnonzero(drop)],
+					[views[row] for row in numpy.flatnonzero(ka)],
+					[views[row] for row in numpy.flatnonzero(update)])
+		dropbefore=now-dropafter
+		kabefore=now-kainterval
+		updatebefore=now-updateafter
+		drop=[]
+		ka=[]
+		update=[]
+		for row, (state, lastact, lastsent, lastup) in enumerate(zip(cols['state'], cols['lastact'], cols['lastsent'], cols['lastup'])):
+			if state!=STATE.DIRECT and state!=STATE.DIRECT_LOCAL:
+				continue
+			if lastact<dropbefore:
+				drop.append(views[row])
+				continue
+			if lastsent<kabefore:
+				ka.append(views[row])
+			if lastup<updatebefore:
+				update.append(views[row])
+		return drop, ka, update
+
+class ColumnarDrizzlePeer(DrizzlePeer):
+	def __init__(self, sock=None):
+		DrizzlePeer.__init__(self, sock)
+		self.peers=PeerTable()
+	def NewPeer(self, addr, state=STATE.NOT_CONNECTED):
+		return ColumnarPeer(self, addr, state)
+	def DoPeerTimers(self):
+		#The Do*Timer methods check again, as earlier disconnects can change
+		#other peers' states.
+		now=time.time()
+		drop, ka, update=self.peers.Due(now, ColumnarPeer.KA_DROP, ColumnarPeer.KA_INTERVAL, ColumnarPeer.STATE_UPDATE)
+		for peer in drop:
+			peer.DoKATimer()
+		for peer in ka:
+			peer.DoKATimer()
+		for peer in update:
+			peer.DoStateTimer()
+		self.DoNodeTimers(now)
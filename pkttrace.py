@@ -0,0 +1,68 @@
+'''
+drizzle -- Drizzle
+pkttrace -- Packet tracing
+
+A fixed-size ring of the latest packets a DrizzlePeer sent and received,
+as (timestamp, peer addr, CMD, size, direction) records, for when logging
+every packet would cost too much. Set a Tracer as a DrizzlePeer's tracer
+to start tracing (and back to None to stop; until then, the netlayer only
+pays for checking), then Dump it whenever it's needed, or have it dumped
+whenever something logs an error.
+
+Sizes are of the encoded packet, or None for received packets that were
+never encoded (like those handed to DrizzlePeer.Recv as Packets).
+'''
+
+import sys
+import time
+
+import log
+from netlayer import CMD
+
+TX=0 #Sent
+RX=1 #Received
+
+class Tracer(object):
+	def __init__(self, size=4096):
+		self.size=size
+		self.ring=[None]*size
+		self.count=0 #Records ever made; the next goes in ring[count%size]
+	def Record(self, direction, addr, cmd, size):
+		self.ring[self.count%self.size]=(time.time(), addr, cmd, size, direction)
+		self.count+=1
+	def Records(self):
+		#Oldest first.
+		if self.count<=self.size:
+			return self.ring[:self.count]
+		split=self.count%self.size
+		return self.ring[split:]+self.ring[:split]
+	def Clear(self):
+		self.ring=[None]*self.size
+		self.count=0
+	@staticmethod
+	def Format(record):
+		t, addr, cmd, size, direction=record
+		return '%.6f %s %s:%d %s %s'%(t, '<-' if direction==TX else '->', addr[0], addr[1], CMD.LOOKUP.get(cmd, cmd), '-' if size is None else size)
+	def Dump(self, out=None):
+		if out is None:
+			out=sys.stderr
+		records=self.Records()
+		out.write('Packet trace: last %d of %d packets\n'%(len(records), self.count))
+		for record in records:
+			out.write(self.Format(record)+'\n')
+		out.flush()
+	def DumpOnError(self, out=None, level=log.ERROR):
+		#Dumps the trace whenever anything logs at level or above; returns the
+		#logging handler that does it.
+		handler=DumpHandler(self, out)
+		handler.setLevel(level)
+		log.getLogger().addHandler(handler)
+		return handler
+
+class DumpHandler(log.Handler):
+	def __init__(self, tracer, out=None):
+		log.Handler.__init__(self)
+		self.tracer=tracer
+		self.out=out
+	def emit(self, record):
+		self.tracer.Dump(self.out)
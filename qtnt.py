@@ -64,7 +64,7 @@ class DPeerView(QWidget):
 			peer.state=STATE.NOT_CONNECTED
 	def mpcForget(self):
 		for peer in self.mpeerctx.selection:
-			del self.dpeer.peers[peer.addr]
+			self.dpeer.ForgetPeer(peer.addr)
 	def mpcBlock(self):
 		for peer in self.mpeerctx.selection:
 			peer.state=STATE.BLOCKED
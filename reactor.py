@@ -0,0 +1,214 @@
+'''
+drizzle -- Drizzle
+reactor -- Event loop
+
+A small reactor: it waits on any number of sockets or file descriptors
+(using selectors, epoll or select, whichever is available) and sleeps
+exactly until the next timer is due. Timers are kept in a min-heap, so
+only the due ones are ever looked at.
+
+Several DrizzlePeers (and any other listeners) can share one Reactor; see
+DrizzlePeer.Attach.
+'''
+
+import time
+import heapq
+import itertools
+import select
+
+try:
+	import selectors
+except ImportError:
+	selectors=None
+
+import log
+
+logger=log.getLogger(__name__)
+
+class Timer(object):
+	def __init__(self, interval, callback, *args):
+		self.interval=interval
+		self.callback=callback
+		self.args=args
+		self.nextcall=time.time()+interval
+		self.entry=None #Live heap entry, when scheduled on a Reactor
+	def Run(self):
+		if time.time()>=self.nextcall:
+			self.Fire()
+	def Fire(self):
+		try:
+			self.callback(*self.args)
+		finally:
+			self.nextcall=time.time()+self.interval
+
+class Alarm(Timer):
+	#A Timer that only fires once.
+	def Fire(self):
+		try:
+			self.callback(*self.args)
+		finally:
+			self.nextcall=None
+
+class TimerSet(set):
+	#A set of Timers that keeps a Reactor's schedule in step with it, so
+	#timers added to a running DrizzlePeer start running right away.
+	def __init__(self, *args):
+		super(TimerSet, self).__init__(*args)
+		self.reactor=None
+	def Attach(self, reactor):
+		self.reactor=reactor
+		for timer in self:
+			reactor.AddTimer(timer)
+	def add(self, timer):
+		super(TimerSet, self).add(timer)
+		if self.reactor is not None:
+			self.reactor.AddTimer(timer)
+	def discard(self, timer):
+		super(TimerSet, self).discard(timer)
+		if self.reactor is not None:
+			self.reactor.RemoveTimer(timer)
+	def remove(self, timer):
+		super(TimerSet, self).remove(timer)
+		if self.reactor is not None:
+			self.reactor.RemoveTimer(timer)
+
+def _Fileno(fileobj):
+	if hasattr(fileobj, 'fileno'):
+		return fileobj.fileno()
+	return fileobj
+
+class Poller(object):
+	#Readiness for reading only, which is all the netlayer needs. Picks the
+	#best mechanism the platform has.
+	def __init__(self):
+		if selectors is not None:
+			self.sel=selectors.DefaultSelector()
+			self.Register=self._SelRegister
+			self.Unregister=self._SelUnregister
+			self.Poll=self._SelPoll
+		elif hasattr(select, 'epoll'):
+			self.ep=select.epoll()
+			self.Register=self._EpRegister
+			self.Unregister=self._EpUnregister
+			self.Poll=self._EpPoll
+		else:
+			self.fds=set()
+			self.Register=self.fds.add
+			self.Unregister=self.fds.discard
+			self.Poll=self._SelectPoll
+	def _SelRegister(self, fd):
+		self.sel.register(fd, selectors.EVENT_READ)
+	def _SelUnregister(self, fd):
+		self.sel.unregister(fd)
+	def _SelPoll(self, timeout):
+		return [key.fd for key, events in self.sel.select(timeout)]
+	def _EpRegister(self, fd):
+		self.ep.register(fd, select.EPOLLIN)
+	def _EpUnregister(self, fd):
+		self.ep.unregister(fd)
+	def _EpPoll(self, timeout):
+		while True:
+			try:
+				return [fd for fd, events in self.ep.poll(-1 if timeout is None else timeout)]
+			except IOError as e:
+				if e.errno!=4: #EINTR
+					raise
+	def _SelectPoll(self, timeout):
+		if not self.fds:
+			if timeout:
+				time.sleep(timeout)
+			return []
+		while True:
+			try:
+				return select.select(list(self.fds), [], [], timeout)[0]
+			except select.error as e:
+				if e.args[0]!=4: #EINTR
+					raise
+
+class Reactor(object):
+	def __init__(self):
+		self.poller=Poller()
+		self.readers={} #fd -> (fileobj, callback)
+		self.heap=[] #[deadline, seq, Timer]; stale if not Timer.entry
+		self.seq=itertools.count()
+		self.hooks=[] #(begin, end) callables run around each dispatch
+		self.running=False
+	def AddReader(self, fileobj, callback):
+		#callback(fileobj) is called whenever fileobj is readable.
+		fd=_Fileno(fileobj)
+		if fd in self.readers:
+			self.poller.Unregister(fd)
+		self.readers[fd]=(fileobj, callback)
+		self.poller.Register(fd)
+	def RemoveReader(self, fileobj):
+		fd=_Fileno(fileobj)
+		if self.readers.pop(fd, None) is not None:
+			self.poller.Unregister(fd)
+	def AddTimer(self, timer):
+		entry=[timer.nextcall, next(self.seq), timer]
+		timer.entry=entry
+		heapq.heappush(self.heap, entry)
+	def RemoveTimer(self, timer):
+		timer.entry=None
+	def CallLater(self, delay, callback, *args):
+		alarm=Alarm(delay, callback, *args)
+		self.AddTimer(alarm)
+		return alarm
+	def AddHooks(self, begin, end):
+		#begin() and end() bracket each batch of callbacks (e.g. to queue
+		#and then flush outbound datagrams).
+		self.hooks.append((begin, end))
+	def NextDeadline(self):
+		heap=self.heap
+		while heap and heap[0][2].entry is not heap[0]:
+			heapq.heappop(heap)
+		if heap:
+			return heap[0][0]
+		return None
+	def RunOnce(self, maxwait=None):
+		deadline=self.NextDeadline()
+		timeout=maxwait
+		if deadline is not None:
+			timeout=max(0.0, deadline-time.time())
+			if maxwait is not None:
+				timeout=min(timeout, maxwait)
+		ready=self.poller.Poll(timeout)
+		for begin, end in self.hooks:
+			begin()
+		try:
+			for fd in ready:
+				reader=self.readers.get(fd)
+				if reader is not None:
+					fileobj, callback=reader
+					callback(fileobj)
+			self.RunTimers()
+		finally:
+			for begin, end in self.hooks:
+				end()
+	def RunTimers(self):
+		heap=self.heap
+		now=time.time()
+		fired=[]
+		while heap and heap[0][0]<=now:
+			entry=heapq.heappop(heap)
+			timer=entry[2]
+			if timer.entry is not entry:
+				continue
+			timer.entry=None
+			fired.append(timer)
+			try:
+				timer.Fire()
+			except Exception:
+				#One failing timer mustn't stop the others, or the loop.
+				logger.exception('Timer %r failed', timer.callback)
+		#Rescheduled only now, so a short interval can't starve the loop.
+		for timer in fired:
+			if timer.nextcall is not None and timer.entry is None:
+				self.AddTimer(timer)
+	def Run(self, cond=None):
+		#Runs until Stop, or until cond() is false (checked every iteration).
+		self.running=True
+		while self.running and (cond is None or cond()):
+			self.RunOnce()
+	def Stop(self):
+		self.running=False
@@ -0,0 +1,160 @@
+'''
+drizzle -- Drizzle
+reconcile -- Set reconciliation
+
+Invertible Bloom lookup tables (IBLTs) over peer tables, so that two peers
+that mostly know the same peers can find out where they differ by sending
+a summary sized by the expected difference rather than by the tables.
+
+An IBLT is a fixed number of cells, each holding a count and the XORs of
+the keys (and key hashes) added to it; every key goes into K cells. The
+difference of two tables' IBLTs holds only the keys in one but not the
+other, and as long as there aren't too many of those it can be "peeled"
+back into the keys themselves.
+
+Table entries are (addr, state) pairs packed into 64-bit keys, so a peer
+whose state differs shows up as removed in one state and added in the
+other. Only IPv4 addresses (as given by inet_ntoa) can be packed.
+'''
+
+import struct
+import socket
+
+S_KEY=struct.Struct('!q')
+S_ENTRY=struct.Struct('!4sHBx')
+S_CELLS=struct.Struct('!H')
+CELL_BYTES=struct.calcsize('!iqI') #What each cell adds to a packed IBLT
+
+def PackEntry(addr, state):
+	host, port=addr
+	try:
+		packed=socket.inet_aton(host)
+	except (socket.error, TypeError):
+		raise ValueError('Cannot pack address %r'%(addr,))
+	if socket.inet_ntoa(packed)!=host:
+		raise ValueError('Cannot pack address %r'%(addr,))
+	try:
+		return S_KEY.unpack(S_ENTRY.pack(packed, port, state))[0]
+	except struct.error:
+		raise ValueError('Cannot pack entry %r in state %r'%(addr, state))
+
+def UnpackEntry(key):
+	packed, port, state=S_ENTRY.unpack(S_KEY.pack(key))
+	return (socket.inet_ntoa(packed), port), state
+
+M64=(1<<64)-1
+
+def _Hash(key, seed):
+	#splitmix64's finalizer, seeded. (Not a CRC: those are linear, so the
+	#XOR of three keys' checks would be the check of their XOR, and cells
+	#holding three keys would look pure.)
+	x=(key+seed*0x9e3779b97f4a7c15)&M64
+	x=((x^(x>>30))*0xbf58476d1ce4e5b9)&M64
+	x=((x^(x>>27))*0x94d049bb133111eb)&M64
+	return (x^(x>>31))&0xffffffff
+
+class IBLT(object):
+	K=3 #Cells per key, one in each of K equal parts of the table
+	CHECK_SEED=0x5bd1e995
+	def __init__(self, cells):
+		self.part=max(1, -(-cells//self.K))
+		self.cells=self.part*self.K
+		self.counts=[0]*self.cells
+		self.keys=[0]*self.cells
+		self.hashes=[0]*self.cells
+	def Cells(self, key):
+		part=self.part
+		return [i*part+_Hash(key, i+1)%part for i in range(self.K)]
+	def Insert(self, key, count=1):
+		check=_Hash(key, self.CHECK_SEED)
+		counts, keys, hashes=self.counts, self.keys, self.hashes
+		for cell in self.Cells(key):
+			counts[cell]+=count
+			keys[cell]^=key
+			hashes[cell]^=check
+	def Subtract(self, other):
+		if other.cells!=self.cells:
+			raise ValueError('IBLTs have %d and %d cells'%(self.cells, other.cells))
+		diff=IBLT(self.cells)
+		diff.counts=[a-b for a, b in zip(self.counts, other.counts)]
+		diff.keys=[a^b for a, b in zip(self.keys, other.keys)]
+		diff.hashes=[a^b for a, b in zip(self.hashes, other.hashes)]
+		return diff
+	def Decode(self):
+		#Peels a difference apart into (keys only in self, keys only in the
+		#subtracted one), or returns None if it can't be done.
+		counts, keys, hashes=list(self.counts), list(self.keys), list(self.hashes)
+		plus=[]
+		minus=[]
+		progress=True
+		while progress:
+			progress=False
+			for cell in range(self.cells):
+				count=counts[cell]
+				if count not in (1, -1):
+					continue
+				key=keys[cell]
+				check=_Hash(key, self.CHECK_SEED)
+				if check!=hashes[cell]:
+					continue
+				(plus if count==1 else minus).append(key)
+				for other in self.Cells(key):
+					counts[other]-=count
+					keys[other]^=key
+					hashes[other]^=check
+				progress=True
+		if any(counts) or any(keys) or any(hashes):
+			return None
+		return plus, minus
+	def Pack(self):
+		cells=self.cells
+		return S_CELLS.pack(cells)+struct.pack('!%di%dq%dI'%(cells, cells, cells), *(self.counts+self.keys+self.hashes))
+	@classmethod
+	def Unpack(cls, s):
+		cells=S_CELLS.unpack_from(s)[0]
+		if not cells or cells%cls.K:
+			raise ValueError('Bad IBLT size %d'%(cells,))
+		vals=struct.unpack_from('!%di%dq%dI'%(cells, cells, cells), s, S_CELLS.size)
+		iblt=cls(cells)
+		iblt.counts=list(vals[:cells])
+		iblt.keys=list(vals[cells:2*cells])
+		iblt.hashes=list(vals[2*cells:])
+		return iblt
+
+def Summarize(psmap, cells):
+	#The packed IBLT of psmap (addr -> state), or None if some address can't
+	#be packed.
+	iblt=IBLT(cells)
+	try:
+		for addr, state in psmap.iteritems():
+			iblt.Insert(PackEntry(addr, state))
+	except ValueError:
+		return None
+	return iblt.Pack()
+
+def Reconcile(summary, psmap):
+	#Given the packed IBLT of some other table, returns (changed, gone): the
+	#entries of psmap that table lacks or has in another state, and the
+	#addrs it has that psmap doesn't. Returns None if the difference can't
+	#be worked out (too big for the summary, unpackable addresses, or a
+	#summary that isn't one, which could be any type off the wire).
+	try:
+		other=IBLT.Unpack(summary)
+	except (struct.error, ValueError, TypeError):
+		return None
+	ours=IBLT(other.cells)
+	try:
+		for addr, state in psmap.iteritems():
+			ours.Insert(PackEntry(addr, state))
+	except ValueError:
+		return None
+	result=ours.Subtract(other).Decode()
+	if result is None:
+		return None
+	changed=dict(UnpackEntry(key) for key in result[0])
+	gone=[]
+	for key in result[1]:
+		addr, state=UnpackEntry(key)
+		if addr not in changed:
+			gone.append(addr)
+	return changed, gone
@@ -9,6 +9,14 @@ To create custom serializers, the easiest way is to define a class, inheriting
 from BaseSerializer, with two classmethods:
 -Serialize(cls, obj, fout): Write the serialized form of obj to stream fout.
 -Deserialize(cls, fin): Return an unserialized object by reading from fin.
+Optionally, a serializer can also provide:
+-Unpack(cls, buf, off): Return a tuple (obj, newoff), decoding obj directly
+ from the buffer buf (a str, bytearray, memoryview or buffer) starting at
+ offset off. This is the fast path used by DeserializeFrom; serializers that
+ don't define it fall back to Deserialize over a temporary stream.
+ BYTES of at least BYTES_VIEW_MIN bytes decoded from a memoryview come back
+ as slices of it rather than copies, so the buffer under it must stay as it
+ is for as long as they're kept. From anything else, BYTES are copied out.
 This will automatically assign the next USER tag to that serializer, which is
 fine if you just want the same version of the application to have consistent
 protocols. If you require backward-compatibility, it is IMPORTANT that you
@@ -26,14 +34,37 @@ In this case, the "ser" object will be called as above, but without the
 implicit "cls" parameter (as they are not necessarily classmethods). Users
 can use this to override arbitrary serializers, but this is generally never
 a good idea.
+
+Wire versions: WIRE_V1 is the original fixed-width encoding, and is always
+what Serialize writes by default. Passing a higher version (up to
+WIRE_VERSION) lets Serialize substitute the compact serializers in COMPACT,
+which use distinct tags (TAG.COMPACT and up), so Deserialize reads any mix of
+versions without being told which one was used. Only write a version the
+receiving side has agreed to understand. Schema-compiled maps (WIRE_SCHEMA)
+are positional, so both sides must also have the same Schemas, in the same
+order; compare SchemaDigest before agreeing on it.
 '''
 
+import sys
 import struct
+import types
+import array
+import socket
+import binascii
 import cStringIO
 import exceptions
 
 SERIALIZERS={} #type -> BaseSerializer derivative (a type)
 TAGS={} #tag (int) -> BaseSerializer derivative
+DISPATCH={} #concrete type -> ideal serializer (cache for GetIdealSerializer)
+COMPACT={} #BaseSerializer derivative -> its compact (WIRE_COMPACT) replacement
+SCHEMAS=[] #Schema id -> Schema
+
+WIRE_V1=1 #Fixed-width integers and length prefixes
+WIRE_COMPACT=2 #Zig-zag varints, one-byte bools, binary longs
+WIRE_ARRAYS=3 #Packed homogeneous numeric and IPv4 address sequences
+WIRE_SCHEMA=4 #Schema-compiled maps (see Schema)
+WIRE_VERSION=WIRE_SCHEMA #Highest version this module can write
 
 CURTAG=0 #BaseSerializer always gets this. Consider it invalid.
 
@@ -43,6 +74,24 @@ TEXT_ERROR_MODE='replace' #Silently drop errors with "unknown" characters.
 #Set to 'strict' if you actually want these errors bugging you. (This will
 #likely come about during Deserialize calls, and wherever Deserialize is
 #implicitly done, such as packet parsing, etc.)
+ARRAY_MIN=8 #Sequences shorter than this aren't worth checking for packing.
+BYTES_VIEW_MIN=4096 #BYTES payloads at least this long are returned as
+#memoryview slices (instead of copies) when decoding from a memoryview.
+
+#Precompiled structures for the primitive encodings.
+S_INT=struct.Struct('!l')
+S_FLOAT=struct.Struct('!d')
+S_BYTE=struct.Struct('!B')
+
+BUFFER_TYPES=(str, bytearray, memoryview, buffer)
+
+def _Slice(buf, start, end):
+	#Copy buf[start:end] out as a str, whatever kind of buffer buf is.
+	if isinstance(buf, str):
+		return buf[start:end]
+	if isinstance(buf, memoryview):
+		return buf[start:end].tobytes()
+	return str(buf[start:end])
 
 #BaseSerializer's metaclass (SerializerMeta) automatically takes care of this
 #from the __types__ tuple provided in the class definition. However...if you
@@ -51,6 +100,7 @@ TEXT_ERROR_MODE='replace' #Silently drop errors with "unknown" characters.
 def SetSerializer(tp, ser):
 	SERIALIZERS[tp]=ser
 	TAGS[ser.__tag__]=ser
+	DISPATCH.clear()
 
 def UpdateSerializer(ser):
 	remove=[]
@@ -61,6 +111,7 @@ def UpdateSerializer(ser):
 		del SERIALIZERS[tp]
 	for tp in ser.__types__:
 		SERIALIZERS[tp]=ser
+	DISPATCH.clear()
 
 #This seems like it may be useful, but it's not particularly pragmatic
 #except for readability and (maybe) type monkey-patching.
@@ -81,6 +132,19 @@ class TAG:
 	ELLIPSIS=12
 	ERROR=13
 	USER=14
+	#Compact forms (WIRE_COMPACT) are kept at the top of the tag space so they
+	#never shift the USER tags; don't assign user tags at or above COMPACT.
+	COMPACT=0xF0
+	VARINT=0xF0
+	VLONG=0xF1
+	VBOOL=0xF2
+	VBYTES=0xF3
+	VTEXT=0xF4
+	VSEQ=0xF5
+	VMAP=0xF6
+	VARRAY=0xF7
+	VADDRS=0xF8
+	VSCHEMA=0xF9
 
 def RegisterTag(name):
 	if not hasattr(TAG, name):
@@ -98,6 +162,7 @@ class SerializerMeta(type):
 			tp.__tag__=CURTAG
 		CURTAG=min(TAG.USER, tp.__tag__+1)
 		TAGS[tp.__tag__]=tp
+		DISPATCH.clear()
 		return tp
 
 class BaseSerializer(object):
@@ -108,16 +173,25 @@ class BaseSerializer(object):
 	@classmethod
 	def Deserialize(cls, fin):
 		raise NotImplementedError(cls.__name__+' does not support deserialization.')
+	@classmethod
+	def Unpack(cls, buf, off):
+		#Generic fallback for serializers that only implement Deserialize.
+		fin=cStringIO.StringIO(_Slice(buf, off, len(buf)))
+		obj=cls.Deserialize(fin)
+		return obj, off+fin.tell()
 
 class IntSerializer(BaseSerializer):
 	__types__=(int,)
 	__tag__=TAG.INT
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!l', obj))
+		fout.write(S_INT.pack(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!l', fin.read(struct.calcsize('!l')))[0]
+		return S_INT.unpack(fin.read(S_INT.size))[0]
+	@classmethod
+	def Unpack(cls, buf, off):
+		return S_INT.unpack_from(buf, off)[0], off+S_INT.size
 	
 class LongSerializer(BaseSerializer):
 	__types__=(long,)
@@ -128,16 +202,23 @@ class LongSerializer(BaseSerializer):
 	@classmethod
 	def Deserialize(cls, fin):
 		return long(BytesSerializer.Deserialize(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		s, off=BytesSerializer.UnpackStr(buf, off)
+		return long(s), off
 
 class FloatSerializer(BaseSerializer):
 	__types__=(float,)
 	__tag__=TAG.FLOAT
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!d', obj))
+		fout.write(S_FLOAT.pack(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!d', fin.read(struct.calcsize('!d')))[0]
+		return S_FLOAT.unpack(fin.read(S_FLOAT.size))[0]
+	@classmethod
+	def Unpack(cls, buf, off):
+		return S_FLOAT.unpack_from(buf, off)[0], off+S_FLOAT.size
 
 class BytesSerializer(BaseSerializer):
 	__types__=(str,)
@@ -150,6 +231,17 @@ class BytesSerializer(BaseSerializer):
 	def Deserialize(cls, fin):
 		l=IntSerializer.Deserialize(fin)
 		return fin.read(l)
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=IntSerializer.Unpack(buf, off)
+		if l>=BYTES_VIEW_MIN and isinstance(buf, memoryview):
+			return buf[off:off+l], off+l
+		return _Slice(buf, off, off+l), off+l
+	@classmethod
+	def UnpackStr(cls, buf, off):
+		#As Unpack, but always returns a str (for decoding into other types).
+		l, off=IntSerializer.Unpack(buf, off)
+		return _Slice(buf, off, off+l), off+l
 
 class TextSerializer(BaseSerializer):
 	__types__=(unicode,)
@@ -162,6 +254,14 @@ class TextSerializer(BaseSerializer):
 	def Deserialize(cls, fin):
 		codec=BytesSerializer.Deserialize(fin)
 		data=BytesSerializer.Deserialize(fin)
+		return cls.Decode(data, codec)
+	@classmethod
+	def Unpack(cls, buf, off):
+		codec, off=BytesSerializer.UnpackStr(buf, off)
+		data, off=BytesSerializer.UnpackStr(buf, off)
+		return cls.Decode(data, codec), off
+	@staticmethod
+	def Decode(data, codec):
 		try:
 			return data.decode(codec, TEXT_ERROR_MODE)
 		except LookupError:
@@ -179,6 +279,10 @@ class BoolSerializer(BaseSerializer):
 	@classmethod
 	def Deserialize(cls, fin):
 		return bool(IntSerializer.Deserialize(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		i, off=IntSerializer.Unpack(buf, off)
+		return bool(i), off
 
 class SequenceSerializer(BaseSerializer):
 	__types__=(list, tuple, set)
@@ -209,6 +313,18 @@ class SequenceSerializer(BaseSerializer):
 		if tp is list:
 			return ret
 		return tp(ret)
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=IntSerializer.Unpack(buf, off)
+		sid, off=ByteSerializer.Unpack(buf, off)
+		tp=cls.SEQ_TYPE_MAP[sid]
+		ret=[]
+		for i in xrange(l):
+			item, off=DeserializeFrom(buf, off)
+			ret.append(item)
+		if tp is list:
+			return ret, off
+		return tp(ret), off
 
 class MapSerializer(BaseSerializer):
 	__types__=(dict,)
@@ -226,6 +342,14 @@ class MapSerializer(BaseSerializer):
 			key, val=SequenceSerializer.Deserialize(fin)
 			ret[key]=val
 		return ret
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=IntSerializer.Unpack(buf, off)
+		ret={}
+		for i in xrange(l):
+			(key, val), off=SequenceSerializer.Unpack(buf, off)
+			ret[key]=val
+		return ret, off
 
 class ByteSerializer(BaseSerializer):
 	#No types for a good reason--use Int instead from the API.
@@ -234,10 +358,13 @@ class ByteSerializer(BaseSerializer):
 	__tag__=TAG.BYTE
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!B', obj))
+		fout.write(S_BYTE.pack(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!B', fin.read(struct.calcsize('!B')))[0]
+		return S_BYTE.unpack(fin.read(S_BYTE.size))[0]
+	@classmethod
+	def Unpack(cls, buf, off):
+		return S_BYTE.unpack_from(buf, off)[0], off+S_BYTE.size
 
 class NoneSerializer(BaseSerializer):
 	__types__=(type(None),)
@@ -248,6 +375,9 @@ class NoneSerializer(BaseSerializer):
 	@classmethod
 	def Deserialize(cls, fin):
 		return None
+	@classmethod
+	def Unpack(cls, buf, off):
+		return None, off
 
 class SliceSerializer(BaseSerializer):
 	__types__=(slice,)
@@ -262,6 +392,12 @@ class SliceSerializer(BaseSerializer):
 		return slice(IntSerializer.Deserialize(fin),
 					IntSerializer.Deserialize(fin),
 					IntSerializer.Deserialize(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		start, off=IntSerializer.Unpack(buf, off)
+		stop, off=IntSerializer.Unpack(buf, off)
+		step, off=IntSerializer.Unpack(buf, off)
+		return slice(start, stop, step), off
 
 class EllipsisSerializer(BaseSerializer):
 	__types__=(type(Ellipsis),)
@@ -272,6 +408,9 @@ class EllipsisSerializer(BaseSerializer):
 	@classmethod
 	def Deserialize(cls, fin):
 		return Ellipsis
+	@classmethod
+	def Unpack(cls, buf, off):
+		return Ellipsis, off
 	
 class RemoteException(Exception):
 	pass
@@ -287,29 +426,568 @@ class ErrorSerializer(BaseSerializer):
 	def Deserialize(cls, fin):
 		ename=BytesSerializer.Deserialize(fin)
 		args=tuple(SequenceSerializer.Deserialize(fin))
+		return cls.Make(ename, args)
+	@classmethod
+	def Unpack(cls, buf, off):
+		ename, off=BytesSerializer.UnpackStr(buf, off)
+		args, off=SequenceSerializer.Unpack(buf, off)
+		return cls.Make(ename, tuple(args)), off
+	@staticmethod
+	def Make(ename, args):
 		ecls=getattr(exceptions, ename, None)
 		if ecls:
 			return ecls(*args)
 		else:
 			return RemoteException(ename, *args)
 
-def Serialize(obj, stream=None):
+#Unsigned LEB128 varints, and the zig-zag mapping that lets small negative
+#numbers stay short. Python integers are unbounded, and so are these.
+
+def ZigZag(n):
+	return (n<<1) if n>=0 else ((-n)<<1)-1
+
+def UnZigZag(z):
+	return (z>>1) if not z&1 else -((z+1)>>1)
+
+def WriteVarint(n, fout):
+	out=bytearray()
+	while n>=0x80:
+		out.append((n&0x7f)|0x80)
+		n>>=7
+	out.append(n)
+	fout.write(str(out))
+
+def ReadVarint(fin):
+	n=0
+	shift=0
+	while True:
+		b=ord(fin.read(1))
+		n|=(b&0x7f)<<shift
+		if not b&0x80:
+			return n
+		shift+=7
+
+def UnpackVarint(buf, off):
+	b=S_BYTE.unpack_from(buf, off)[0]
+	off+=1
+	if not b&0x80:
+		return b, off
+	n=b&0x7f
+	shift=7
+	while True:
+		b=S_BYTE.unpack_from(buf, off)[0]
+		off+=1
+		n|=(b&0x7f)<<shift
+		if not b&0x80:
+			return n, off
+		shift+=7
+
+#Compact serializers. These have no __types__; Serialize reaches them through
+#COMPACT when asked for a version >= WIRE_COMPACT, and passes that version on
+#so nested objects are written compactly too.
+
+class VarIntSerializer(BaseSerializer):
+	__tag__=TAG.VARINT
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		WriteVarint(ZigZag(obj), fout)
+	@classmethod
+	def Deserialize(cls, fin):
+		return UnZigZag(ReadVarint(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		z, off=UnpackVarint(buf, off)
+		return UnZigZag(z), off
+
+class VLongSerializer(BaseSerializer):
+	#Zig-zagged magnitude as length-prefixed big-endian bytes.
+	__tag__=TAG.VLONG
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		h='%x'%(ZigZag(obj),)
+		if len(h)%2:
+			h='0'+h
+		VBytesSerializer.Serialize(binascii.unhexlify(h), fout)
+	@classmethod
+	def Deserialize(cls, fin):
+		return cls.Decode(VBytesSerializer.Deserialize(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		data, off=VBytesSerializer.UnpackStr(buf, off)
+		return cls.Decode(data), off
+	@staticmethod
+	def Decode(data):
+		return long(UnZigZag(long(binascii.hexlify(data), 16)))
+
+class VBoolSerializer(BaseSerializer):
+	__tag__=TAG.VBOOL
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		ByteSerializer.Serialize((1 if obj else 0), fout)
+	@classmethod
+	def Deserialize(cls, fin):
+		return bool(ByteSerializer.Deserialize(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		b, off=ByteSerializer.Unpack(buf, off)
+		return bool(b), off
+
+class VBytesSerializer(BaseSerializer):
+	__tag__=TAG.VBYTES
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		WriteVarint(len(obj), fout)
+		fout.write(obj)
+	@classmethod
+	def Deserialize(cls, fin):
+		return fin.read(ReadVarint(fin))
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		if l>=BYTES_VIEW_MIN and isinstance(buf, memoryview):
+			return buf[off:off+l], off+l
+		return _Slice(buf, off, off+l), off+l
+	@classmethod
+	def UnpackStr(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		return _Slice(buf, off, off+l), off+l
+
+class VTextSerializer(BaseSerializer):
+	__tag__=TAG.VTEXT
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		VBytesSerializer.Serialize(PREFERRED_ENCODING, fout)
+		VBytesSerializer.Serialize(obj.encode(PREFERRED_ENCODING, TEXT_ERROR_MODE), fout)
+	@classmethod
+	def Deserialize(cls, fin):
+		codec=VBytesSerializer.Deserialize(fin)
+		data=VBytesSerializer.Deserialize(fin)
+		return TextSerializer.Decode(data, codec)
+	@classmethod
+	def Unpack(cls, buf, off):
+		codec, off=VBytesSerializer.UnpackStr(buf, off)
+		data, off=VBytesSerializer.UnpackStr(buf, off)
+		return TextSerializer.Decode(data, codec), off
+
+class VSequenceSerializer(BaseSerializer):
+	#Shares SequenceSerializer's type maps, so RegisterType covers both.
+	__tag__=TAG.VSEQ
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		WriteVarint(len(obj), fout)
+		ByteSerializer.Serialize(SequenceSerializer.SEQ_ID_MAP[type(obj)], fout)
+		for item in obj:
+			Serialize(item, fout, version)
+	@classmethod
+	def Deserialize(cls, fin):
+		l=ReadVarint(fin)
+		tp=SequenceSerializer.SEQ_TYPE_MAP[ByteSerializer.Deserialize(fin)]
+		ret=[]
+		for i in xrange(l):
+			ret.append(Deserialize(fin))
+		if tp is list:
+			return ret
+		return tp(ret)
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		sid, off=ByteSerializer.Unpack(buf, off)
+		tp=SequenceSerializer.SEQ_TYPE_MAP[sid]
+		ret=[]
+		for i in xrange(l):
+			item, off=DeserializeFrom(buf, off)
+			ret.append(item)
+		if tp is list:
+			return ret, off
+		return tp(ret), off
+
+class VMapSerializer(BaseSerializer):
+	#Keys and values follow each other directly, without MapSerializer's
+	#per-pair sequence header.
+	__tag__=TAG.VMAP
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_COMPACT):
+		WriteVarint(len(obj), fout)
+		for key, val in sorted(obj.items(), key=lambda item: item[0]):
+			Serialize(key, fout, version)
+			Serialize(val, fout, version)
+	@classmethod
+	def Deserialize(cls, fin):
+		l=ReadVarint(fin)
+		ret={}
+		for i in xrange(l):
+			key=Deserialize(fin)
+			ret[key]=Deserialize(fin)
+		return ret
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		ret={}
+		for i in xrange(l):
+			key, off=DeserializeFrom(buf, off)
+			ret[key], off=DeserializeFrom(buf, off)
+		return ret, off
+
+#Packed sequences (WIRE_ARRAYS). VSequenceSerializer hands a sequence to one
+#of these (via PackedSerializer) when every element has the same simple type;
+#they still decode to the original sequence type.
+
+#Wire element code -> (struct code, local array typecode), by element size.
+ARRAY_CODES={}
+for _code, _tcs in (('b', 'b'), ('h', 'h'), ('i', 'il'), ('q', 'lq'), ('d', 'd')):
+	_size=struct.calcsize('!'+_code)
+	for _tc in _tcs:
+		try:
+			if array.array(_tc).itemsize==_size:
+				ARRAY_CODES[_code]=_tc
+				break
+		except ValueError:
+			pass
+del _code, _tcs, _size, _tc
+ARRAY_SWAP=(sys.byteorder=='little') #Wire order is big-endian.
+
+class VArraySerializer(BaseSerializer):
+	__tag__=TAG.VARRAY
+	@classmethod
+	def Pick(cls, obj):
+		#Returns the wire element code for obj, or None if it can't be packed.
+		tps=set(map(type, obj))
+		if len(tps)!=1:
+			return None
+		tp=tps.pop()
+		if tp is float:
+			return 'd'
+		if tp is not int:
+			return None
+		lo=min(obj)
+		hi=max(obj)
+		for code, bits in (('b', 7), ('h', 15), ('i', 31), ('q', 63)):
+			if code in ARRAY_CODES and -(1<<bits)<=lo and hi<(1<<bits):
+				return code
+		return None
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_ARRAYS, code=None):
+		if code is None:
+			code=cls.Pick(obj)
+		arr=array.array(ARRAY_CODES[code], obj)
+		if ARRAY_SWAP:
+			arr.byteswap()
+		WriteVarint(len(arr), fout)
+		ByteSerializer.Serialize(SequenceSerializer.SEQ_ID_MAP[type(obj)], fout)
+		ByteSerializer.Serialize(ord(code), fout)
+		fout.write(arr.tostring())
+	@classmethod
+	def Deserialize(cls, fin):
+		l=ReadVarint(fin)
+		sid=ByteSerializer.Deserialize(fin)
+		code=chr(ByteSerializer.Deserialize(fin))
+		arr=array.array(ARRAY_CODES[code])
+		arr.fromstring(fin.read(l*arr.itemsize))
+		return cls.Finish(arr, sid)
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		sid, off=ByteSerializer.Unpack(buf, off)
+		code, off=ByteSerializer.Unpack(buf, off)
+		arr=array.array(ARRAY_CODES[chr(code)])
+		end=off+l*arr.itemsize
+		arr.fromstring(_Slice(buf, off, end))
+		return cls.Finish(arr, sid), end
+	@staticmethod
+	def Finish(arr, sid):
+		if ARRAY_SWAP:
+			arr.byteswap()
+		tp=SequenceSerializer.SEQ_TYPE_MAP[sid]
+		if tp is list:
+			return arr.tolist()
+		return tp(arr)
+
+class VAddrsSerializer(BaseSerializer):
+	#Sequences of (IPv4 dotted-quad str, port int) pairs, as all the packed
+	#addresses followed by all the ports: six bytes per entry.
+	__tag__=TAG.VADDRS
+	S_ADDR=struct.Struct('!4s')
+	@classmethod
+	def Pack(cls, obj):
+		#Returns (packed hosts, port array), or None if obj doesn't qualify.
+		hosts=[]
+		ports=array.array('H')
+		try:
+			for item in obj:
+				host, port=item
+				if type(item) is not tuple or type(host) is not str or type(port) is not int:
+					return None
+				packed=socket.inet_aton(host)
+				if socket.inet_ntoa(packed)!=host: #Not in canonical form
+					return None
+				hosts.append(packed)
+				ports.append(port)
+		except (ValueError, TypeError, socket.error, OverflowError):
+			return None
+		return ''.join(hosts), ports
+	@classmethod
+	def Serialize(cls, obj, fout, version=WIRE_ARRAYS, packed=None):
+		if packed is None:
+			packed=cls.Pack(obj)
+		hosts, ports=packed
+		if ARRAY_SWAP:
+			ports.byteswap()
+		WriteVarint(len(ports), fout)
+		ByteSerializer.Serialize(SequenceSerializer.SEQ_ID_MAP[type(obj)], fout)
+		fout.write(hosts)
+		fout.write(ports.tostring())
+	@classmethod
+	def Deserialize(cls, fin):
+		l=ReadVarint(fin)
+		sid=ByteSerializer.Deserialize(fin)
+		return cls.Finish(fin.read(4*l), fin.read(2*l), sid)
+	@classmethod
+	def Unpack(cls, buf, off):
+		l, off=UnpackVarint(buf, off)
+		sid, off=ByteSerializer.Unpack(buf, off)
+		mid=off+4*l
+		end=mid+2*l
+		return cls.Finish(_Slice(buf, off, mid), _Slice(buf, mid, end), sid), end
+	@staticmethod
+	def Finish(hosts, portstr, sid):
+		ports=array.array('H')
+		ports.fromstring(portstr)
+		if ARRAY_SWAP:
+			ports.byteswap()
+		ntoa=socket.inet_ntoa
+		ret=[(ntoa(hosts[4*i:4*i+4]), port) for i, port in enumerate(ports)]
+		tp=SequenceSerializer.SEQ_TYPE_MAP[sid]
+		if tp is list:
+			return ret
+		return tp(ret)
+
+def PackedSerializer(obj):
+	#Returns (serializer, keyword arguments for its Serialize) for the best
+	#packed form of the sequence obj, or None if it has none.
+	if len(obj)<ARRAY_MIN:
+		return None
+	code=VArraySerializer.Pick(obj)
+	if code is not None:
+		return VArraySerializer, {'code': code}
+	packed=VAddrsSerializer.Pack(obj)
+	if packed is not None:
+		return VAddrsSerializer, {'packed': packed}
+	return None
+
+#Schemas (WIRE_SCHEMA) describe maps with a known set of string keys, like
+#packet headers. A Schema is built from a sequence of (key, kind) fields:
+#-A struct code (one of INT_RANGES, or 'd'): packed with the other fixed
+# fields in one precompiled struct.
+#-ADDR: an IPv4 (host, port) tuple, also packed into that struct.
+#-VAR: anything else, written in field order with the compact serializers,
+# but without spelling out the key.
+#A bitmask of the present fields comes first; the struct for each mask is
+#compiled once, on first use, and only holds the fields that are present.
+#Values that don't fit their field, and keys the schema doesn't know, are
+#written last as an ordinary compact map, so any map round-trips.
+#Like tags, schema ids are assigned in definition order; peers only agree on
+#them if they define the same schemas in the same order.
+
+ADDR='ADDR'
+VAR='VAR'
+
+INT_RANGES={'B': (0, 0xff), 'H': (0, 0xffff), 'h': (-0x8000, 0x7fff),
+			'L': (0, 0xffffffff), 'l': (-0x80000000, 0x7fffffff)}
+
+def SchemaDigest():
+	#A hash of the fields of every Schema, by id; see WIRE_SCHEMA above.
+	return binascii.crc32(repr([schema.fields for schema in SCHEMAS]))&0xffffffff
+
+class Schema(object):
+	def __init__(self, fields):
+		self.fields=tuple(fields)
+		self.keys=frozenset(key for key, kind in self.fields)
+		self.fixed=[(key, kind) for key, kind in self.fields if kind is not VAR]
+		self.vars=[key for key, kind in self.fields if kind is VAR]
+		nbits=len(self.fields)+1 #Top bit flags the extras map
+		for mcode in 'BHLQ':
+			if nbits<=8*struct.calcsize('!'+mcode):
+				break
+		else:
+			raise ValueError('Too many fields in schema')
+		self.mstruct=struct.Struct('!'+mcode)
+		self.fixedmask=(1<<len(self.fixed))-1
+		self.extrabit=1<<len(self.fields)
+		self.layouts={} #Fixed-field mask -> (struct.Struct, [(key, kind)])
+		self.id=len(SCHEMAS)
+		SCHEMAS.append(self)
+	def __repr__(self):
+		return '<Schema %d %r>'%(self.id, self.fields)
+	def Layout(self, mask):
+		mask&=self.fixedmask
+		try:
+			return self.layouts[mask]
+		except KeyError:
+			pass
+		present=[field for i, field in enumerate(self.fixed) if mask&(1<<i)]
+		codes=[('4sH' if kind is ADDR else kind) for key, kind in present]
+		layout=(struct.Struct('!'+''.join(codes)), present)
+		self.layouts[mask]=layout
+		return layout
+	def Serialize(self, obj, stream=None, version=WIRE_SCHEMA):
+		if not stream:
+			stream=cStringIO.StringIO()
+		ByteSerializer.Serialize(TAG.VSCHEMA, stream)
+		ByteSerializer.Serialize(self.id, stream)
+		mask=0
+		bit=1
+		present=0
+		vals=[]
+		extras={}
+		for key, kind in self.fixed:
+			val=obj.get(key, self)
+			if val is not self:
+				present+=1
+				packed=self.Fit(val, kind)
+				if packed is None:
+					extras[key]=val
+				else:
+					mask|=bit
+					vals.extend(packed)
+			bit<<=1
+		varvals=[]
+		for key in self.vars:
+			val=obj.get(key, self)
+			if val is not self:
+				present+=1
+				mask|=bit
+				varvals.append(val)
+			bit<<=1
+		if present<len(obj):
+			for key, val in obj.iteritems():
+				if key not in self.keys:
+					extras[key]=val
+		if extras:
+			mask|=self.extrabit
+		stream.write(self.mstruct.pack(mask))
+		stream.write(self.Layout(mask)[0].pack(*vals))
+		for val in varvals:
+			Serialize(val, stream, version)
+		if extras:
+			Serialize(extras, stream, version)
+		return stream.getvalue() #As with Serialize
+	@staticmethod
+	def Fit(val, kind):
+		#Returns val as a tuple of struct values for kind, or None.
+		tp=type(val)
+		if kind is ADDR:
+			if tp is not tuple or len(val)!=2:
+				return None
+			host, port=val
+			if type(host) is not str or type(port) is not int or not 0<=port<=0xffff:
+				return None
+			try:
+				packed=socket.inet_aton(host)
+			except (socket.error, TypeError):
+				return None
+			if socket.inet_ntoa(packed)!=host:
+				return None
+			return (packed, port)
+		if kind=='d':
+			return (val,) if tp is float else None
+		lo, hi=INT_RANGES[kind]
+		if tp is not int or not lo<=val<=hi:
+			return None
+		return (val,)
+	@staticmethod
+	def Fixed(present, vals):
+		#Returns the fixed fields in the struct values vals, as a dict.
+		ret={}
+		i=0
+		for key, kind in present:
+			if kind is ADDR:
+				ret[key]=(socket.inet_ntoa(vals[i]), vals[i+1])
+				i+=2
+			else:
+				ret[key]=vals[i]
+				i+=1
+		return ret
+	def Deserialize(self, fin):
+		mask=self.mstruct.unpack(fin.read(self.mstruct.size))[0]
+		st, present=self.Layout(mask)
+		ret=self.Fixed(present, st.unpack(fin.read(st.size)))
+		bit=self.fixedmask+1
+		for key in self.vars:
+			if mask&bit:
+				ret[key]=Deserialize(fin)
+			bit<<=1
+		if mask&self.extrabit:
+			ret.update(Deserialize(fin))
+		return ret
+	def Unpack(self, buf, off):
+		mask=self.mstruct.unpack_from(buf, off)[0]
+		off+=self.mstruct.size
+		st, present=self.Layout(mask)
+		ret=self.Fixed(present, st.unpack_from(buf, off))
+		off+=st.size
+		bit=self.fixedmask+1
+		for key in self.vars:
+			if mask&bit:
+				ret[key], off=DeserializeFrom(buf, off)
+			bit<<=1
+		if mask&self.extrabit:
+			extras, off=DeserializeFrom(buf, off)
+			ret.update(extras)
+		return ret, off
+
+class VSchemaSerializer(BaseSerializer):
+	#Only decodes; encoding goes through the Schema itself.
+	__tag__=TAG.VSCHEMA
+	@classmethod
+	def Deserialize(cls, fin):
+		return SCHEMAS[ByteSerializer.Deserialize(fin)].Deserialize(fin)
+	@classmethod
+	def Unpack(cls, buf, off):
+		sid, off=ByteSerializer.Unpack(buf, off)
+		return SCHEMAS[sid].Unpack(buf, off)
+
+COMPACT.update({IntSerializer: VarIntSerializer,
+				LongSerializer: VLongSerializer,
+				BoolSerializer: VBoolSerializer,
+				BytesSerializer: VBytesSerializer,
+				TextSerializer: VTextSerializer,
+				SequenceSerializer: VSequenceSerializer,
+				MapSerializer: VMapSerializer})
+
+def Serialize(obj, stream=None, version=WIRE_V1):
 	if not stream:
 		stream=cStringIO.StringIO()
 	se=GetIdealSerializer(obj)
 	if se is None:
 		raise TypeError('Unserializeable type: '+repr(type(obj)))
-	ByteSerializer.Serialize(se.__tag__, stream)
-	se.Serialize(obj, stream)
+	if version>WIRE_V1 and se in COMPACT:
+		se=COMPACT[se]
+		kwargs={}
+		if se is VSequenceSerializer and version>=WIRE_ARRAYS:
+			packed=PackedSerializer(obj)
+			if packed is not None:
+				se, kwargs=packed
+		ByteSerializer.Serialize(se.__tag__, stream)
+		se.Serialize(obj, stream, version, **kwargs)
+	else:
+		ByteSerializer.Serialize(se.__tag__, stream)
+		se.Serialize(obj, stream)
 	return stream.getvalue() #Not accurate unless stream=None (or empty) on entry.
 
 def Deserialize(stream):
-	if isinstance(stream, str):
-		stream=cStringIO.StringIO(stream)
+	if isinstance(stream, BUFFER_TYPES):
+		return DeserializeFrom(stream)[0]
 	tag=ByteSerializer.Deserialize(stream)
 	se=TAGS[tag]
 	return se.Deserialize(stream)
 
+def DeserializeFrom(buf, off=0):
+	#Decodes one object directly out of buf (any BUFFER_TYPES) at offset off,
+	#without an intermediate stream. Returns (obj, offset past obj).
+	tag, off=ByteSerializer.Unpack(buf, off)
+	se=TAGS[tag]
+	return se.Unpack(buf, off)
+
 def GetIdealSerializer(obj):
 	#Returns a serializer with the "best" (most specific) serializer type for
 	#that object. It does so by comparing MROs--types with longer MROs are
@@ -317,11 +995,21 @@ def GetIdealSerializer(obj):
 	#XXX is this always the case in multiple inheritance situations? If not,
 	#a user can pull the desired serializer from SERIALIZERS manually, or by
 	#referring to it wherever it's defined...
+	#The result only depends on the concrete type, so it's cached in DISPATCH;
+	#anything that changes SERIALIZERS must clear that.
+	tp=type(obj)
+	try:
+		return DISPATCH[tp]
+	except KeyError:
+		pass
 	curser=None
 	curmrolen=0
-	for tp, ser in SERIALIZERS.iteritems():
-		if isinstance(obj, tp):
-			if len(tp.mro())>curmrolen:
+	for stp, ser in SERIALIZERS.iteritems():
+		if isinstance(obj, stp):
+			mrolen=len(stp.__mro__)
+			if mrolen>curmrolen:
 				curser=ser
-				curmrolen=len(tp.mro())
-	return curser
\ No newline at end of file
+				curmrolen=mrolen
+	if tp is not types.InstanceType: #Old-style instances all share one type
+		DISPATCH[tp]=curser
+	return curser
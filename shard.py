@@ -0,0 +1,236 @@
+'''
+drizzle -- Drizzle
+shard -- Multi-process sharded node
+
+Spreads one logical Drizzle node over several worker processes, all bound
+to the same UDP port with SO_REUSEPORT, so receive and dispatch scale across
+cores instead of sitting behind one GIL.
+
+Every remote address is owned by exactly one shard, chosen by Owner (a
+stable hash of the address). Only the owner keeps the real Peer: its state
+machine, timers and arbitration. The kernel spreads datagrams over the
+sockets as it sees fit, so a shard that receives a datagram for a peer it
+doesn't own forwards it to the owner over a local Unix datagram socket.
+
+The other shards keep a GhostPeer mirroring the owner's view of that peer.
+Owners broadcast every state change, so each shard can use any peer as a
+relay (ARBITRATE, ROUTE) and answer PEERS for the whole node. Sending needs
+no help: all shards share the port, so any of them can send on behalf of
+the node. State changes a shard makes to a ghost are passed on to the owner
+as hints, which the owner only takes up where its own rules (those of
+Peer.LearnPeer) would have made the same move; a ghost may be out of date.
+
+Ghosts don't mirror what their peers report in PEERS, though: each shard
+only learns who can reach whom (DrizzlePeer.reach and aware) from the peers
+it owns. A ROUTE to a peer that isn't direct is thus sent on by what the
+shard that got it knows, which may be a worse hop than the node as a whole
+could pick, or none at all.
+'''
+
+import os
+import sys
+import zlib
+import shutil
+import socket
+import tempfile
+import multiprocessing
+
+import serialize
+import log
+import reactor
+from netlayer import DrizzlePeer, Peer, STATE
+
+logger=log.getLogger(__name__)
+
+SO_REUSEPORT=getattr(socket, 'SO_REUSEPORT', 15) #Linux's value
+
+class MSG:
+	PKT=0 #(data, src): a datagram for the owner of src
+	STATE=1 #(addr, state): the owner's peer at addr changed state
+	HINT=2 #(addr, state): a non-owner wants the owner's peer at addr in state
+	SYNC=3 #(addr,): SyncTo addr, for its owner
+
+def Owner(addr, count):
+	#Hashes addr in one canonical form, so that str and unicode hosts, or
+	#tuples and lists (as decoded from packets), land on the same shard.
+	host, port=addr
+	return (zlib.crc32('%s:%d'%(str(host), int(port)))&0xffffffff)%count
+
+class GhostPeer(Peer):
+	#Another shard's peer, as far as this one knows. It is never put on the
+	#wheel; the owner runs its timers.
+	def _set_state(self, val):
+		self._state=val
+		self.this.Tell(self.this.Owner(self.addr), MSG.HINT, self.addr, val)
+	state=property(Peer._get_state, _set_state)
+	def Mirror(self, val):
+		#Wire stays at v1: the owner negotiates the version only after the
+		#state change that gets broadcast, and every peer understands v1.
+		wasdirect=self._state in (STATE.DIRECT, STATE.DIRECT_LOCAL)
+		self._state=val
+		if wasdirect!=(val in (STATE.DIRECT, STATE.DIRECT_LOCAL)):
+			self.this.DirectChanged(self, not wasdirect)
+	def Sync(self):
+		self.this.Tell(self.this.Owner(self.addr), MSG.SYNC, self.addr)
+
+class ShardedDrizzlePeer(DrizzlePeer):
+	def __init__(self, sock, index, ipcsocks, ipcpaths):
+		#ipcsocks[index] is ours to receive on; ipcpaths are everyone's.
+		DrizzlePeer.__init__(self, sock)
+		self.index=index
+		self.count=len(ipcpaths)
+		self.ipc=ipcsocks[index]
+		self.ipc.setblocking(False)
+		self.ipcpaths=ipcpaths
+		self.observers.append(self.Broadcast)
+	def Owner(self, addr):
+		return Owner(addr, self.count)
+	def Owns(self, addr):
+		return Owner(addr, self.count)==self.index
+	def Attach(self, rct):
+		DrizzlePeer.Attach(self, rct)
+		rct.AddReader(self.ipc, self.OnIPC)
+	def Tell(self, shard, *msg):
+		try:
+			self.ipc.sendto(serialize.Serialize(msg, None, serialize.WIRE_VERSION), self.ipcpaths[shard])
+		except socket.error as e:
+			logger.warning('Failed to reach shard %d: %s', shard, e)
+	def TellAll(self, *msg):
+		for shard in range(self.count):
+			if shard!=self.index:
+				self.Tell(shard, *msg)
+	def Recv(self, data, src):
+		if self.Owns(src):
+			DrizzlePeer.Recv(self, data, src)
+		else:
+			self.Tell(self.Owner(src), MSG.PKT, data, src)
+	def OnIPC(self, sock):
+		for i in range(self.BATCH_SIZE):
+			try:
+				data=sock.recv(self.BUF_SIZE)
+			except socket.error:
+				return #Nothing left (EAGAIN)
+			msg=serialize.Deserialize(data)
+			kind=msg[0]
+			if kind==MSG.PKT:
+				DrizzlePeer.Recv(self, msg[1], tuple(msg[2]))
+			elif kind==MSG.STATE:
+				self.Mirror(tuple(msg[1]), msg[2])
+			elif kind==MSG.HINT:
+				self.Hint(tuple(msg[1]), msg[2])
+			elif kind==MSG.SYNC:
+				DrizzlePeer.SyncTo(self, msg[1])
+			else:
+				logger.warning('Unknown shard message %r', msg)
+	def Hint(self, addr, state):
+		#Another shard would have our peer at addr in state. Only the moves
+		#LearnPeer makes are taken (towards arbitrating it); anything else,
+		#like a stale ghost's INDIRECT for a peer now DIRECT, is ignored.
+		peer=self.GetPeer(addr, True)
+		if peer is None or isinstance(peer, GhostPeer):
+			return
+		if peer.state==STATE.NOT_CONNECTED and state in (STATE.INDIRECT, STATE.INDIRECT_REMOTE):
+			peer.state=state
+		elif peer.state==STATE.INDIRECT_REMOTE and state==STATE.INDIRECT:
+			peer.state=state
+		else:
+			logger.debug('Ignoring hint of %s for %r', STATE.LOOKUP.get(state, state), peer)
+	def Mirror(self, addr, state):
+		if addr in self.addrs:
+			return
+		peer=self.peers.get(addr)
+		if peer is None:
+			peer=self.peers[addr]=GhostPeer(self, addr)
+		if isinstance(peer, GhostPeer):
+			peer.Mirror(state)
+			self.PeerChanged(addr, state)
+	def Broadcast(self, peer, state):
+		#Observer: tell the other shards about our own peers' state changes.
+		if not isinstance(peer, GhostPeer):
+			self.TellAll(MSG.STATE, peer.addr, state)
+	def NewPeer(self, addr, state=STATE.NOT_CONNECTED):
+		if self.Owns(addr):
+			return DrizzlePeer.NewPeer(self, addr, state)
+		if state!=STATE.NOT_CONNECTED:
+			self.Tell(self.Owner(addr), MSG.HINT, tuple(addr), state)
+		return GhostPeer(self, addr, state)
+	def SyncTo(self, addr):
+		if self.Owns(addr):
+			DrizzlePeer.SyncTo(self, addr)
+		else:
+			self.Tell(self.Owner(addr), MSG.SYNC, tuple(addr))
+	def LocalPeers(self):
+		return (peer for peer in self.peers.itervalues() if not isinstance(peer, GhostPeer))
+
+class ShardedNode(object):
+	def __init__(self, port, count=None, host=''):
+		if count is None:
+			count=multiprocessing.cpu_count()
+		self.addr=(host, port)
+		self.count=count
+		self.procs=[]
+		self.ipcdir=None
+	def Start(self, seeds=()):
+		#Everything is bound before forking, so no shard can talk to another
+		#that isn't listening yet.
+		self.ipcdir=tempfile.mkdtemp(prefix='drizzle-')
+		ipcpaths=[os.path.join(self.ipcdir, 'shard%d'%(i,)) for i in range(self.count)]
+		ipcsocks=[]
+		socks=[]
+		for path in ipcpaths:
+			ipc=socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+			ipc.bind(path)
+			ipcsocks.append(ipc)
+			sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+			sock.bind(self.addr)
+			socks.append(sock)
+		for index in range(self.count):
+			proc=multiprocessing.Process(target=self.Worker, args=(index, socks, ipcsocks, ipcpaths, seeds))
+			proc.daemon=True
+			proc.start()
+			self.procs.append(proc)
+		for sock in socks+ipcsocks:
+			sock.close()
+	def Worker(self, index, socks, ipcsocks, ipcpaths, seeds):
+		#Only socks[index] and ipcsocks[index] are this shard's; the rest were
+		#inherited from the parent, and would keep the other shards' sockets
+		#open (and getting datagrams) even after those shards had gone.
+		for i in range(self.count):
+			if i!=index:
+				socks[i].close()
+				ipcsocks[i].close()
+		dpeer=ShardedDrizzlePeer(socks[index], index, ipcsocks, ipcpaths)
+		dpeer.Attach(reactor.Reactor())
+		for addr in seeds:
+			if dpeer.Owns(addr):
+				dpeer.SyncTo(addr)
+		dpeer.Run()
+	def Join(self):
+		for proc in self.procs:
+			proc.join()
+	def Stop(self):
+		for proc in self.procs:
+			proc.terminate()
+		self.Join()
+		self.procs=[]
+		if self.ipcdir is not None:
+			shutil.rmtree(self.ipcdir, True)
+			self.ipcdir=None
+
+if __name__=='__main__':
+	if len(sys.argv)<2:
+		sys.argv.append('9652')
+	if len(sys.argv)<3:
+		sys.argv.append(str(multiprocessing.cpu_count()))
+	seeds=[]
+	for peerspec in sys.argv[3:]:
+		h, sep, port=peerspec.partition(':')
+		seeds.append((socket.gethostbyname(h), int(port)))
+	node=ShardedNode(int(sys.argv[1]), int(sys.argv[2]))
+	node.Start(seeds)
+	print('Sharded node on port', sys.argv[1], 'with', node.count, 'shards')
+	try:
+		node.Join()
+	finally:
+		node.Stop()
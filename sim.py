@@ -0,0 +1,298 @@
+'''
+drizzle -- Drizzle
+sim -- Mesh simulator
+
+Runs any number of DrizzlePeers in one process on a virtual network and a
+virtual clock, so that minutes of mesh behaviour (keep-alives, state
+updates, arbitration) take as long as the packets take to process rather
+than as long as the timers say.
+
+While a Simulator is installed (use it as a context manager), time.time
+returns its clock, and everything is driven off its event queue: each node
+is Attached to a Host, which stands in for its Reactor, and its socket is
+a VirtualSocket on the Network. Datagrams arrive after the network's
+latency (plus jitter), or are lost, at random; the Simulator seeds random
+itself, so a run with the same seed and inputs repeats exactly.
+
+Nodes may sit behind NATs, one per node or shared, of the usual kinds:
+full-cone (anyone may send in once the node has sent out), port-restricted
+(only those the node has sent to) and symmetric (a new mapping for every
+destination), so arbitration is exercised the way it is on the Internet.
+Nodes behind the same NAT reach each other's private addresses directly.
+
+    python sim.py [<nodes> [<seconds> [<seed>]]]
+'''
+
+import sys
+import time
+import heapq
+import errno
+import random
+import socket
+import itertools
+import collections
+
+import log
+import reactor
+from netlayer import DrizzlePeer, STATE
+
+logger=log.getLogger(__name__)
+
+class Host(object):
+	#Stands in for a Reactor, for one node: runs its timers and socket reads
+	#off the Simulator's queue, bracketed by its hooks.
+	def __init__(self, sim):
+		self.sim=sim
+		self.hooks=[]
+	def AddReader(self, sock, callback):
+		sock.reader=callback
+		sock.host=self
+	def RemoveReader(self, sock):
+		sock.reader=None
+	def AddTimer(self, timer):
+		entry=[timer.nextcall, next(self.sim.seq), self.Fire, None]
+		entry[3]=(timer, entry)
+		timer.entry=entry
+		heapq.heappush(self.sim.queue, entry)
+	def RemoveTimer(self, timer):
+		timer.entry=None
+	def CallLater(self, delay, callback, *args):
+		alarm=reactor.Alarm(delay, callback, *args)
+		self.AddTimer(alarm)
+		return alarm
+	def AddHooks(self, begin, end):
+		self.hooks.append((begin, end))
+	def Dispatch(self, f, *args):
+		for begin, end in self.hooks:
+			begin()
+		try:
+			return f(*args)
+		finally:
+			for begin, end in self.hooks:
+				end()
+	def Fire(self, timer, entry):
+		if timer.entry is not entry:
+			return #Removed or rescheduled
+		timer.entry=None
+		self.Dispatch(timer.Fire)
+		if timer.nextcall is not None and timer.entry is None:
+			self.AddTimer(timer)
+
+class VirtualSocket(object):
+	#What DrizzlePeer needs of a UDP socket.
+	def __init__(self, net, addr, nat=None):
+		self.net=net
+		self.addr=addr
+		self.nat=nat
+		self.inbox=collections.deque()
+		self.timeout=None
+		self.host=None
+		self.reader=None #Set by Host.AddReader
+		self.readpending=False
+		self.closed=False
+	def getsockname(self):
+		return self.addr
+	def settimeout(self, timeout):
+		self.timeout=timeout
+	def gettimeout(self):
+		return self.timeout
+	def setblocking(self, flag):
+		self.timeout=None if flag else 0.0
+	def sendto(self, data, addr):
+		self.net.Send(self, data, tuple(addr))
+		return len(data)
+	def recvfrom(self, size):
+		if not self.inbox:
+			raise socket.error(errno.EAGAIN, 'No datagrams waiting')
+		return self.inbox.popleft()
+	def close(self):
+		self.closed=True
+		self.net.sockets.pop(self.addr, None)
+
+class NAT(object):
+	FULL_CONE='full-cone'
+	RESTRICTED='port-restricted'
+	SYMMETRIC='symmetric'
+	def __init__(self, kind, ip, subnet):
+		if kind not in (self.FULL_CONE, self.RESTRICTED, self.SYMMETRIC):
+			raise ValueError('Unknown NAT kind %r'%(kind,))
+		self.kind=kind
+		self.ip=ip
+		self.subnet=subnet #Prefix of the private addresses behind it
+		self.hosts=0 #Private addresses handed out
+		self.ports=itertools.count(20000)
+		self.mappings={} #Private addr (and dest addr, if symmetric) -> public port
+		self.reverse={} #Public port -> [private addr, set of addrs allowed in (None for anyone)]
+	def __repr__(self):
+		return '<NAT %s %s>'%(self.kind, self.ip)
+	def Outbound(self, src, dest):
+		#The public addr src's datagram to dest leaves from.
+		key=(src, dest) if self.kind==self.SYMMETRIC else src
+		port=self.mappings.get(key)
+		if port is None:
+			port=self.mappings[key]=next(self.ports)
+			self.reverse[port]=[src, None if self.kind==self.FULL_CONE else set()]
+		allowed=self.reverse[port][1]
+		if allowed is not None:
+			allowed.add(dest)
+		return (self.ip, port)
+	def Inbound(self, port, src):
+		#The private addr a datagram from src to port goes to, or None if the
+		#NAT drops it.
+		mapping=self.reverse.get(port)
+		if mapping is None:
+			return None
+		private, allowed=mapping
+		if allowed is not None and src not in allowed:
+			return None
+		return private
+
+class Network(object):
+	PORT=9652 #Every node's port (each gets its own address)
+	LAN_LATENCY=0.0005 #Latency (in s) between nodes behind the same NAT
+	def __init__(self, sim, latency=0.02, jitter=0.005, loss=0.0):
+		self.sim=sim
+		self.latency=latency #One way, in s...
+		self.jitter=jitter #...plus up to this much more, at random
+		self.loss=loss #Chance of any datagram being lost
+		self.sockets={} #Addr (public, or private if behind a NAT) -> VirtualSocket
+		self.nats={} #Public IP -> NAT
+		self.publics=0
+		self.stats={'sent': 0, 'bytes': 0, 'delivered': 0, 'lost': 0, 'filtered': 0, 'unroutable': 0}
+	def PublicIP(self):
+		self.publics+=1
+		return '198.18.%d.%d'%divmod(self.publics, 256)
+	def AddNAT(self, kind):
+		nat=NAT(kind, self.PublicIP(), '10.%d.%d.'%divmod(len(self.nats)+1, 256))
+		self.nats[nat.ip]=nat
+		return nat
+	def AddSocket(self, nat=None):
+		if nat is None:
+			addr=(self.PublicIP(), self.PORT)
+		else:
+			nat.hosts+=1
+			addr=(nat.subnet+str(nat.hosts), self.PORT)
+		sock=self.sockets[addr]=VirtualSocket(self, addr, nat)
+		return sock
+	def LinkLatency(self, src, dest):
+		#One-way latency between two VirtualSockets; override for topologies.
+		return self.latency+self.sim.random.uniform(0, self.jitter)
+	def Send(self, sock, data, dest):
+		stats=self.stats
+		stats['sent']+=1
+		stats['bytes']+=len(data)
+		if self.loss and self.sim.random.random()<self.loss:
+			stats['lost']+=1
+			return
+		src=sock.addr
+		nat=sock.nat
+		target=None
+		if nat is not None:
+			target=self.sockets.get(dest)
+			if target is not None and target.nat is nat:
+				self.sim.At(self.sim.now+self.LAN_LATENCY, self.Deliver, target, data, src)
+				return
+			src=nat.Outbound(src, dest)
+		destnat=self.nats.get(dest[0])
+		if destnat is not None:
+			private=destnat.Inbound(dest[1], src)
+			if private is None:
+				stats['filtered']+=1
+				return
+			target=self.sockets.get(private)
+		else:
+			target=self.sockets.get(dest)
+			if target is not None and target.nat is not None:
+				target=None #Private addresses aren't reachable from outside
+		if target is None:
+			stats['unroutable']+=1
+			return
+		self.sim.At(self.sim.now+self.LinkLatency(sock, target), self.Deliver, target, data, src)
+	def Deliver(self, sock, data, src):
+		if sock.closed:
+			return
+		self.stats['delivered']+=1
+		sock.inbox.append((data, src))
+		if sock.reader is not None and not sock.readpending:
+			sock.readpending=True
+			self.sim.At(self.sim.now, self.Readable, sock)
+	def Readable(self, sock):
+		sock.readpending=False
+		if sock.reader is not None and sock.inbox:
+			sock.host.Dispatch(sock.reader, sock)
+
+class Simulator(object):
+	def __init__(self, seed=0, latency=0.02, jitter=0.005, loss=0.0, start=1000000000.0):
+		self.seed=seed
+		self.random=random.Random(seed) #For the network; the nodes use random itself
+		self.now=start
+		self.queue=[] #Heap of [time, seq, callable, args]
+		self.seq=itertools.count()
+		self.net=Network(self, latency, jitter, loss)
+		self.nodes=[]
+		self.realtime=None
+	def __enter__(self):
+		self.Install()
+		return self
+	def __exit__(self, *exc):
+		self.Uninstall()
+	def Install(self):
+		random.seed(self.seed)
+		self.realtime=time.time
+		time.time=self.Time
+	def Uninstall(self):
+		if self.realtime is not None:
+			time.time=self.realtime
+			self.realtime=None
+	def Time(self):
+		return self.now
+	def At(self, t, f, *args):
+		heapq.heappush(self.queue, [t, next(self.seq), f, args])
+	def AddNAT(self, kind):
+		return self.net.AddNAT(kind)
+	def AddNode(self, nat=None, cls=DrizzlePeer):
+		#A new node (of DrizzlePeer class cls), behind nat if given.
+		if self.realtime is None:
+			raise RuntimeError('Install the Simulator before adding nodes')
+		dpeer=cls(self.net.AddSocket(nat))
+		dpeer.Attach(Host(self))
+		self.nodes.append(dpeer)
+		return dpeer
+	def Run(self, duration):
+		self.RunUntil(self.now+duration)
+	def RunUntil(self, end):
+		queue=self.queue
+		while queue and queue[0][0]<=end:
+			t, seq, f, args=heapq.heappop(queue)
+			if t>self.now:
+				self.now=t
+			f(*args)
+		self.now=max(self.now, end)
+	def RunWhile(self, cond, timeout, step=1.0):
+		#Runs until cond() is false (checked every step s) or timeout s have
+		#passed; returns the time taken.
+		start=self.now
+		while cond() and self.now-start<timeout:
+			self.Run(step)
+		return self.now-start
+	def Links(self):
+		#Directly connected (node, peer) pairs, counting each way.
+		return sum(1 for node in self.nodes for peer in node.peers.itervalues() if peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL))
+
+if __name__=='__main__':
+	count=int(sys.argv[1]) if len(sys.argv)>1 else 50
+	seconds=float(sys.argv[2]) if len(sys.argv)>2 else 120
+	seed=int(sys.argv[3]) if len(sys.argv)>3 else 0
+	log.getLogger().setLevel(log.ERROR)
+	kinds=[None, NAT.FULL_CONE, NAT.RESTRICTED, NAT.SYMMETRIC]
+	wall=time.time()
+	with Simulator(seed) as sim:
+		seed=sim.AddNode()
+		for i in range(count-1):
+			kind=kinds[i%len(kinds)]
+			node=sim.AddNode(None if kind is None else sim.AddNAT(kind))
+			node.SyncTo(seed.sock.getsockname())
+		for t in range(10, int(seconds)+1, 10):
+			sim.Run(10)
+			print('t=%3ds links %d/%d'%(t, sim.Links(), count*(count-1)))
+	print('%d nodes, %ds simulated in %.1fs; network %r'%(count, seconds, time.time()-wall, sim.net.stats))
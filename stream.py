@@ -0,0 +1,459 @@
+'''
+drizzle -- Drizzle
+stream -- Reliable streams
+
+Ordered, reliable byte streams to directly connected peers, carried in DATA
+packets between StreamHandlers, so handlers can push bulk data at whatever
+rate the path allows instead of pacing best-effort datagrams by hand.
+
+The sender cuts what is written into numbered segments and keeps a window
+of them in flight. The receiver acknowledges the next segment it expects,
+plus up to MAX_SACK_RANGES ranges it already holds beyond that (selective
+ACKs), so only what is actually missing gets resent: a segment once DUPTHRESH
+later ones have arrived, or the oldest outstanding one when the
+retransmission timeout runs out. The timeout comes from the peer's smoothed
+RTT (see Peer.RTTSample), which KEEPALIVE round trips keep current even
+before any stream starts, and which acknowledgements then refine. Streams
+that are done with are remembered for as long as their senders could still
+be retrying, so late segments are dropped rather than starting them over.
+
+The window follows LEDBAT (RFC 6817): segments carry the sender's clock,
+the receiver returns how long they took (give or take the clocks' offset),
+and the window grows while that one-way delay stays within TARGET of the
+lowest seen, shrinks as queues build past it, and halves on loss. Transfers
+thus fill the link without crowding out the mesh's own traffic, or anything
+else on the path.
+'''
+
+import time
+import random
+import collections
+
+import log
+from netlayer import CMD, STATE, Packet, Millis, CLOCK_MASK
+
+logger=log.getLogger(__name__)
+
+def _Before(a, b):
+	#Whether clock value a (see Millis) is earlier than b.
+	return 0<((b-a)&CLOCK_MASK)<=(CLOCK_MASK>>1)
+
+def _Earliest(vals):
+	first=None
+	for val in vals:
+		if val is not None and (first is None or _Before(val, first)):
+			first=val
+	return first
+
+class SendStream(object):
+	def __init__(self, handler, peer, sid):
+		self.handler=handler
+		self.peer=peer
+		self.sid=sid
+		self.pending=collections.deque() #Written strs not yet cut into segments
+		self.pendingoff=0 #Offset into pending[0]
+		self.pendingbytes=0
+		self.closing=False #Close was called
+		self.finseq=None #Seq of the last segment, once it's made
+		self.una=0 #Lowest unacknowledged seq
+		self.nxt=0 #Next new seq
+		self.inflight=collections.OrderedDict() #Unacknowledged seq -> [data, resent since the last timeout], in seq order
+		self.highsack=-1 #Highest seq selectively acknowledged
+		self.rwnd=handler.RECV_WINDOW #Segments past una the receiver will take
+		self.cwnd=float(handler.INIT_WINDOW) #Segments allowed in flight
+		self.ssthresh=float('inf')
+		self.recover=-1 #Loss recovery lasts until this seq is acknowledged
+		self.basedelays=collections.deque([None], handler.BASE_HISTORY) #Lowest delay seen in each of the last few minutes
+		self.baseminute=int(time.time()//60)
+		self.delays=collections.deque((), handler.CURRENT_FILTER) #Latest delays
+		self.rtodeadline=None
+		self.backoff=0 #Timeouts in a row
+		self.done=False #Everything was acknowledged
+		self.failed=False
+		self.stats={'bytes': 0, 'segments': 0, 'retransmits': 0, 'timeouts': 0}
+	def __repr__(self):
+		return '<SendStream %d to %r>'%(self.sid, self.peer.addr)
+	def Write(self, data):
+		if self.closing:
+			raise ValueError('Write to a closed stream')
+		if data:
+			self.pending.append(data)
+			self.pendingbytes+=len(data)
+			self.Pump()
+	def Close(self):
+		if not self.closing:
+			self.closing=True
+			self.Pump()
+	def Take(self, size):
+		#Up to size bytes off the front of pending.
+		parts=[]
+		while size and self.pending:
+			chunk=self.pending[0]
+			off=self.pendingoff
+			part=chunk[off:off+size]
+			parts.append(part)
+			size-=len(part)
+			if off+len(part)>=len(chunk):
+				self.pending.popleft()
+				self.pendingoff=0
+			else:
+				self.pendingoff+=len(part)
+		data=parts[0] if len(parts)==1 else ''.join(parts)
+		self.pendingbytes-=len(data)
+		return data
+	def Pump(self):
+		#Sends new segments while the windows allow.
+		if self.done or self.failed:
+			return
+		size=self.handler.SegmentSize(self.peer)
+		while len(self.inflight)<int(self.cwnd) and self.nxt-self.una<self.rwnd:
+			if self.pendingbytes:
+				data=self.Take(size)
+			elif self.closing and self.finseq is None:
+				data=''
+			else:
+				break
+			seq=self.nxt
+			self.nxt+=1
+			if self.closing and not self.pendingbytes:
+				self.finseq=seq
+			self.inflight[seq]=[data, False]
+			self.Transmit(seq)
+		if self.inflight and self.rtodeadline is None:
+			self.rtodeadline=time.time()+self.RTO()
+	def Transmit(self, seq):
+		pkt=Packet(CMD.DATA, handler=self.handler.name, sid=self.sid, seq=seq, ts=Millis(), data=self.inflight[seq][0])
+		if seq==self.finseq:
+			pkt.fin=1
+		self.stats['segments']+=1
+		self.peer.Send(pkt)
+	def RTO(self):
+		return self.handler.RTO(self.peer, self.backoff)
+	def DelaySample(self, delay):
+		minute=int(time.time()//60)
+		if minute!=self.baseminute:
+			self.baseminute=minute
+			self.basedelays.append(None)
+		base=self.basedelays[-1]
+		if base is None or _Before(delay, base):
+			self.basedelays[-1]=delay
+		self.delays.append(delay)
+	def QueuingDelay(self):
+		#In s: how much longer segments take to arrive than they can.
+		current=_Earliest(self.delays)
+		if current is None:
+			return 0.0
+		base=_Earliest(self.basedelays)
+		if not _Before(base, current):
+			return 0.0
+		return ((current-base)&CLOCK_MASK)/1000.0
+	def OnAck(self, pkt):
+		if self.done or self.failed:
+			return
+		handler=self.handler
+		inflight=self.inflight
+		if pkt.Has('echo'):
+			#The echo is the clock of the segment that was acknowledged, so
+			#it times one transmission, resent or not.
+			self.peer.RTTSample(((Millis()-pkt.echo)&CLOCK_MASK)/1000.0)
+		if pkt.Has('delay'):
+			self.DelaySample(pkt.delay)
+		if pkt.Has('wnd'):
+			self.rwnd=pkt.wnd
+		ack=pkt.ack
+		if ack>self.nxt:
+			logger.warning('%r: ACK for %d, but only sent up to %d', self, ack, self.nxt)
+			return
+		acked=0
+		flight=len(inflight)
+		if ack>self.una:
+			while inflight:
+				seq=next(iter(inflight))
+				if seq>=ack:
+					break
+				self.stats['bytes']+=len(inflight.pop(seq)[0])
+				acked+=1
+			self.una=ack
+			self.backoff=0
+		if pkt.Has('sack'):
+			sack=pkt.sack
+			for i in xrange(0, len(sack)-1, 2):
+				start, end=max(sack[i], ack), min(sack[i+1], self.nxt)
+				if end-start>len(inflight):
+					seqs=[seq for seq in inflight if start<=seq<end]
+				else:
+					seqs=xrange(start, end)
+				for seq in seqs:
+					seg=inflight.pop(seq, None)
+					if seg is not None:
+						self.stats['bytes']+=len(seg[0])
+						acked+=1
+				self.highsack=max(self.highsack, end-1)
+		lost=[]
+		for seq, seg in inflight.iteritems():
+			if seq+handler.DUPTHRESH>self.highsack or len(lost)>=self.cwnd:
+				break
+			if not seg[1]:
+				lost.append(seq)
+		if lost and self.una>self.recover:
+			self.cwnd=max(self.cwnd/2, handler.MIN_WINDOW)
+			self.ssthresh=self.cwnd
+			self.recover=self.nxt-1
+		elif acked and self.una>self.recover:
+			self.Grow(acked, flight)
+		for seq in lost:
+			inflight[seq][1]=True
+			self.stats['retransmits']+=1
+			self.Transmit(seq)
+		if acked:
+			self.rtodeadline=time.time()+self.RTO() if inflight else None
+		if self.finseq is not None and not inflight and self.nxt>self.finseq:
+			self.done=True
+			self.rtodeadline=None
+			handler.Finished(self)
+			return
+		self.Pump()
+	def Grow(self, acked, flight):
+		handler=self.handler
+		qdelay=self.QueuingDelay()
+		if self.cwnd<self.ssthresh:
+			if qdelay<handler.TARGET/2:
+				self.cwnd+=acked
+			else:
+				self.ssthresh=self.cwnd
+		else:
+			self.cwnd+=handler.GAIN*(handler.TARGET-qdelay)/handler.TARGET*acked/self.cwnd
+		#No credit for window that wasn't used.
+		self.cwnd=max(handler.MIN_WINDOW, min(self.cwnd, flight+handler.ALLOWED_INCREASE))
+	def OnTimer(self, now):
+		if self.rtodeadline is None or now<self.rtodeadline:
+			return
+		handler=self.handler
+		self.stats['timeouts']+=1
+		self.backoff+=1
+		if self.backoff>handler.MAX_RETRIES:
+			logger.warning('%r: no ACKs after %d timeouts; giving up', self, handler.MAX_RETRIES)
+			handler.Fail(self)
+			return
+		self.ssthresh=max(self.cwnd/2, handler.MIN_WINDOW)
+		self.cwnd=float(handler.MIN_WINDOW)
+		self.recover=self.nxt-1
+		for seg in self.inflight.itervalues():
+			seg[1]=False
+		seq=next(iter(self.inflight))
+		self.inflight[seq][1]=True
+		self.stats['retransmits']+=1
+		self.Transmit(seq)
+		self.rtodeadline=now+self.RTO()
+
+class RecvStream(object):
+	def __init__(self, handler, peer, sid):
+		self.handler=handler
+		self.peer=peer
+		self.sid=sid
+		self.nxt=0 #Next seq to deliver
+		self.ooo={} #Seq -> data, for segments past nxt
+		self.finseq=None
+		self.unacked=0 #Segments since our last ACK
+		self.echo=None #Clock and delay of the latest segment, for the next ACK
+		self.delay=None
+		self.done=False #Everything up to the FIN was delivered
+		self.failed=False
+		self.lingeruntil=None #When done, time to stop answering retransmissions
+		self.chunks=[] #What StreamData collects by default
+		self.stats={'bytes': 0, 'segments': 0, 'duplicates': 0}
+	def __repr__(self):
+		return '<RecvStream %d from %r>'%(self.sid, self.peer.addr)
+	def Read(self):
+		#Everything the default StreamData collected so far.
+		data=''.join(self.chunks)
+		self.chunks=[data] if data else []
+		return data
+	def OnData(self, pkt):
+		handler=self.handler
+		seq=pkt.seq
+		self.stats['segments']+=1
+		if pkt.Has('fin'):
+			self.finseq=seq
+		if pkt.Has('ts'):
+			self.echo=pkt.ts
+			self.delay=(Millis()-pkt.ts)&CLOCK_MASK
+		self.unacked+=1
+		urgent=bool(self.ooo)
+		if seq==self.nxt:
+			self.Deliver(pkt.data)
+			ooo=self.ooo
+			while self.nxt in ooo:
+				self.Deliver(ooo.pop(self.nxt))
+		elif self.nxt<seq<self.nxt+handler.RECV_WINDOW and seq not in self.ooo:
+			self.ooo[seq]=pkt.data
+			urgent=True
+		else:
+			self.stats['duplicates']+=1
+			urgent=True
+		if urgent or self.unacked>=handler.ACK_EVERY or (self.finseq is not None and self.nxt>self.finseq):
+			self.Ack()
+		if not self.done and self.finseq is not None and self.nxt>self.finseq:
+			self.done=True
+			self.lingeruntil=time.time()+handler.LINGER
+			handler.StreamClosed(self)
+	def Deliver(self, data):
+		self.nxt+=1
+		if data:
+			self.stats['bytes']+=len(data)
+			self.handler.StreamData(self, data)
+	def Ack(self):
+		handler=self.handler
+		pkt=Packet(CMD.DATA, handler=handler.name, sid=self.sid, ack=self.nxt, wnd=handler.RECV_WINDOW-len(self.ooo))
+		if self.echo is not None:
+			pkt.echo=self.echo
+			pkt.delay=self.delay
+		if self.ooo:
+			pkt.sack=self.SackRanges()
+		self.unacked=0
+		self.peer.Send(pkt)
+	def SackRanges(self):
+		#The lowest MAX_SACK_RANGES runs of segments held past nxt, as a flat
+		#list of [start, end) pairs.
+		ranges=[]
+		limit=self.handler.MAX_SACK_RANGES
+		for seq in sorted(self.ooo):
+			if ranges and ranges[-1]==seq:
+				ranges[-1]=seq+1
+			elif len(ranges)<2*limit:
+				ranges.extend((seq, seq+1))
+			else:
+				break
+		return ranges
+
+class StreamHandler(object):
+	#A netlayer handler (registered on dpeer as name) for streams both ways.
+	#Override the Stream* methods to use what arrives.
+	TICK=0.02 #Interval (in s) on which to check timeouts and send delayed ACKs, while there are streams
+	STREAM_OVERHEAD=128 #Upper bound (in bytes) on what DATA adds to a segment, at any wire version
+	RECV_WINDOW=1024 #Segments past the next in-order one to accept
+	INIT_WINDOW=4 #Segments in flight at the start
+	MIN_WINDOW=1
+	ALLOWED_INCREASE=4 #Segments the window may exceed what was last in flight by
+	TARGET=0.1 #Queuing delay (in s) to aim for
+	GAIN=1.0 #Segments the window grows by per window acknowledged, at zero queuing delay
+	BASE_HISTORY=10 #Minutes to remember the lowest delay over
+	CURRENT_FILTER=4 #Latest delays to take the lowest of as the current one
+	DUPTHRESH=3 #Later segments acknowledged before one is taken as lost
+	ACK_EVERY=2 #In-order segments to acknowledge at once; others wait up to TICK
+	MAX_SACK_RANGES=8
+	INIT_RTO=1.0 #Retransmission timeout (in s) before the peer's RTT is known
+	MIN_RTO=0.2
+	MAX_RTO=10.0
+	MAX_RETRIES=8 #Timeouts in a row before giving up
+	LINGER=30 #Time (in s) to keep answering a finished stream's retransmissions
+	def __init__(self, dpeer, name='stream'):
+		self.dpeer=dpeer
+		self.name=name
+		self.sending={} #(Addr, sid) -> SendStream
+		self.receiving={} #(Addr, sid) -> RecvStream
+		self.closed={} #(Addr, sid) -> time until which to drop its segments
+		self.lastsid=int(random.getrandbits(31))
+		self.timing=False #DoTimers is scheduled
+		dpeer.handlers[name]=self
+	def SegmentSize(self, peer):
+		return self.dpeer.PATH_MTU-self.STREAM_OVERHEAD
+	def Open(self, peer):
+		#Returns a new SendStream to peer (a direct Peer); Write to it, then
+		#Close it.
+		if peer.state not in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			raise ValueError('%r is not directly connected'%(peer,))
+		self.StartTimer()
+		self.lastsid=sid=(self.lastsid+1)&0x7fffffff
+		stream=self.sending[(peer.addr, sid)]=SendStream(self, peer, sid)
+		return stream
+	def Send(self, peer, data):
+		stream=self.Open(peer)
+		stream.Write(data)
+		stream.Close()
+		return stream
+	def Recv(self, peer, pkt):
+		if not pkt.Has('sid'):
+			logger.warning('Stream packet without a sid from %r', peer)
+			return
+		key=(peer.addr, pkt.sid)
+		if pkt.Has('ack'):
+			stream=self.sending.get(key)
+			if stream is not None:
+				stream.OnAck(pkt)
+		elif pkt.Has('seq', 'data'):
+			stream=self.receiving.get(key)
+			if stream is None:
+				if key in self.closed:
+					self.dpeer.Dropped('stream_closed')
+					return
+				self.StartTimer()
+				stream=self.receiving[key]=RecvStream(self, peer, pkt.sid)
+				self.StreamOpened(stream)
+			stream.OnData(pkt)
+	def StateChange(self, peer, state):
+		if state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			return
+		for table in (self.sending, self.receiving):
+			for key, stream in table.items():
+				if key[0]==peer.addr and not stream.done:
+					self.Fail(stream)
+	def Finished(self, stream):
+		del self.sending[(stream.peer.addr, stream.sid)]
+		self.StreamSent(stream)
+	def Fail(self, stream):
+		stream.failed=True
+		if isinstance(stream, SendStream):
+			del self.sending[(stream.peer.addr, stream.sid)]
+		else:
+			self.Forget(stream)
+		self.StreamFailed(stream)
+	def Forget(self, stream):
+		key=(stream.peer.addr, stream.sid)
+		del self.receiving[key]
+		self.closed[key]=time.time()+self.Quarantine(stream.peer)
+	def RTO(self, peer, backoff=0):
+		srtt=peer.srtt
+		if srtt is None:
+			rto=self.INIT_RTO
+		else:
+			rto=max(self.MIN_RTO, srtt+max(4*peer.rttvar, self.TICK))
+		return min(rto*(1<<backoff), self.MAX_RTO)
+	def Quarantine(self, peer):
+		#How long (in s) a sender to peer could go on retransmitting after we
+		#last answered: MAX_RETRIES timeouts, backing off as SendStreams do.
+		return sum(self.RTO(peer, backoff) for backoff in xrange(self.MAX_RETRIES))
+	def StartTimer(self):
+		#Streams need dpeer on a Reactor (or anything else with CallLater,
+		#like aionet's) by the time they start.
+		if self.dpeer.reactor is None:
+			raise RuntimeError('StreamHandler %r needs its DrizzlePeer attached to a reactor (see DrizzlePeer.Attach) first'%(self.name,))
+		if not self.timing:
+			self.timing=True
+			self.dpeer.reactor.CallLater(self.TICK, self.DoTimers)
+	def DoTimers(self):
+		now=time.time()
+		for stream in self.sending.values():
+			stream.OnTimer(now)
+		for key, stream in self.receiving.items():
+			if stream.unacked:
+				stream.Ack()
+			if stream.done and stream.lingeruntil<now:
+				self.Forget(stream)
+		for key, until in self.closed.items():
+			if until<now:
+				del self.closed[key]
+		if self.sending or self.receiving or self.closed:
+			self.dpeer.reactor.CallLater(self.TICK, self.DoTimers)
+		else:
+			self.timing=False
+	def StreamOpened(self, stream):
+		pass
+	def StreamData(self, stream, data):
+		stream.chunks.append(data)
+	def StreamClosed(self, stream):
+		pass #Everything arrived
+	def StreamSent(self, stream):
+		pass #Everything was acknowledged
+	def StreamFailed(self, stream):
+		pass
@@ -0,0 +1,365 @@
+'''
+drizzle -- Drizzle
+swarm -- Piece exchange
+
+Content distribution over the mesh, after BitTorrent. Content is cut into
+fixed-size pieces, each hashed (with any hash in HASH_MAP) into a Manifest,
+and the manifest's own hash names the swarm. Every node in a swarm has a
+handler named for it ('swarm:' and the ID), so who is in which swarm goes
+around with the HANDLERS gossip. Neighbours in the same swarm swap
+bitfields of the pieces they have, then HAVEs as they get more.
+
+A node asks for the pieces it lacks from all of its direct neighbours at
+once, up to MAX_REQUESTS from each, rarest first so that pieces spread
+evenly. Pieces come back over reliable streams (see stream) and are checked
+against the manifest before they are kept or advertised.
+
+Nodes joining with only a swarm's ID fetch the manifest from a neighbour,
+and check it against the ID. Pieces are kept in memory.
+'''
+
+import time
+import random
+
+import serialize
+import log
+from netlayer import CMD, STATE, Packet, HASH_MAP
+from reactor import Timer
+from stream import StreamHandler
+
+logger=log.getLogger(__name__)
+
+class OP:
+	BITFIELD=0 #data: the pieces held, as bits (MSB first); answered in kind unless reply is set
+	HAVE=1 #seq: a piece just acquired
+	REQUEST=2 #seq: a piece wanted, which comes back over the SwarmNode's streams
+	REJECT=3 #seq: a requested piece that won't be coming
+	MANIFEST=4 #data: the manifest; without it, a request for it
+
+def _HasBit(bits, i):
+	return (i>>3)<len(bits) and bits[i>>3]&(0x80>>(i&7))
+
+def _SetBit(bits, i):
+	if (i>>3)>=len(bits):
+		bits.extend(bytearray((i>>3)-len(bits)+1))
+	bits[i>>3]|=0x80>>(i&7)
+
+def _ClearBit(bits, i):
+	if (i>>3)<len(bits):
+		bits[i>>3]&=~(0x80>>(i&7))
+
+class Manifest(object):
+	ID_LENGTH=32 #Hex digits of the manifest's hash to name the swarm by
+	MAX_PIECES=1<<20 #Most pieces a manifest may have, which also bounds what peers may claim before ours arrives
+	def __init__(self, name, length, piecesize, hashname, hashes):
+		if hashname not in HASH_MAP:
+			raise ValueError('Unknown hash %r'%(hashname,))
+		self.name=name
+		self.length=length
+		self.piecesize=piecesize
+		self.hashname=hashname
+		self.hashes=list(hashes)
+		if len(self.hashes)!=-(-length//piecesize):
+			raise ValueError('%d hashes for %d pieces'%(len(self.hashes), -(-length//piecesize)))
+		if len(self.hashes)>self.MAX_PIECES:
+			raise ValueError('%d pieces is more than %d'%(len(self.hashes), self.MAX_PIECES))
+		self.packed=serialize.Serialize([name, length, piecesize, hashname, self.hashes], None, serialize.WIRE_V1)
+		self.id=HASH_MAP[hashname].new(self.packed).hexdigest()[:self.ID_LENGTH]
+	def __repr__(self):
+		return '<Manifest %s %r, %d pieces>'%(self.id, self.name, len(self.hashes))
+	@classmethod
+	def FromData(cls, name, data, piecesize=262144, hashname='SHA512'):
+		hsh=HASH_MAP[hashname]
+		hashes=[hsh.new(data[off:off+piecesize]).digest() for off in xrange(0, len(data), piecesize)]
+		return cls(name, len(data), piecesize, hashname, hashes)
+	@classmethod
+	def Unpack(cls, s):
+		return cls(*serialize.Deserialize(s))
+	def Pieces(self):
+		return len(self.hashes)
+	def PieceLength(self, i):
+		return min(self.piecesize, self.length-i*self.piecesize)
+	def Check(self, i, data):
+		return len(data)==self.PieceLength(i) and HASH_MAP[self.hashname].new(data).digest()==self.hashes[i]
+
+class Swarm(object):
+	#The netlayer handler for one swarm.
+	MAX_REQUESTS=4 #Pieces to have requested from any one peer at once
+	REQUEST_TIMEOUT=60 #Time (in s) a requested piece has to arrive
+	MAX_BAD_PIECES=3 #Pieces failing their hash a peer may send before it's ignored
+	def __init__(self, node, id, manifest=None, data=None):
+		self.node=node
+		self.id=id
+		self.name='swarm:'+id
+		self.manifest=None
+		self.pieces=None #Piece -> data, or None if missing
+		self.have=bytearray()
+		self.count=0 #Pieces held
+		self.avail=None #Piece -> number of peers with it
+		self.bitfields={} #Addr -> bytearray of the pieces a peer has
+		self.greeted=set() #Addrs we sent our bitfield to
+		self.requests={} #Piece -> (addr asked, deadline)
+		self.load={} #Addr -> pieces requested from it
+		self.bad={} #Addr -> pieces from it that failed their hash
+		self.stats={'downloaded': 0, 'uploaded': 0, 'bad': 0}
+		if manifest is not None:
+			self.SetManifest(manifest, data)
+	def __repr__(self):
+		return '<Swarm %s %d/%s>'%(self.id, self.count, self.manifest and self.manifest.Pieces())
+	def SetManifest(self, manifest, data=None):
+		#data, if given, is the whole content.
+		if manifest.id!=self.id:
+			raise ValueError('Manifest %s is not for swarm %s'%(manifest.id, self.id))
+		self.manifest=manifest
+		count=manifest.Pieces()
+		self.pieces=[None]*count
+		self.have=bytearray(-(-count//8))
+		if data is not None:
+			for i in xrange(count):
+				piece=data[i*manifest.piecesize:(i+1)*manifest.piecesize]
+				if manifest.Check(i, piece):
+					self.pieces[i]=piece
+					_SetBit(self.have, i)
+					self.count+=1
+		self.avail=[0]*count
+		for bits in self.bitfields.itervalues():
+			del bits[len(self.have):]
+			self.CountBits(bits, 1)
+	def CountBits(self, bits, delta):
+		avail=self.avail
+		for i in xrange(min(len(avail), 8*len(bits))):
+			if _HasBit(bits, i):
+				avail[i]+=delta
+	def PieceLimit(self):
+		#Pieces there are, or could be if the manifest isn't here yet.
+		if self.manifest is None:
+			return Manifest.MAX_PIECES
+		return self.manifest.Pieces()
+	def Complete(self):
+		return self.manifest is not None and self.count==self.manifest.Pieces()
+	def Data(self):
+		if not self.Complete():
+			return None
+		return ''.join(self.pieces)
+	def Tell(self, peer, op, **attrs):
+		peer.Send(Packet(CMD.DATA, handler=self.name, op=op, **attrs))
+	def Members(self):
+		#The direct peers known to be in the swarm.
+		for addr in self.bitfields:
+			peer=self.node.dpeer.GetPeer(addr)
+			if peer is not None and peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+				yield peer
+	def Greet(self, peer, reply=False):
+		self.greeted.add(peer.addr)
+		if reply:
+			self.Tell(peer, OP.BITFIELD, data=str(self.have), reply=1)
+		else:
+			self.Tell(peer, OP.BITFIELD, data=str(self.have))
+	def Recv(self, peer, pkt):
+		if not pkt.Has('op'):
+			logger.warning('Swarm packet without an op from %r', peer)
+			return
+		op=pkt.op
+		addr=peer.addr
+		if op in (OP.HAVE, OP.REQUEST, OP.REJECT) and not (pkt.Has('seq') and isinstance(pkt.seq, (int, long)) and 0<=pkt.seq<self.PieceLimit()):
+			logger.warning('Swarm op %r for a piece out of range from %r', op, peer)
+			self.node.dpeer.Dropped('bad_piece')
+			return
+		if op==OP.BITFIELD:
+			data=pkt.data if pkt.Has('data') else ''
+			#Checked before the bytearray is made: bytearray(n) would be n bytes.
+			if not isinstance(data, str) or len(data)>-(-self.PieceLimit()//8):
+				logger.warning('Bad bitfield for %r from %r', self, peer)
+				self.node.dpeer.Dropped('bad_bitfield')
+				return
+			bits=bytearray(data)
+			old=self.bitfields.get(addr)
+			if self.avail is not None:
+				if old is not None:
+					self.CountBits(old, -1)
+				self.CountBits(bits, 1)
+			self.bitfields[addr]=bits
+			if not pkt.Has('reply'):
+				self.Greet(peer, True)
+			if self.manifest is None:
+				self.Tell(peer, OP.MANIFEST)
+			self.Schedule()
+		elif op==OP.HAVE:
+			bits=self.bitfields.get(addr)
+			if bits is None:
+				bits=self.bitfields[addr]=bytearray()
+			i=pkt.seq
+			if not _HasBit(bits, i):
+				_SetBit(bits, i)
+				if self.avail is not None and i<len(self.avail):
+					self.avail[i]+=1
+			self.Schedule()
+		elif op==OP.REQUEST:
+			i=pkt.seq
+			if self.pieces is not None and 0<=i<len(self.pieces) and self.pieces[i] is not None:
+				self.stats['uploaded']+=len(self.pieces[i])
+				self.node.SendPiece(peer, self, i)
+			else:
+				self.Tell(peer, OP.REJECT, seq=i)
+		elif op==OP.REJECT:
+			i=pkt.seq
+			if self.requests.get(i, (None,))[0]==addr:
+				self.EndRequest(i)
+			bits=self.bitfields.get(addr)
+			if bits is not None and _HasBit(bits, i):
+				_ClearBit(bits, i)
+				if self.avail is not None and i<len(self.avail):
+					self.avail[i]-=1
+			self.Schedule()
+		elif op==OP.MANIFEST:
+			if not pkt.Has('data'):
+				if self.manifest is not None:
+					self.Tell(peer, OP.MANIFEST, data=self.manifest.packed)
+			elif self.manifest is None:
+				try:
+					manifest=Manifest.Unpack(pkt.data)
+				except Exception as e:
+					logger.warning('Bad manifest for %r from %r: %s', self, peer, e)
+					return
+				if manifest.id!=self.id:
+					logger.warning('Manifest from %r is not for %r', peer, self)
+					return
+				self.SetManifest(manifest)
+				self.Schedule()
+		else:
+			logger.warning('Unknown swarm op %r from %r', op, peer)
+	def StateChange(self, peer, state):
+		if state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+			return
+		addr=peer.addr
+		self.greeted.discard(addr)
+		bits=self.bitfields.pop(addr, None)
+		if bits is not None and self.avail is not None:
+			self.CountBits(bits, -1)
+		for i, (asked, deadline) in self.requests.items():
+			if asked==addr:
+				self.EndRequest(i)
+	def Request(self, peer, i):
+		self.requests[i]=(peer.addr, time.time()+self.REQUEST_TIMEOUT)
+		self.load[peer.addr]=self.load.get(peer.addr, 0)+1
+		self.Tell(peer, OP.REQUEST, seq=i)
+	def EndRequest(self, i):
+		req=self.requests.pop(i, None)
+		if req is None:
+			return
+		load=self.load[req[0]]-1
+		if load:
+			self.load[req[0]]=load
+		else:
+			del self.load[req[0]]
+	def Schedule(self):
+		#Requests missing pieces, rarest first, from whoever has them and the
+		#fewest requests outstanding.
+		if self.manifest is None or self.Complete():
+			return
+		load=self.load
+		peers=[peer for peer in self.Members() if load.get(peer.addr, 0)<self.MAX_REQUESTS and self.bad.get(peer.addr, 0)<self.MAX_BAD_PIECES]
+		if not peers:
+			return
+		avail=self.avail
+		wanted=[i for i in xrange(len(avail)) if avail[i] and self.pieces[i] is None and i not in self.requests]
+		random.shuffle(wanted)
+		wanted.sort(key=avail.__getitem__)
+		for i in wanted:
+			holders=[peer for peer in peers if _HasBit(self.bitfields[peer.addr], i)]
+			if not holders:
+				continue
+			peer=min(holders, key=lambda peer: load.get(peer.addr, 0))
+			self.Request(peer, i)
+			if load[peer.addr]>=self.MAX_REQUESTS:
+				peers.remove(peer)
+				if not peers:
+					break
+	def PieceArrived(self, peer, i, data):
+		if self.requests.get(i, (None,))[0]==peer.addr:
+			self.EndRequest(i)
+		if self.manifest is None or not 0<=i<len(self.pieces) or self.pieces[i] is not None:
+			return
+		if not self.manifest.Check(i, data):
+			logger.warning('Piece %d of %r from %r failed its hash', i, self, peer)
+			self.stats['bad']+=1
+			self.bad[peer.addr]=self.bad.get(peer.addr, 0)+1
+			self.Schedule()
+			return
+		self.pieces[i]=data
+		_SetBit(self.have, i)
+		self.count+=1
+		self.stats['downloaded']+=len(data)
+		for member in self.Members():
+			self.Tell(member, OP.HAVE, seq=i)
+		if self.Complete():
+			logger.info('%r complete', self)
+			self.node.Completed(self)
+		else:
+			self.Schedule()
+	def DoTimers(self, now):
+		for peer in self.node.dpeer.LocalPeers():
+			if self.name in peer.handlers and peer.addr not in self.greeted and peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+				self.Greet(peer)
+		for i, (addr, deadline) in self.requests.items():
+			if deadline<now:
+				logger.info('Request for piece %d of %r from %r timed out', i, self, addr)
+				self.EndRequest(i)
+		self.Schedule()
+
+class PieceStreams(StreamHandler):
+	#Each stream is one piece: a serialized [swarm ID, piece] header, then
+	#the piece.
+	def __init__(self, node, dpeer, name):
+		StreamHandler.__init__(self, dpeer, name)
+		self.node=node
+	def StreamClosed(self, stream):
+		data=stream.Read()
+		try:
+			(id, i), off=serialize.DeserializeFrom(data, 0)
+		except Exception as e:
+			logger.warning('Bad piece stream from %r: %s', stream.peer, e)
+			return
+		swarm=self.node.swarms.get(id)
+		if swarm is not None:
+			swarm.PieceArrived(stream.peer, i, data[off:])
+
+class SwarmNode(object):
+	TICK=1 #Interval (in s) on which swarms look for new members and expired requests
+	def __init__(self, dpeer, name='swarm'):
+		#name is the handler for the piece streams.
+		self.dpeer=dpeer
+		self.swarms={} #ID -> Swarm
+		self.streams=PieceStreams(self, dpeer, name)
+		dpeer.timers.add(Timer(self.TICK, self.DoTimers))
+	def Join(self, manifest=None, data=None, id=None):
+		#Joins the swarm for manifest (seeding data, if given), or the one
+		#with id, whose manifest will be fetched.
+		if manifest is not None:
+			id=manifest.id
+		swarm=self.swarms.get(id)
+		if swarm is None:
+			swarm=self.swarms[id]=Swarm(self, id, manifest, data)
+			self.dpeer.handlers[swarm.name]=swarm
+			#Everyone we know gets our bitfield; those in the swarm answer.
+			for peer in self.dpeer.LocalPeers():
+				if peer.state in (STATE.DIRECT, STATE.DIRECT_LOCAL):
+					swarm.Greet(peer)
+		elif manifest is not None and swarm.manifest is None:
+			swarm.SetManifest(manifest, data)
+		return swarm
+	def Leave(self, id):
+		swarm=self.swarms.pop(id, None)
+		if swarm is not None:
+			del self.dpeer.handlers[swarm.name]
+	def SendPiece(self, peer, swarm, i):
+		stream=self.streams.Open(peer)
+		stream.Write(serialize.Serialize([swarm.id, i], None, serialize.WIRE_V1))
+		stream.Write(swarm.pieces[i])
+		stream.Close()
+	def DoTimers(self):
+		now=time.time()
+		for swarm in self.swarms.values():
+			swarm.DoTimers(now)
+	def Completed(self, swarm):
+		pass #For subclasses
@@ -0,0 +1,81 @@
+'''
+drizzle -- Drizzle
+wheel -- Hierarchical timing wheel
+
+Keeps large numbers of coarse deadlines (like per-peer keep-alives) such
+that scheduling, rescheduling and cancelling are O(1), and advancing the
+clock only touches items that are actually due (plus the occasional cascade
+of a higher level's slot into the ones below it).
+
+Each level has SLOTS slots; a slot on level L spans SLOTS**L ticks of
+resolution seconds. Deadlines further out than the top level can hold are
+parked in its farthest slot and re-filed when they come around.
+'''
+
+import math
+
+class TimingWheel(object):
+	BITS=6
+	SLOTS=1<<BITS
+	MASK=SLOTS-1
+	def __init__(self, resolution, start, levels=4):
+		self.resolution=float(resolution)
+		self.levels=levels
+		self.wheels=[[{} for i in range(self.SLOTS)] for j in range(levels)]
+		self.where={} #Item -> the slot dict (item -> deadline) holding it
+		self.tick=self.Tick(start)
+	def __len__(self):
+		return len(self.where)
+	def __contains__(self, item):
+		return item in self.where
+	def Tick(self, t):
+		return int(math.floor(t/self.resolution))
+	def Schedule(self, item, deadline):
+		#(Re)schedules item to come out of Advance once deadline has passed.
+		self.Cancel(item)
+		self.File(item, deadline, self.tick+1)
+	def File(self, item, deadline, first):
+		#Puts item in its slot, but no earlier than tick first.
+		ticks=max(int(math.ceil(deadline/self.resolution)), first)
+		delta=ticks-self.tick
+		level=0
+		while level<self.levels-1 and delta>=(1<<(self.BITS*(level+1))):
+			level+=1
+		if delta>=(1<<(self.BITS*(level+1))):
+			#Beyond the top level; park in its farthest slot for now.
+			ticks=self.tick+(self.MASK<<(self.BITS*level))
+		slot=self.wheels[level][(ticks>>(self.BITS*level))&self.MASK]
+		slot[item]=deadline
+		self.where[item]=slot
+	def Cancel(self, item):
+		slot=self.where.pop(item, None)
+		if slot is not None:
+			del slot[item]
+	def Advance(self, now):
+		#Moves the clock to now, returning the list of items whose deadlines
+		#have passed; they are no longer scheduled.
+		expired=[]
+		target=self.Tick(now)
+		while self.tick<target:
+			self.tick+=1
+			self.Cascade(1)
+			slot=self.wheels[0][self.tick&self.MASK]
+			if slot:
+				for item in slot:
+					del self.where[item]
+				expired.extend(slot)
+				slot.clear()
+		return expired
+	def Cascade(self, level):
+		#When a lower level wraps around, the next slot of this one is
+		#re-filed into the levels below.
+		if level>=self.levels or (self.tick>>(self.BITS*(level-1)))&self.MASK:
+			return
+		self.Cascade(level+1)
+		slot=self.wheels[level][(self.tick>>(self.BITS*level))&self.MASK]
+		if slot:
+			items=list(slot.items())
+			slot.clear()
+			for item, deadline in items:
+				#The current tick's level 0 slot hasn't been run yet.
+				self.File(item, deadline, self.tick)